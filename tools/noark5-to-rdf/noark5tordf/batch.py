@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, glob, time, pickle, shutil, signal, logging, traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import *
+from .sinks import createSink, getOutputStem
+from .formats import getOutputExtension
+from .incremental import startRun, finishRun
+from .inputs import isArchive, isXmlInput, listArchive, splitMember, getInputBasename
+from .metrics import Metrics, isMetered, writeMetrics
+from .references import getIdIndexPath, collectReferences, finishReferences
+from .checksums import ChecksumReport, writeChecksumReport
+from .subjectindex import relocateOutputs
+
+# Config and logger of a worker process, set once by _initWorker so the
+# config is only parsed (and pickled) once per worker, not once per file
+_worker_config = None
+_worker_logger = None
+
+
+def _initWorker(config, logger_name):
+    global _worker_config, _worker_logger
+    _worker_config = config
+    _worker_logger = logger_name and logging.getLogger(logger_name) or None
+
+    # Let the parent decide when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class WorkerError(Exception):
+    """ A exception of a worker process that can't be sent to the parent as it is, e.g. a SAXParseException """
+
+
+def getPortableError(error):
+    """
+    Get a exception to raise in a worker process instead of "error". The parent can't unpickle
+    some exceptions, which breaks the pool and fails all files that are still waiting
+    """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return WorkerError("".join(traceback.format_exception_only(type(error), error)).strip())
+
+
+def _convertFile(path, name=None, stem=None, bnode_prefix=""):
+    """
+    Convert a single file in a worker process. "name" is the file name to derive the
+    output name from (defaults to "path"), "stem" overrides the output name altogether
+    """
+    # Imported here to avoid a circular import with the command line module
+    from .noark5tordf import process_xml_file
+
+    config = _worker_config
+    if stem is not None:
+        config = dict(config, output_file=stem)
+
+    start = time.time()
+    sink = createSink(config, inputfile=name or path, logger=_worker_logger)
+    try:
+        result = process_xml_file(config, path, logger=_worker_logger, sink=sink, bnode_prefix=bnode_prefix)
+    except Exception as e:
+        raise getPortableError(e)
+    finally:
+        sink.close()
+
+    stats = {"file": name or path, "subjects": sink.subjects, "triples": sink.triples,
+             "seconds": time.time() - start, "output": sink.getFilenames(), "error": None}
+    # Added, changed etc. subjects of incremental runs, and the violations when validating
+    if hasattr(sink, "getCounts"):
+        stats.update(sink.getCounts())
+    if hasattr(result, "metrics"):
+        stats["metrics"] = result.metrics.asDict()
+    if hasattr(result, "checksums"):
+        stats["checksums"] = result.checksums.asDict()
+        stats["checksum_mismatches"] = result.checksums.mismatches
+
+    return stats
+
+
+def expandInputs(paths):
+    """
+    Expand a list of files, directories and glob patterns to a sorted list of (possibly compressed)
+    XML files. Directories are searched recursively, and tar and zip archives are expanded to their
+    XML members ("<archive>!<member>")
+    """
+    if not is_sequence(paths):
+        paths = [paths]
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(sorted(os.path.join(root, name) for name in names if isXmlInput(name) or isArchive(name)))
+        elif os.path.isfile(path) or splitMember(path)[1] is not None:
+            files.append(path)
+        else:
+            files.extend(sorted(glob.glob(path, recursive=True)))
+
+    expanded = []
+    for path in files:
+        if isArchive(path) and os.path.isfile(path):
+            expanded.extend(listArchive(path))
+        else:
+            expanded.append(path)
+    files = expanded
+
+    # Drop duplicates but keep the order
+    seen = set()
+    return [f for f in files if not (os.path.abspath(f) in seen or seen.add(os.path.abspath(f)))]
+
+
+def _mergeOutputs(stats, filename, logger=None, config=None):
+    """
+    Concatenate the outputs of the converted files, in input order, into a single file (and move
+    their subjects in the subject index of the config, if any)
+    """
+    moves = []
+    with open(filename, "wb") as output:
+        for file_stats in stats:
+            if file_stats["error"]:
+                continue
+
+            for part in file_stats["output"]:
+                with open(part, "rb") as infile:
+                    shutil.copyfileobj(infile, output, 1024 * 1024)
+                os.remove(part)
+                moves.append((part, filename))
+
+            file_stats["output"] = [filename]
+
+    if config is not None:
+        relocateOutputs(config, moves)
+
+    if logger:
+        logger.info("Merged %s outputs into '%s'" % (len(stats), filename))
+
+
+def process_xml_files(config, inputs, workers=None, merge=False, logger=None):
+    """
+    Convert many XML files in parallel using a pool of "workers" processes (default: number of CPUs).
+    "inputs" are files, directories or glob patterns.
+
+    In "stream" and "sharded" output mode, the output of input file number N is named
+    "<NNNNN>-<input name>", so the names are unique and stable across runs. If "merge" is True
+    the outputs are concatenated into "output_file" in input order instead. Blank nodes are
+    prefixed with the input file number, so their labels never collide in merged output.
+
+    With a "manifest" in the config, the files are converted as one incremental run. The
+    subjects that none of the files have are only listed as deleted if all files succeed.
+
+    With metrics turned on (see metrics.py) the metrics of all files are added up and written
+    once, to "<output>-metrics.json" if "metrics" is just true, and so are the checksum reports
+    (to "<output>-checksums.json", see checksums.py). Likewise the references between
+    the subjects of all files are resolved together (see references.py).
+
+    Returns a list of stats (one dict per input file, in input order). Files that fail don't
+    abort the run, the error is recorded in the "error" field of their stats.
+    """
+    files = expandInputs(inputs)
+    config = startRun(config)
+    workers = workers or os.cpu_count() or 1
+    metered = isMetered(config)
+    if metered:
+        config = dict(config, metrics_collect=True)
+    # And so are the checksum reports
+    verifying = bool(config.get("verify_checksums"))
+    if verifying:
+        config = dict(config, checksums_collect=True)
+    # The references of all files are resolved together at the end
+    referencing = bool(getIdIndexPath(config))
+    if referencing:
+        config = collectReferences(config)
+    # Only stream and sharded output is written to files of each input
+    per_file = (config.get("output_mode") or "per-subject") in ["stream", "sharded"]
+
+    if logger:
+        logger.info("Converting %s files with %s workers" % (len(files), workers))
+
+    assertDir(config.get("output_dir", "."))
+    merged_stem = getOutputStem(config)
+    parts_dir = os.path.join(config.get("output_dir", "."), ".parts")
+    if merge and per_file:
+        assertDir(parts_dir)
+
+    stats = []
+    logger_name = logger and logger.name or None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(config, logger_name)) as executor:
+        futures = []
+        for index, path in enumerate(files):
+            name = "%05d-%s" % (index, getInputBasename(path))
+            stem = None
+            if per_file:
+                stem = os.path.join(parts_dir if merge else config.get("output_dir", "."), name)
+
+            futures.append(executor.submit(_convertFile, path, name=path, stem=stem, bnode_prefix="f%05d-" % index))
+
+        for path, future in zip(files, futures):
+            try:
+                file_stats = future.result()
+            except Exception as e:
+                file_stats = {"file": path, "subjects": 0, "triples": 0, "seconds": 0, "output": [],
+                              "error": "".join(traceback.format_exception_only(type(e), e)).strip()}
+                if logger:
+                    logger.error("Failed to convert '%s': %s" % (path, file_stats["error"]))
+
+            stats.append(file_stats)
+
+    if merge and per_file:
+        _mergeOutputs(stats, merged_stem + getOutputExtension(config), logger=logger, config=config)
+
+        # Also removes partial output of failed files
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    failed = [s for s in stats if s["error"]]
+    deleted = finishRun(config, deletions=not failed, logger=logger)
+
+    if referencing:
+        finishReferences(config, logger=logger)
+
+    if verifying:
+        report = ChecksumReport(config.get("checksum_max_details"))
+        for file_stats in stats:
+            if file_stats.get("checksums"):
+                report.merge(file_stats["checksums"])
+        writeChecksumReport(config, report, logger=logger)
+
+    if metered:
+        metrics = Metrics()
+        for file_stats in stats:
+            if file_stats.get("metrics"):
+                metrics.merge(file_stats["metrics"])
+        writeMetrics(config, metrics, logger=logger)
+
+    if logger:
+        if config.get("manifest_run") is not None:
+            logger.info("%s subjects added, %s changed, %s unchanged, %s deleted" % (
+                sum(s.get("added", 0) for s in stats), sum(s.get("changed", 0) for s in stats),
+                sum(s.get("unchanged", 0) for s in stats), len(deleted)))
+        if [s for s in stats if "violations" in s]:
+            logger.info("Found %s violations in %s files" % (
+                sum(s.get("violations", 0) for s in stats), len([s for s in stats if s.get("violations")])))
+        logger.info("Converted %s files (%s subjects, %s triples), %s failed" % (
+            len(stats) - len(failed), sum(s["subjects"] for s in stats), sum(s["triples"] for s in stats), len(failed)))
+
+    return stats
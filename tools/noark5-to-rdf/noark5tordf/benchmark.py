@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Throughput and memory benchmarks of the converter on synthetic Noark5 files
+
+import sys, os, json, time, shutil, platform, tempfile, argparse, multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .utils import *
+from .synthetic import ArchiveGenerator, parseSize
+
+# The stored baseline, next to setup.py
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark-baseline.json")
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "noark5.yaml")
+
+# Shapes of synthetic input, as ArchiveGenerator options
+CASES = {
+    "default": {},
+    "flat": {"depth": 1, "registreringer": 20},
+    "deep": {"depth": 6, "mapper": 2, "registreringer": 2},
+    "wide": {"depth": 1, "registreringer": 500, "dokumenter": 2},
+    "non-ascii": {"non_ascii": 0.3, "text_size": 120},
+}
+
+# Higher is better for these, lower for the rest
+RATES = ["elements_per_second", "triples_per_second", "mb_per_second"]
+COMPARED = RATES + ["peak_rss_mb"]
+
+
+def _peakRss():
+    """ The peak resident set size of this process in MB, or None where it is unknown """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (sys.platform == "darwin" and 1024.0 * 1024 or 1024.0)
+
+
+def _convert(configfile, inputfile, output_dir, output_mode):
+    """ Convert a file in a fresh process and measure it """
+    from . import config as config_module
+    from .noark5tordf import process_xml_file
+
+    cfg = config_module.readConfig(configfile, output_dir=output_dir, input_dir=os.path.join(output_dir, "input"),
+                                   backup_dir=os.path.join(output_dir, "backup"), output_mode=output_mode, logger=None)
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    sink = process_xml_file(cfg, inputfile)
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    files = 0
+    for root, dirs, names in os.walk(output_dir):
+        dirs[:] = [d for d in dirs if d not in ["input", "backup"]]
+        files = files + len(names)
+
+    return {"seconds": seconds, "cpu_seconds": cpu, "subjects": sink.subjects, "triples": sink.triples,
+            "files": files, "peak_rss_mb": _peakRss()}
+
+
+def runBenchmark(inputfile, elements=None, configfile=DEFAULT_CONFIG, output_mode="stream", repeat=1, work_dir=None):
+    """
+    Convert a file end to end ("repeat" times, each in a new process so the peak RSS is its own) and
+    return the best run: seconds, triples, subjects, output files, peak RSS and the rates. "elements"
+    is the number of elements in the file, for the elements per second
+    """
+    size = os.path.getsize(inputfile)
+    context = multiprocessing.get_context("spawn")
+    best = None
+    for run in range(max(1, repeat)):
+        output_dir = tempfile.mkdtemp(prefix="noark5tordf-benchmark-", dir=work_dir)
+        try:
+            with context.Pool(1) as pool:
+                result = pool.apply(_convert, (configfile, inputfile, output_dir, output_mode))
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+
+    seconds = max(best["seconds"], 1e-9)
+    best.update({
+        "bytes": size,
+        "elements": elements,
+        "elements_per_second": elements and elements / seconds or None,
+        "triples_per_second": best["triples"] / seconds,
+        "mb_per_second": size / seconds / (1024 * 1024),
+    })
+    return best
+
+
+def runSuite(cases=None, sizes=("10MB",), output_modes=("stream",), repeat=1, configfile=DEFAULT_CONFIG, work_dir=None, logger=None):
+    """
+    Generate the synthetic input of every case and size (see CASES) and benchmark every output
+    mode on it. Returns the results by "<case>/<size>/<output mode>"
+    """
+    results = {}
+    input_dir = tempfile.mkdtemp(prefix="noark5tordf-benchmark-input-", dir=work_dir)
+    try:
+        for name in cases or sorted(CASES):
+            for size in sizes:
+                inputfile = os.path.join(input_dir, "%s-%s.xml" % (name, size))
+                generator = ArchiveGenerator(**CASES[name])
+                with open(inputfile, "wb") as output:
+                    generator.write(output, size=parseSize(size))
+
+                for output_mode in output_modes:
+                    key = "%s/%s/%s" % (name, size, output_mode)
+                    results[key] = runBenchmark(inputfile, generator.elements, configfile, output_mode, repeat, work_dir)
+                    if logger:
+                        logger.info("%s: %s" % (key, formatResult(results[key])))
+
+                os.remove(inputfile)
+    finally:
+        shutil.rmtree(input_dir, ignore_errors=True)
+
+    return results
+
+
+def formatResult(result):
+    rss = result["peak_rss_mb"] is not None and "%.0f MB peak RSS" % result["peak_rss_mb"] or "peak RSS unknown"
+    return "%.2fs, %.0f elements/s, %.0f triples/s, %.2f MB/s, %s, %s files" % (
+        result["seconds"], result["elements_per_second"] or 0, result["triples_per_second"], result["mb_per_second"], rss, result["files"])
+
+
+def readBaseline(filename=BASELINE_FILE):
+    """ Read a stored baseline, or None if there is none """
+    try:
+        with open(filename, encoding="utf-8") as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return None
+
+
+def writeBaseline(results, filename=BASELINE_FILE):
+    """ Store results as the baseline, with the Python version and platform they were measured on """
+    baseline = {"python": platform.python_version(), "platform": platform.platform(), "machine": platform.machine(),
+                "cpus": os.cpu_count(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    with open(filename, "w", encoding="utf-8") as output:
+        json.dump(baseline, output, indent=2, sort_keys=True)
+        output.write("\n")
+    return baseline
+
+
+def compareBaseline(results, baseline, tolerance=0.25):
+    """
+    Compare results with a baseline. Returns a list of (key, metric, baseline value, value) for the
+    rates that dropped and the peak RSS that grew more than "tolerance" (a fraction)
+    """
+    regressions = []
+    for key, result in results.items():
+        base = (baseline or {}).get("results", {}).get(key)
+        if base is None:
+            continue
+        for metric in COMPARED:
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            if metric in RATES and new < old * (1 - tolerance):
+                regressions.append((key, metric, old, new))
+            elif metric not in RATES and new > old * (1 + tolerance):
+                regressions.append((key, metric, old, new))
+
+    return regressions
+
+
+def main():
+    """ Run the benchmarks and compare them with (or store them as) the baseline """
+    parser = argparse.ArgumentParser(description="Benchmark the Noark5 to RDF converter on synthetic input")
+    parser.add_argument("--cases", dest="cases", default=",".join(sorted(CASES)),
+                        help="Comma separated cases, of %s" % ", ".join(sorted(CASES)))
+    parser.add_argument("--sizes", dest="sizes", default="10MB",
+                        help="Comma separated input sizes, e.g. 1MB,100MB,10GB, the default is 10MB")
+    parser.add_argument("--modes", dest="modes", default="stream",
+                        help="Comma separated output modes, the default is stream")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1,
+                        help="Runs of every benchmark, the fastest counts")
+    parser.add_argument("-c", "--config", dest="configfile", default=DEFAULT_CONFIG,
+                        help="Config file to convert with, the default is noark5tordf/config/noark5.yaml")
+    parser.add_argument("--baseline", dest="baseline", default=BASELINE_FILE,
+                        help="Baseline file, the default is benchmark-baseline.json next to setup.py")
+    parser.add_argument("--save", dest="save", action="store_true",
+                        help="Store the results as the new baseline instead of comparing with it")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.25,
+                        help="How much worse than the baseline a result may be before it is a regression, the default is 0.25")
+    parser.add_argument("-o", "--output", dest="outputfile", default=None,
+                        help="Also write the results as JSON to this file")
+    parser.add_argument("--work-dir", dest="work_dir", default=None,
+                        help="Directory for the temporary input and output, the default is the system temp dir")
+
+    options = parser.parse_args()
+
+    import logging
+    logger = logging.getLogger("noark5tordf-benchmark")
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+    cases = [case for case in options.cases.split(",") if case]
+    unknown = [case for case in cases if case not in CASES]
+    if unknown:
+        parser.error("Unknown cases: %s" % ", ".join(unknown))
+
+    results = runSuite(cases, options.sizes.split(","), options.modes.split(","), options.repeat,
+                       options.configfile, options.work_dir, logger)
+
+    if options.outputfile:
+        with open(options.outputfile, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if options.save:
+        writeBaseline(results, options.baseline)
+        logger.info("Stored the baseline in %s" % options.baseline)
+        return 0
+
+    baseline = readBaseline(options.baseline)
+    if baseline is None:
+        logger.warning("No baseline in %s, store one with --save" % options.baseline)
+        return 0
+
+    regressions = compareBaseline(results, baseline, options.tolerance)
+    for key, metric, old, new in regressions:
+        logger.error("%s: %s %.2f -> %.2f" % (key, metric, old, new))
+    if not regressions:
+        logger.info("No regressions against the baseline")
+    return regressions and 1 or 0
+
+
+# Check if called from command line
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, json, mmap, hashlib, threading
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import *
+from .inputs import getInputBasename, splitMember
+
+# The properties of a dokumentobjekt that describe its document file
+FILE_PROPERTY = "referanseDokumentfil"
+CHECKSUM_PROPERTY = "sjekksum"
+ALGORITHM_PROPERTY = "sjekksumAlgoritme"
+SIZE_PROPERTY = "filstoerrelse"
+PROPERTIES = frozenset([FILE_PROPERTY, CHECKSUM_PROPERTY, ALGORITHM_PROPERTY, SIZE_PROPERTY])
+
+# Files up to this size are read into a buffer, larger ones are memory mapped
+BUFFER_SIZE = 1024 * 1024
+
+DEFAULT_MAX_DETAILS = 10000
+
+
+def getHashName(algorithm):
+    """ Get the hashlib name of a Noark5 checksum algorithm (e.g. "SHA-256" or "MD5"), or None if it is unknown """
+    name = algorithm.strip().lower().replace("-", "").replace("_", "")
+    if name in hashlib.algorithms_available:
+        return name
+    return None
+
+
+def hashFile(path, algorithm, buffer_size=BUFFER_SIZE):
+    """ Hash a file with a hashlib algorithm, returns the hex digest and the size of the file """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb", buffering=0) as infile:
+        size = os.fstat(infile.fileno()).st_size
+        if size > buffer_size:
+            # hashlib releases the GIL while it hashes the whole mapping, without copying it
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+        else:
+            digest.update(infile.read())
+    return digest.hexdigest(), size
+
+
+def checkFile(path, checksum=None, algorithm=None, size=None, buffer_size=BUFFER_SIZE):
+    """
+    Check a document file against its checksum and size (either may be None). Returns a list of
+    (kind, message) of the mismatches: "missing", "unreadable", "algorithm", "size" or "checksum"
+    """
+    name = None
+    if checksum is not None:
+        name = getHashName(algorithm)
+        if name is None:
+            return [("algorithm", "Unknown checksum algorithm '%s'" % algorithm)]
+
+    try:
+        if name is not None:
+            digest, actual_size = hashFile(path, name, buffer_size)
+        else:
+            digest, actual_size = None, os.path.getsize(path)
+    except FileNotFoundError:
+        return [("missing", "The file does not exist")]
+    except OSError as e:
+        return [("unreadable", "Can't read the file: %s" % e)]
+
+    mismatches = []
+    if size is not None:
+        try:
+            expected_size = int(size.strip())
+        except ValueError:
+            expected_size = None
+        if expected_size != actual_size:
+            mismatches.append(("size", "The file has %s bytes, not %s" % (actual_size, size)))
+
+    if digest is not None and digest != checksum.strip().lower():
+        mismatches.append(("checksum", "The %s checksum of the file is %s, not %s" % (algorithm, digest, checksum)))
+
+    return mismatches
+
+
+class ChecksumReport:
+    """
+    The document files checked by a ChecksumVerifier and their mismatches. Every mismatch is
+    counted, but only the first "max_details" are kept
+    """
+    def __init__(self, max_details=None):
+        self.files = 0
+        self.mismatches = 0
+        self.kinds = {}
+        self.details = []
+        self._max_details = DEFAULT_MAX_DETAILS if max_details is None else max_details
+
+    def add(self, file, path, mismatches):
+        self.files = self.files + 1
+        for kind, message in mismatches:
+            self.mismatches = self.mismatches + 1
+            self.kinds[kind] = self.kinds.get(kind, 0) + 1
+            if len(self.details) < self._max_details:
+                self.details.append({"file": file, "path": path, "kind": kind, "message": message})
+
+    def merge(self, other):
+        """ Add the counts and mismatches of another report, or of its asDict() """
+        if isinstance(other, ChecksumReport):
+            other = other.asDict()
+
+        self.files = self.files + other["files"]
+        self.mismatches = self.mismatches + other["mismatches"]
+        for kind, count in other["kinds"].items():
+            self.kinds[kind] = self.kinds.get(kind, 0) + count
+        self.details.extend(other["details"][:max(0, self._max_details - len(self.details))])
+
+    def asDict(self):
+        return {"files": self.files, "mismatches": self.mismatches, "kinds": dict(self.kinds),
+                "details": sorted(self.details, key=lambda detail: (detail["file"], detail["kind"])),
+                "truncated": len(self.details) < self.mismatches}
+
+    def write(self, filename, **info):
+        """ Write the report as JSON, "info" (e.g. the input) is added at the top """
+        report = dict(info)
+        report.update(self.asDict())
+        with open(filename, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2, ensure_ascii=False)
+        return filename
+
+
+def getDocumentDir(config, inputfile=None):
+    """ Get the dir the document files are relative to: "document_dir", or the dir of the input (or its archive) """
+    document_dir = config.get("document_dir")
+    if document_dir:
+        return os.path.abspath(document_dir)
+    if isinstance(inputfile, str):
+        return os.path.dirname(os.path.abspath(splitMember(inputfile)[0]))
+    return os.path.abspath(".")
+
+
+def getChecksumReportPath(config, inputfile=None):
+    """ Get the file the checksum report of a input is written to, relative to the output dir """
+    path = config.get("checksum_report")
+    if not path:
+        name = inputfile and getInputBasename(inputfile) or "output"
+        if name.endswith(".xml"):
+            name = name[:-4]
+        path = name + "-checksums.json"
+
+    if not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+class ChecksumVerifier:
+    """
+    Checks the document files of the dokumentobjekter ("checksum_element") of a conversion against
+    their sjekksum, sjekksumAlgoritme and filstoerrelse. The handler passes the properties and the
+    end of the elements to it, and the files are hashed by a pool of "checksum_workers" threads
+    while the conversion goes on. Only when more than "checksum_queue" files wait to be hashed
+    does the conversion wait for them. Files outside of the document dir are not read, they are
+    "outside" mismatches.
+    """
+    def __init__(self, config, inputfile=None, logger=None):
+        self._config = config
+        self._logger = logger
+        self.element = config.get("checksum_element") or "dokumentobjekt"
+        self.document_dir = getDocumentDir(config, inputfile)
+        self._root = os.path.realpath(self.document_dir)
+        self.report = ChecksumReport(config.get("checksum_max_details"))
+        self._algorithm = config.get("checksum_algorithm") or "SHA-256"
+        self._buffer_size = config.get("checksum_buffer_size") or BUFFER_SIZE
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = threading.BoundedSemaphore(config.get("checksum_queue") or 1000)
+        self._executor = ThreadPoolExecutor(max_workers=config.get("checksum_workers") or 4,
+                                            thread_name_prefix="noark5tordf-checksums")
+
+    def addProperty(self, entity, name, text):
+        """ Remember a property (its text, before value expressions) of a element that is checked """
+        if name in PROPERTIES and entity.getName() == self.element:
+            values = self._pending.get(entity)
+            if values is None:
+                values = self._pending[entity] = {}
+            values[name] = text
+
+    def _getPath(self, file):
+        """ Get the real path of a document file, or None if it is outside of the document dir (e.g. "../" or a symlink) """
+        path = os.path.realpath(os.path.join(self.document_dir, file))
+        if os.path.commonpath([self._root, path]) != self._root:
+            return None
+        return path
+
+    def finishEntity(self, entity):
+        """ Queue the check of the document file of a element that ended """
+        values = self._pending.pop(entity, None)
+        if values is None or not values.get(FILE_PROPERTY):
+            return
+
+        file = values[FILE_PROPERTY]
+        path = self._getPath(file)
+        # Some deliveries percent-encode the file names
+        if path is not None and not os.path.exists(path) and "%" in file:
+            unquoted = self._getPath(unquote(file))
+            if unquoted is not None and os.path.exists(unquoted):
+                path = unquoted
+
+        # The input is not trusted, only files in the document dir are read
+        if path is None:
+            with self._lock:
+                self.report.add(file, None, [("outside", "The file is outside of the document dir")])
+            return
+
+        checksum = values.get(CHECKSUM_PROPERTY)
+        algorithm = values.get(ALGORITHM_PROPERTY) or self._algorithm
+
+        self._queue.acquire()
+        future = self._executor.submit(checkFile, path, checksum, algorithm, values.get(SIZE_PROPERTY), self._buffer_size)
+        future.add_done_callback(lambda future: self._done(file, path, future))
+
+    def _done(self, file, path, future):
+        try:
+            try:
+                mismatches = future.result()
+            except Exception as e:
+                mismatches = [("unreadable", "Can't check the file: %s" % e)]
+            with self._lock:
+                self.report.add(file, path, mismatches)
+        finally:
+            self._queue.release()
+
+    def close(self):
+        """ Wait for the queued checks, returns the report """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pending = {}
+        return self.report
+
+
+class ChecksumSink:
+    """ Wraps the sink of a conversion whose document files are checked, the report is in "checksums" """
+    def __init__(self, sink, verifier):
+        self._sink = sink
+        self._verifier = verifier
+        self.checksums = verifier.report
+
+    def __getattr__(self, name):
+        # The counts, file names, metrics etc. of the wrapped sink
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._sink, name)
+
+    def openSubject(self, entity):
+        return self._sink.openSubject(entity)
+
+    def writeSubject(self, entity, data):
+        self._sink.writeSubject(entity, data)
+
+    def getFilenames(self):
+        return self._sink.getFilenames()
+
+    def getCounts(self):
+        """ Get the counts of the wrapped sink (if any) and the number of checksum mismatches """
+        counts = {}
+        if hasattr(self._sink, "getCounts"):
+            counts.update(self._sink.getCounts())
+        counts["checksum_mismatches"] = self.checksums.mismatches
+        return counts
+
+    def close(self):
+        self._verifier.close()
+        self._sink.close()
+
+
+def writeChecksumReport(config, report, inputfile=None, logger=None):
+    """ Write the checksum report of a input (or of a whole run) """
+    path = report.write(getChecksumReportPath(config, inputfile), input=inputfile)
+    if logger:
+        message = "Checked %s document files, found %s mismatches, see '%s'" % (report.files, report.mismatches, path)
+        if report.mismatches:
+            logger.warning(message)
+        else:
+            logger.info(message)
+    return path
@@ -4,9 +4,22 @@
 import os
 import yaml
 from .utils import *
+from .expressions import ConfigError
+from .rules import compileRules
+from .formats import DEFAULT_GRAPH, getOutputFormat
+from .rmil import RmilError
+from .validation import getValidator, getSchemaPaths
 
-def readConfig(configfile, output_dir=None, input_dir=None, backup_dir=None, interval=None, logfile=None, loglevel=None, env=None, logger=None):
-    """ Read a config file or return a default config """
+def readConfig(configfile, output_dir=None, input_dir=None, backup_dir=None, interval=None, logfile=None, loglevel=None, env=None, logger=None,
+               output_mode=None, output_file=None, shard_max_bytes=None, shard_max_triples=None, streaming=None,
+               utf8_output=None, parser=None, output_format=None, output_compression=None, graph=None,
+               manifest=None, stable_ids=None, store_path=None, store_backend=None, validation_schema=None,
+               validation_report=None, metrics=None, metrics_textfile=None, profile=None, subject_index=None,
+               id_index=None, verify_checksums=None, document_dir=None):
+    """
+    Read a config file or return a default config. Raises ConfigError if it contains invalid
+    expressions, output formats or validation schemas
+    """
     if not env:
         env = os.environ.copy()
 
@@ -29,6 +42,110 @@ def readConfig(configfile, output_dir=None, input_dir=None, backup_dir=None, int
         "ObjectElements" : {
         },
         "output_dir" : "",
+
+        # Used when watching a directory for input files: XML files are picked up from "input_dir"
+        # every "interval" seconds and moved to "backup_dir" when converted
+        "input_dir" : "input",
+        "backup_dir" : "backup",
+        "interval" : 5,
+
+        # How the RDF is written: "per-subject" (one .nt file per subject), "stream" (a single
+        # NTriples file, see "output_file") or "sharded" (rotating files, see "shard_max_bytes"
+        # and "shard_max_triples")
+        "output_mode" : "per-subject",
+        "output_file" : None,
+        "shard_max_bytes" : 256 * 1024 * 1024,
+        "shard_max_triples" : None,
+        "output_buffer_size" : 1024 * 1024,
+        "input_buffer_size" : 1024 * 1024,
+
+        # Write the triples of a subject as soon as its id is known (from a id attribute or the
+        # first id element), instead of keeping the whole subject in memory until it ends
+        "streaming" : False,
+
+        # Literals are written as ASCII with \uXXXX escapes by default, "utf8_output" writes
+        # them as UTF-8 (RDF 1.1 NTriples) instead
+        "utf8_output" : False,
+
+        # The XML parser: "expat", "lxml" (if installed), "sax" or "auto" for the fastest available
+        "parser" : "auto",
+
+        # The output format: "ntriples", "nquads" (with "graph" as the graph of every triple) or
+        # "binary" (dictionary encoded, see formats.py), and the compression: "none", "gzip" or
+        # "zstd" (if installed)
+        "output_format" : "ntriples",
+        "output_compression" : "none",
+        "compression_level" : None,
+        "graph" : DEFAULT_GRAPH,
+        "binary_max_terms" : 1000000,
+
+        # Incremental conversion: a SQLite database (relative to the output dir) of the subjects
+        # written by earlier runs and their hashes. Only new and changed subjects are written,
+        # and deleted ones are listed in "tombstone_file" (default deleted-subjects.txt)
+        "manifest" : None,
+        "tombstone_file" : None,
+
+        # Derive blank node labels and generated ids (randomID() in id expressions) from the parent
+        # subject, element path and content, so the same input always gives the same output
+        "stable_ids" : False,
+
+        # The "store" output mode loads the triples into a triple store instead of writing files:
+        # a SQLite quad store (the default "sqlite" backend) or a rdflib store plugin ("rdflib"
+        # backend, see "rdflib_store"). The triples go into "graph", "store_batch_size" at a time
+        "store_path" : "triples.db",
+        "store_backend" : "sqlite",
+        "rdflib_store" : "BerkeleyDB",
+        "store_batch_size" : 100000,
+
+        # Check the subjects against the constraints of one or more RMIL files while converting.
+        # The violations are written as JSON to "validation_report" (relative to the output dir,
+        # default "<input name>-validation.json"), with at most "validation_max_details" of them
+        # listed one by one
+        "validation_schema" : None,
+        "validation_report" : None,
+        "validation_max_details" : 10000,
+        # The schemas are compiled into a cache in this dir (default ~/.cache/noark5tordf),
+        # which is used while they don't change. False turns the cache off
+        "schema_cache_dir" : None,
+
+        # Record where the triples of every subject are written (file, byte offset and length) in a
+        # SQLite database, relative to the output dir. Needs ntriples output in a file
+        "subject_index" : None,
+
+        # Map the ids of subjects to their subject URIs in a SQLite database (relative to the
+        # output dir) that is kept between runs, and resolve the references to other subjects in
+        # the elements listed in "references" against it. The links are written to "reference_output"
+        # (default "<input name>-references.nt") and the dangling references to "reference_report"
+        # (default "<input name>-references.json"), at most "reference_max_details" of them
+        "id_index" : None,
+        "references" : [],
+        "reference_output" : None,
+        "reference_report" : None,
+        "reference_max_details" : 10000,
+
+        # Check the document files (referanseDokumentfil, relative to "document_dir" or the dir of
+        # the input) of the "checksum_element" elements against their sjekksum, sjekksumAlgoritme
+        # ("checksum_algorithm" if there is none) and filstoerrelse. The files are hashed by
+        # "checksum_workers" threads while converting, the conversion only waits when more than
+        # "checksum_queue" files are queued. The mismatches are written as JSON to "checksum_report"
+        # (default "<input name>-checksums.json"), at most "checksum_max_details" of them
+        "verify_checksums" : False,
+        "document_dir" : None,
+        "checksum_element" : "dokumentobjekt",
+        "checksum_algorithm" : "SHA-256",
+        "checksum_workers" : 4,
+        "checksum_queue" : 1000,
+        "checksum_report" : None,
+        "checksum_max_details" : 10000,
+
+        # Count the elements, objects, blank nodes, properties and triples and time the phases of
+        # the conversion and each element name. "metrics" is a JSON file (relative to the output
+        # dir, true for "<input name>-metrics.json") and "metrics_textfile" a file in the Prometheus
+        # text format. "profile" profiles the conversion with cProfile ("<input name>.prof" if true)
+        "metrics" : None,
+        "metrics_textfile" : None,
+        "profile" : None,
+
         "logfile" : logfile,
         "loglevel" : loglevel
     }
@@ -43,7 +160,7 @@ def readConfig(configfile, output_dir=None, input_dir=None, backup_dir=None, int
 
     if os.path.isfile(config_file):
         stream = open(config_file, 'r')
-        config = yaml.load(stream)
+        config = yaml.safe_load(stream)
         stream.close()
     else:
         config = {}
@@ -53,6 +170,9 @@ def readConfig(configfile, output_dir=None, input_dir=None, backup_dir=None, int
         
     default_config.update(config)
 
+    # Fail fast on broken expressions, rather than at the first element that uses them
+    compileRules(default_config)
+
     # Command line overrides config
     if output_dir:
         default_config["output_dir"] = output_dir
@@ -63,6 +183,93 @@ def readConfig(configfile, output_dir=None, input_dir=None, backup_dir=None, int
     if backup_dir:
         default_config["backup_dir"] = backup_dir
 
+    if output_mode:
+        default_config["output_mode"] = output_mode
+
+    if output_file:
+        default_config["output_file"] = output_file
+
+    if shard_max_bytes:
+        default_config["shard_max_bytes"] = shard_max_bytes
+
+    if shard_max_triples:
+        default_config["shard_max_triples"] = shard_max_triples
+
+    if streaming:
+        default_config["streaming"] = True
+
+    if utf8_output:
+        default_config["utf8_output"] = True
+
+    if parser:
+        default_config["parser"] = parser
+
+    if output_format:
+        default_config["output_format"] = output_format
+
+    if output_compression:
+        default_config["output_compression"] = output_compression
+
+    if graph:
+        default_config["graph"] = graph
+
+    if manifest:
+        default_config["manifest"] = manifest
+
+    if stable_ids:
+        default_config["stable_ids"] = True
+
+    if store_path:
+        default_config["store_path"] = store_path
+
+    if store_backend:
+        default_config["store_backend"] = store_backend
+
+    if validation_schema:
+        default_config["validation_schema"] = validation_schema
+
+    if validation_report:
+        default_config["validation_report"] = validation_report
+
+    if metrics:
+        default_config["metrics"] = metrics
+
+    if metrics_textfile:
+        default_config["metrics_textfile"] = metrics_textfile
+
+    if profile:
+        default_config["profile"] = profile
+
+    if subject_index:
+        default_config["subject_index"] = subject_index
+
+    if id_index:
+        default_config["id_index"] = id_index
+
+    if verify_checksums:
+        default_config["verify_checksums"] = True
+
+    if document_dir:
+        default_config["document_dir"] = document_dir
+
+    try:
+        getOutputFormat(default_config)
+    except ValueError as e:
+        raise ConfigError(str(e))
+
+    if default_config["subject_index"]:
+        if getOutputFormat(default_config)[0] != "ntriples":
+            raise ConfigError("The subject index needs ntriples output")
+        if default_config["output_mode"] == "store" or (default_config["output_mode"] == "stream" and default_config["output_file"] == "-"):
+            raise ConfigError("The subject index needs output files")
+
+    if default_config["validation_schema"]:
+        default_config["validation_schema"] = [os.path.abspath(path) for path in getSchemaPaths(default_config)]
+        try:
+            getValidator(default_config)
+        except (RmilError, OSError) as e:
+            raise ConfigError("Can't read the validation schema: %s" % e)
+
     if not os.path.isabs(default_config["output_dir"]):
         root_folder = getCurrDir()
         default_config["output_dir"] = os.path.join(root_folder, default_config["output_dir"])
@@ -1,36 +1,145 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import uuid, hashlib
+
 from .utils import *
+from .rules import compileRules
+
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+
+# Attributes are kept as a tuple of (uri, local name, qname, value) tuples
+NO_ATTRIBUTES = ()
+
+
+def compactAttributes(attributes):
+    """ Copy SAX attributes (or a dict of (uri, local name) -> value) into the compact tuple form """
+    if not attributes:
+        return NO_ATTRIBUTES
+
+    if isinstance(attributes, tuple):
+        return attributes
+
+    if hasattr(attributes, "getQNameByName"):
+        return tuple((uri, name, attributes.getQNameByName((uri, name)), value) for (uri, name), value in attributes.items())
+
+    return tuple((uri, name, name, value) for (uri, name), value in attributes.items())
+
+
+def _getType(name, attributes, rule):
+    """ Get the type of a element, from its name or a xsi:type attribute, overridable in the config """
+    for uri, attr, qname, value in attributes:
+        if attr == "type" and uri == XSI_NAMESPACE:
+            # Leave the decision to capitalize or not to the config if its overridden
+            return rule.table[value].type
+
+    return rule.type
+
+
+class Property:
+    """
+    A leaf element, i.e. a value of its parent entity. The XML handler replaces
+    entities without children by these, which are a lot smaller.
+    """
+    __slots__ = ["_name", "_namespace", "_value", "_attributes", "_rule"]
+
+    def __init__(self, name, namespace, value, attributes, rule):
+        self._name = name
+        self._namespace = namespace
+        self._value = value
+        self._attributes = attributes
+        self._rule = rule
+
+    def cleanUp(self):
+        pass
+
+    def getAttributes(self):
+        return self._attributes
+
+    def getName(self):
+        return self._name
+
+    def getRule(self):
+        return self._rule
+
+    def getValue(self):
+        return self._value
+
+    def getId(self):
+        return self._name
+
+    def isProperty(self):
+        return True
+
+    def isContainedObject(self):
+        return False
+
+    def isLiteral(self):
+        return self._rule.literal
+
+    def getDataType(self):
+        return self._rule.datatype
+
+    def getLanguage(self):
+        return self._rule.lang
+
+    def getTypePrefix(self):
+        return self._rule.getTypePrefix(self._namespace)
+
+    def getType(self):
+        return _getType(self._name, self._attributes, self._rule)
+
+    def getPredicate(self):
+        return self.getTypePrefix() + self.getType()
+
+    def __str__(self):
+        return "Property '%s'" % self._name
+
 
 class Entity:
     """ Class to encapsulate XML entities """
-    def __init__(self, name, attributes, config, parent=None, namespace=None, count_dict=None):
+    __slots__ = ["_name", "_attributes", "_entities", "_has_children", "_parent", "_id", "_subject", "_config",
+                 "_namespace", "_numbered_id", "_value", "_type", "_type_prefix", "_type_predicate", "_predicate",
+                 "_is_contained_object", "_bnode_prefix", "_rule", "_counter", "_writer", "_id_element", "_id_values",
+                 "_stable_id", "_stable_counts"]
+
+    def __init__(self, name, attributes, config, parent=None, namespace=None, count_dict=None, bnode_prefix="", rule=None):
         # Most of the properties are calculated only once and then
         # "frozen" so we can  GC things on the fly
         self._name = name
-        self._attributes = attributes
+        self._attributes = compactAttributes(attributes)
         self._entities = []
+        self._has_children = False
         self._parent = parent
         self._id = None
         self._subject = None
         self._config = config
         self._namespace = namespace
         self._numbered_id = None
-        self._str_rep = None
         self._value = None
         self._type = None
         self._type_prefix = None
         self._type_predicate = None
         self._predicate = None
         self._is_contained_object = None
+        self._bnode_prefix = bnode_prefix
+        self._counter = None
+        self._writer = None
+        self._id_element = None
+        self._id_values = None
+        self._stable_id = None
+        self._stable_counts = None
+
+        # The resolved config for elements with this name. The XML handler
+        # compiles the rules once per document and passes them in
+        if rule is None:
+            rule = compileRules(config)[name]
+        self._rule = rule
         
         if count_dict is not None:
             # Number the entity (for blank nodes)        
-            if not name in count_dict:
-                count_dict[name] = 0
-            count_dict[name] = count_dict[name] + 1
-            self._counter = count_dict[name]
+            self._counter = count_dict.get(name, 0) + 1
+            count_dict[name] = self._counter
 
         if parent is not None:
             parent.addEntity(self)
@@ -40,6 +149,8 @@ class Entity:
         self._entities = None
         self._attributes = None
         self._parent = None
+        self._id_values = None
+        self._stable_counts = None
         del self._entities
         del self._attributes
         
@@ -49,45 +160,108 @@ class Entity:
     def getName(self):
         return self._name
 
-    def isLiteral(self):
-        if "literal" in self._config["ObjectElements"].get(self._name, {}):
-            return self._config["ObjectElements"][self._name]["literal"]
+    def getRule(self):
+        return self._rule
 
-        return True       
+    def isLiteral(self):
+        return self._rule.literal
     
     def getDataType(self):
-        if self.isLiteral() and "datatype" in self._config["ObjectElements"].get(self._name, {}):
-            return self._config["ObjectElements"][self._name]["datatype"]
-
-        return None
+        return self._rule.datatype
 
     def getLanguage(self):
-        if self.isLiteral() and "lang" in self._config["ObjectElements"].get(self._name, {}):
-            return self._config["ObjectElements"][self._name]["lang"]
-
-        return None
+        return self._rule.lang
 
     def setValue(self, value):
         # Check for value expression       
-        if "value" in self._config["ObjectElements"].get(self._name, {}):
-            params = {"value": value, "context" : self, "config" : self._config}
-            exec(self._config["ObjectElements"][self._name]["value"], globals(), params)
-            self._value = params["result"]
+        if self._rule.value is not None:
+            self._value = self._rule.value.evaluate(value, self, self._config)
         else:
             self._value = value
 
+        if self._parent is not None and self._value is not None:
+            self._parent.setIdValue(self._name, self._value)
+
+    def setIdValue(self, name, value):
+        """ Remember the value of a property, if it is one of the id elements of this entity """
+        if name in self._rule.id_elements:
+            if self._id_values is None:
+                self._id_values = {}
+            # The last value wins
+            self._id_values[name] = value
+
     def getValue(self):
         return self._value
    
     def isProperty(self):
         return self._value is not None
 
+    def toProperty(self):
+        """ Get the (much smaller) Property representation of this entity, after its value is set """
+        return Property(self._name, self._namespace, self._value, self._attributes, self._rule)
+
     def getNumberedId(self):
         if self._numbered_id is None:
-            self._numbered_id = "%s-%s" % (self._name, self._counter)
+            self._numbered_id = "%s%s-%s" % (self._bnode_prefix, self._name, self._counter)
         
         return self._numbered_id
 
+    def getPath(self):
+        """ Get the names of the elements from the root to this one, separated by "/" """
+        names = []
+        entity = self
+        while entity is not None:
+            names.append(entity._name)
+            entity = entity._parent
+
+        names.reverse()
+        return "/".join(names)
+
+    def getContentHash(self):
+        """ Hash the name, attributes, properties and blank nodes (recursively) of this entity """
+        digest = hashlib.blake2b(repr((self._name, self._attributes)).encode("utf-8"), digest_size=16)
+
+        for entity in self._entities:
+            if entity.isProperty():
+                digest.update(repr((entity.getName(), entity.getValue(), entity.getAttributes())).encode("utf-8"))
+            else:
+                digest.update(entity.getContentHash())
+
+        return digest.digest()
+
+    def _countStableChild(self, content):
+        """ Count the children with the same content, so they get different stable ids """
+        if self._stable_counts is None:
+            self._stable_counts = {}
+
+        count = self._stable_counts.get(content, 0)
+        self._stable_counts[content] = count + 1
+        return count
+
+    def getStableId(self):
+        """
+        Get a hash (16 bytes) of the subject of the parent, the element path and the content of
+        this entity. Unlike numbered and random ids it is the same every time the same input is
+        converted, also in parallel. Children with the same content are told apart by position.
+        """
+        if self._stable_id is not None:
+            return self._stable_id
+
+        content = self.getContentHash()
+        parent_subject = ""
+        count = 0
+        if self._parent is not None:
+            parent_subject = self._parent.getSubject()
+            count = self._parent._countStableChild(content)
+
+        key = "%s\n%s\n%s\n" % (parent_subject, self.getPath(), count)
+        self._stable_id = hashlib.blake2b(key.encode("utf-8") + content, digest_size=16).digest()
+        return self._stable_id
+
+    def getStableUuid(self):
+        """ Get the stable id (see getStableId) as a UUID, for id expressions that generate ids """
+        return str(uuid.UUID(bytes=self.getStableId(), version=5))
+
     def getId(self):
         """
         Figure out the ID that this entity has and "freeze" it. ID-less entities are
@@ -103,36 +277,30 @@ class Entity:
         else:
             # Check if the id is an expression
             
+            rule = self._rule
+
             # A blank node is either it's explicitly stated with a "id" config property set to None...
-            if "id" in self._config["ObjectElements"].get(self._name, {}) and  self._config["ObjectElements"][self._name]["id"] is None:
+            if rule.is_blank:
                 return None
             
             # ..or explicitly using a "id-expression" python expression
             
-            if "id-expression" in self._config["ObjectElements"].get(self._name, {}):
-                params = {"context" : self, "config" : self._config}
-                exec(self._config["ObjectElements"][self._name]["id-expression"], globals(), params)
-                self._id = params["result"]
+            if rule.id_expression is not None:
+                self._id = rule.id_expression.evaluate(context=self, config=self._config)
                 return self._id
  
             # ..or implicitly if none of the config given or global ids match any of its properties or attributes       
-            ids = self._config["ObjectElements"].get(self._name,{}).get("id", [])
-            if not is_sequence(ids):
-                ids = [ids]
-            
-            ids = list(tuple(ids + self._config.get("ids", [])))
-            
-            for id_element in ids:
+            for id_attribute, id_element in rule.ids:
                 # Attribute ID?
-                if id_element[0] == "@":                
-                    if id_element[1:] in self._attributes.getQNames():
-                        self._id = self._attributes.getValueByQName(id_element[1:])
+                if id_attribute is not None:
+                    values = [value for uri, attr, qname, value in self._attributes if qname == id_attribute]
+                    if len(values) > 0:
+                        self._id = values[0]
                         break
                 else:
                     # Normal element value
-                    props = [prop for prop in self.getProperties() if prop.getName() == id_element]
-                    if len(props) > 0:
-                        self._id =  props[-1].getValue()
+                    if self._id_values is not None and id_element in self._id_values:
+                        self._id = self._id_values[id_element]
                         break
 
         return self._id
@@ -154,16 +322,35 @@ class Entity:
 
         # Blank nodes are treated as a special case
         if id is None:
-            self._subject = "_:%s" % self.getNumberedId()
+            if self._rule.stable_ids:
+                self._subject = "_:%s-%s" % (self._name, self.getStableId().hex()[:20])
+            else:
+                self._subject = "_:%s" % self.getNumberedId()
         else:
             # Get subject prefix for element, or the global one if none is configured
-            self._subject = "<" + self._config["ObjectElements"].get(self._name, {}).get("subject_prefix", self._config["subject_prefix"]) + id + ">"
+            self._subject = "<" + self._rule.subject_prefix + id + ">"
 
         return self._subject
         
     def addEntity(self, entity):
         """ Add a contained entity """
         self._entities.append(entity)
+        self._has_children = True
+
+    def replaceEntity(self, entity, replacement):
+        """ Replace a contained entity (usually the last one), or remove it if "replacement" is None """
+        index = len(self._entities) - 1
+        if self._entities[index] is not entity:
+            index = self._entities.index(entity)
+
+        if replacement is None:
+            del self._entities[index]
+        else:
+            self._entities[index] = replacement
+
+    def hasChildren(self):
+        """ Checks if any elements were ever added to this entity (also if they were removed later) """
+        return self._has_children
     
     def getEntities(self):
         return self._entities
@@ -178,18 +365,13 @@ class Entity:
 
     def __str__(self):
         """ Return a string representation of this entity """
-        if self._str_rep is None:
-            self._str_rep = "Entity '%s' (id: %s)" % (self._name, self.getId() or self.getNumberedId())
-
-        return self._str_rep
+        return "Entity '%s' (id: %s)" % (self._name, self.getId() or self.getNumberedId())
     
     def getTypePrefix(self):
         if self._type_prefix is not None:
             return self._type_prefix
         
-        self._type_prefix = self._config["ObjectElements"].get(self._name, {}).get("type_prefix") or self._namespace or self._config["type_prefix"]
-        if self._type_prefix[-1] != "/":
-            self._type_prefix = self._type_prefix + "/"
+        self._type_prefix = self._rule.getTypePrefix(self._namespace)
 
         return self._type_prefix
 
@@ -201,19 +383,8 @@ class Entity:
         if self._type is not None:
             return self._type
 
-        # Deault type postfix is capitalized element name
-        etype = self._name
-        
-        # Is there xsi:type in the attributes?
-        if ('http://www.w3.org/2001/XMLSchema-instance', 'type') in self._attributes.keys():
-            etype = self._attributes[('http://www.w3.org/2001/XMLSchema-instance', 'type')]
-
-        # Check for override in config
-        if etype in self._config["ObjectElements"].keys():
-            # Leave the decision to capitalize or not to the config if its overridden
-            etype = self._config["ObjectElements"][etype].get("type", etype)
-        
-        self._type = etype
+        # Deault type postfix is capitalized element name, unless there is a xsi:type attribute
+        self._type = _getType(self._name, self._attributes, self._rule)
         return self._type
     
     def getTypePredicate(self):
@@ -237,68 +408,150 @@ class Entity:
         
         return self._predicate
         
-    def generateNTriples(self):
-        """
-        Serialize the properties and entities of this entity as RDF NTriples.
-        If "recurse" is True, it will traverse the three and serialize all nodes
-        """
-
-        subject = self.getSubject()
-        s = ""
-
-        s = s + "%s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <%s>.\n" % (subject, self.getTypePredicate())
+    def _writeHeader(self, write, subject):
+        """ Serialize the type and attributes of this entity """
+        escape = self._rule.escape
+        write("%s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <%s>.\n" % (subject, self.getTypePredicate()))
 
         # Treat attributes as string literals
         # TODO: what about language and datatype for these?
-        for uri, attr in self._attributes.keys():
+        for uri, attr, qname, value in self._attributes:
             if uri:
                 predicate = uri + "/" + attr
             else:
                 predicate = self._config["type_prefix"] + attr
 
-            s = s + '%s <%s> "%s".\n' % (subject, predicate, escape_literal(self._attributes[(uri, attr)]))
-        
-        # We link to our parent (if we're not a blank node)
+            write('%s <%s> "%s".\n' % (subject, predicate, escape(value)))
+
+    def _writeParentLink(self, write, subject):
+        """ We link to our parent (if we're not a blank node) """
         if not self.isContainedObject() and self.getParent() is not None:
-            s = s + '%s <%s> %s.\n' % (subject, self.getParent().getPredicate(), self.getParent().getSubject())
+            write('%s <%s> %s.\n' % (subject, self.getParent().getPredicate(), self.getParent().getSubject()))
 
-        # Serialize properties and add links to blank nodes
-        for entity in self._entities:
-            if entity.isProperty():
-                if entity.isLiteral():
-                    lang = entity.getLanguage()
-                    
-                    # According to the spec, you can't have both lang and type on a literal (string is implied if lang is set)
-                    if lang is None or lang == "":
-                        postfix = self.getDataType()
-                        postfix = postfix and "^^<http://www.w3.org/2001/XMLSchema#>" + postfix or ""
-                    else:
-                        postfix = "@" + lang
-                    
-                    s = s + '%s <%s> "%s"%s.\n' % (subject, entity.getPredicate(), escape_literal(entity.getValue()), postfix)
+    def _writeChild(self, write, subject, entity):
+        """ Serialize a property, or a link to a blank node and the blank node tree itself """
+        if entity.isProperty():
+            escape = self._rule.escape
+
+            if entity.isLiteral():
+                lang = entity.getLanguage()
+                
+                # According to the spec, you can't have both lang and type on a literal (string is implied if lang is set)
+                if lang is None or lang == "":
+                    postfix = self.getDataType()
+                    postfix = postfix and "^^<http://www.w3.org/2001/XMLSchema#>" + postfix or ""
                 else:
-                    s = s + '%s <%s> <%s>.\n' % (subject, entity.getPredicate(), escape_literal(entity.getValue()))
-
-                # Entities with attributes are expanded to seperate literals
-                # TODO: what about language and datatype for these?
-                try:
-                    prop_attrs = entity.getAttributes()
-                except:
-                    import pdb;pdb.set_trace()
-                for uri, pred_id in prop_attrs.keys():
-                    s = s + '%s <%s> "%s".\n' % (subject, entity.getPredicate() + "-" + pred_id, escape_literal(prop_attrs[(uri, pred_id)]))
-
-                # Properties and blank node hierarchies can be disposed of after serialization
-                entity.cleanUp()
-                    
-            elif entity.isContainedObject():
-                # All parents link *to* their blank nodes
-                s = s + '%s <%s> %s.\n' % (subject, entity.getPredicate(), entity.getSubject())
+                    postfix = "@" + lang
+                
+                write('%s <%s> "%s"%s.\n' % (subject, entity.getPredicate(), escape(entity.getValue()), postfix))
+            else:
+                write('%s <%s> <%s>.\n' % (subject, entity.getPredicate(), escape(entity.getValue())))
+
+            # Entities with attributes are expanded to seperate literals
+            # TODO: what about language and datatype for these?
+            for uri, pred_id, qname, value in entity.getAttributes():
+                write('%s <%s> "%s".\n' % (subject, entity.getPredicate() + "-" + pred_id, escape(value)))
+
+            # Properties and blank node hierarchies can be disposed of after serialization
+            entity.cleanUp()
                 
-                # Serialize the blank node tree within its parent
-                s = s + entity.generateNTriples()
+        elif entity.isContainedObject():
+            # All parents link *to* their blank nodes
+            write('%s <%s> %s.\n' % (subject, entity.getPredicate(), entity.getSubject()))
             
-                # Properties and blank node hierarchies can be disposed of after serialization
-                entity.cleanUp()
+            # Serialize the blank node tree within its parent
+            entity.writeNTriples(write)
+        
+            # Properties and blank node hierarchies can be disposed of after serialization
+            entity.cleanUp()
+
+    def writeNTriples(self, write):
+        """
+        Serialize the properties and entities of this entity as RDF NTriples, by calling
+        "write" (e.g. the write() of a file or the append() of a list) with each triple.
+        Blank nodes are serialized within their parent.
+        """
+        subject = self.getSubject()
+        self._writeHeader(write, subject)
+        self._writeParentLink(write, subject)
+
+        # Serialize properties and add links to blank nodes
+        for entity in self._entities:
+            self._writeChild(write, subject, entity)
+
+    def generateNTriples(self):
+        """ Serialize this entity as RDF NTriples, see writeNTriples """
+        parts = []
+        self.writeNTriples(parts.append)
+        return "".join(parts)
+
+    def getEarlyId(self):
+        """
+        Check if the id of this entity can be decided before all its children are seen.
+        Returns (id, None) if it is given by a attribute, (None, element name) if it will be given
+        by a (not yet seen) child element, or (None, None) if it can't be decided early.
+        """
+        rule = self._rule
+        if rule.is_blank or rule.id_expression is not None or self._id is not None:
+            return None, None
+
+        for id_attribute, id_element in rule.ids:
+            if id_attribute is None:
+                return None, id_element
+
+            for uri, attr, qname, value in self._attributes:
+                if qname == id_attribute:
+                    return value, None
+
+        return None, None
+
+    def awaitId(self, name):
+        """ Let the first child element "name" decide the id of this entity (see getEarlyId) """
+        self._id_element = name
+
+    def awaitsId(self, name):
+        """ Checks if the child element "name" decides the id of this entity """
+        # Once the subject is used (by a child linking to us) it can't change anymore
+        return self._id_element == name and self._subject is None and self._is_contained_object is None
+
+    def setId(self, id):
+        self._id = id
+        self._id_element = None
+
+    def isStreaming(self):
+        return self._writer is not None
+
+    def getWriter(self):
+        return self._writer
+
+    def startStreaming(self, writer):
+        """
+        Start writing the triples of this entity to "writer" as they become known, instead of keeping
+        them until the entity ends. The children seen so far are written right away.
+        A blank node streams into the writer of its parent.
+        """
+        self._writer = writer
+        self._id_element = None
+        subject = self.getSubject()
+
+        if self.isContainedObject() and self._parent is not None:
+            writer.write('%s <%s> %s.\n' % (self._parent.getSubject(), self.getPredicate(), subject))
+
+        self._writeHeader(writer.write, subject)
+
+        for entity in self._entities:
+            self._writeChild(writer.write, subject, entity)
+
+        self._entities = []
+
+    def writeChild(self, entity):
+        """ Write a finished property or blank node of a streaming entity """
+        self._writeChild(self._writer.write, self.getSubject(), entity)
+
+    def finishStreaming(self):
+        """ Write what is left of a streaming entity, and close its writer unless it's a blank node """
+        if not self.isContainedObject():
+            self._writeParentLink(self._writer.write, self.getSubject())
+            self._writer.close()
 
-        return s
+        self._writer = None
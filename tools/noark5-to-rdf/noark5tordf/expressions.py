@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+from .utils import *
+
+# The config keys of ObjectElements that hold python expressions
+EXPRESSION_KEYS = ["value", "id-expression"]
+
+_prefix_pattern = re.compile(r"""^result\s*=\s*config\[\s*(["'])(\w+)\1\s*\]\s*\+\s*value$""")
+_random_id_pattern = re.compile(r"""^result\s*=\s*randomID\(\s*\)$""")
+
+
+class ConfigError(Exception):
+    """ Raised when the config contains something that can't be used """
+    pass
+
+
+class Expression:
+    """
+    A "value" or "id-expression" from the ObjectElements config, compiled once. The expression
+    is python code that must set "result". It can use "value" (the text of the element, for "value"
+    expressions), "context" (the Entity) and "config", as well as everything in utils.
+    """
+    def __init__(self, source, name):
+        self.source = source
+        self.name = name
+
+        try:
+            self._code = compile(source, "<ObjectElements %s>" % name, "exec")
+        except SyntaxError as e:
+            raise ConfigError("Syntax error in expression %s: %s" % (name, e))
+
+        if "result" not in self._code.co_names:
+            raise ConfigError("Expression %s never sets 'result'" % name)
+
+    def evaluate(self, value=None, context=None, config=None):
+        params = {"value": value, "context" : context, "config" : config}
+        if context is not None and context.getRule().stable_ids:
+            # Generated ids are derived from the element instead (see Entity.getStableId)
+            params["randomID"] = context.getStableUuid
+        exec(self._code, globals(), params)
+        return params["result"]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.source)
+
+
+class PrefixExpression(Expression):
+    """ Fast path for 'result = config["some_prefix"] + value' """
+    def __init__(self, source, name, key):
+        Expression.__init__(self, source, name)
+        self.key = key
+
+    def evaluate(self, value=None, context=None, config=None):
+        return config[self.key] + value
+
+
+class RandomIdExpression(Expression):
+    """ Fast path for 'result = randomID()' """
+    def evaluate(self, value=None, context=None, config=None):
+        if context is not None and context.getRule().stable_ids:
+            return context.getStableUuid()
+        return randomID()
+
+
+def compileExpression(source, name):
+    """ Compile a expression, using a fast path that skips exec() for the common patterns """
+    stripped = source.strip()
+
+    match = _prefix_pattern.match(stripped)
+    if match:
+        return PrefixExpression(source, name, match.group(2))
+
+    if _random_id_pattern.match(stripped):
+        return RandomIdExpression(source, name)
+
+    return Expression(source, name)
+
+
+def compileExpressions(config):
+    """
+    Compile all expressions in the ObjectElements of the config. Returns a dict of
+    element name -> {config key -> Expression}. Raises ConfigError for invalid expressions.
+    """
+    expressions = {}
+
+    for element, element_config in (config.get("ObjectElements") or {}).items():
+        for key in EXPRESSION_KEYS:
+            source = (element_config or {}).get(key)
+            if source is None:
+                continue
+
+            if not isinstance(source, str):
+                raise ConfigError("Expression %s.%s must be a string" % (element, key))
+
+            expressions.setdefault(element, {})[key] = compileExpression(source, "%s.%s" % (element, key))
+
+    return expressions
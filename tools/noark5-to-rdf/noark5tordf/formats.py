@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io, re, sys, gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .utils import *
+
+OUTPUT_FORMATS = ["ntriples", "nquads", "binary"]
+OUTPUT_COMPRESSIONS = ["none", "gzip", "zstd"]
+
+FORMAT_EXTENSIONS = {"ntriples" : ".nt", "nquads" : ".nq", "binary" : ".n5b"}
+COMPRESSION_EXTENSIONS = {"none" : "", "gzip" : ".gz", "zstd" : ".zst"}
+
+DEFAULT_GRAPH = "http://data.bouvet.no/sesam/noark5-input"
+
+# The binary triple format: a header, followed by records that start with a tag byte.
+# A TERM record defines the next term id (counting from 0 after each header or RESET) as
+# a varint length and the UTF-8 bytes of the term in NTriples syntax ("<iri>", "_:label",
+# '"literal"@lang'...). A TRIPLE record is three varint term ids. The writer starts over
+# with a RESET when the dictionary gets too big, so memory use is bounded. Files can be
+# concatenated, a header in the middle of a file also starts over.
+BINARY_MAGIC = b"N5TB\x01"
+TAG_TERM = 1
+TAG_TRIPLE = 2
+TAG_RESET = 3
+
+_triple_pattern = re.compile(r'^(<[^>]*>|_:\S+) (<[^>]*>) (.*)\.$')
+
+
+def getOutputFormat(config):
+    """ Get the output format and compression of the config, checking that they can be used """
+    output_format = config.get("output_format") or "ntriples"
+    compression = config.get("output_compression") or "none"
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format '%s', must be one of %s" % (output_format, ", ".join(OUTPUT_FORMATS)))
+
+    if compression not in OUTPUT_COMPRESSIONS:
+        raise ValueError("Unknown output compression '%s', must be one of %s" % (compression, ", ".join(OUTPUT_COMPRESSIONS)))
+
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package, which is not installed")
+
+    return output_format, compression
+
+
+def getOutputExtension(config):
+    """ Get the file extension of the output format, e.g. ".nt" or ".nq.gz" """
+    output_format, compression = getOutputFormat(config)
+    return FORMAT_EXTENSIONS[output_format] + COMPRESSION_EXTENSIONS[compression]
+
+
+def stripOutputExtension(filename):
+    """ Remove a output file extension (of any format) from "filename" """
+    for compression in COMPRESSION_EXTENSIONS.values():
+        for extension in FORMAT_EXTENSIONS.values():
+            if filename.endswith(extension + compression):
+                return filename[:-len(extension + compression)]
+
+    return filename
+
+
+def _writeVarint(parts, value):
+    while value > 0x7F:
+        parts.append(0x80 | (value & 0x7F))
+        value = value >> 7
+    parts.append(value)
+
+
+def splitTriples(data):
+    """ Split whole lines of NTriples (as written by the sinks) into (subject, predicate, object) tuples of terms """
+    lines = data.split("\n")
+    # Only "\n" ends a line, literals in UTF-8 output may have U+2028 and U+0085 unescaped
+    if lines[-1] == "":
+        lines.pop()
+
+    triples = []
+    for line in lines:
+        match = _triple_pattern.match(line)
+        if match is None:
+            raise ValueError("Not a NTriples line: %r" % line)
+        triples.append(match.groups())
+
+    return triples
+
+
+class BinaryTripleWriter:
+    """ Encodes NTriples (as written by the sinks, whole lines) into the binary triple format """
+    def __init__(self, output, max_terms=None):
+        self._output = output
+        self._max_terms = max(max_terms or 1000000, 3)
+        self._terms = {}
+        output.write(BINARY_MAGIC)
+
+    def _termId(self, term, parts):
+        try:
+            return self._terms[term]
+        except KeyError:
+            pass
+
+        encoded = term.encode("utf-8")
+        parts.append(TAG_TERM)
+        _writeVarint(parts, len(encoded))
+        parts.extend(encoded)
+
+        id = self._terms[term] = len(self._terms)
+        return id
+
+    def write(self, data):
+        parts = bytearray()
+        for triple in splitTriples(data):
+            # Start over between triples, so the ids of a triple are from the same dictionary
+            if len(self._terms) + 3 > self._max_terms:
+                parts.append(TAG_RESET)
+                self._terms = {}
+
+            ids = [self._termId(term, parts) for term in triple]
+            parts.append(TAG_TRIPLE)
+            for id in ids:
+                _writeVarint(parts, id)
+
+        self._output.write(parts)
+
+    def flush(self):
+        self._output.flush()
+
+    def close(self):
+        self._output.close()
+
+
+class _NQuadsWriter:
+    """ Adds the graph to each triple written as NTriples """
+    def __init__(self, output, graph):
+        self._output = output
+        self._suffix = " <%s>.\n" % graph
+
+    def write(self, data):
+        # Newlines in literals are escaped, so every newline ends a triple
+        self._output.write(data.replace(".\n", self._suffix))
+
+    def flush(self):
+        self._output.flush()
+
+    def close(self):
+        self._output.close()
+
+
+class _Unclosed:
+    """ A stream that is only flushed when closed (for stdout) """
+    def __init__(self, output):
+        self._output = output
+
+    def write(self, data):
+        return self._output.write(data)
+
+    def flush(self):
+        self._output.flush()
+
+    def close(self):
+        self._output.flush()
+
+
+class _ClosingStream(io.RawIOBase):
+    """ A writable stream that also closes the stream it writes through """
+    def __init__(self, output, underlying):
+        self._output = output
+        self._underlying = underlying
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._output.write(data)
+
+    def flush(self):
+        self._output.flush()
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            io.RawIOBase.close(self)
+            self._output.close()
+        finally:
+            self._underlying.close()
+
+
+def openOutput(filename, config, buffer_size=None):
+    """
+    Open a output file (or stdout for "-") for writing NTriples to, in the output format and
+    compression of the config. The returned object has write() (taking whole lines of
+    NTriples as a string), flush() and close().
+    """
+    output_format, compression = getOutputFormat(config)
+    buffer_size = buffer_size or -1
+
+    if filename == "-":
+        if output_format != "binary" and compression == "none":
+            output = _Unclosed(sys.stdout)
+        else:
+            output = _Unclosed(sys.stdout.buffer)
+    elif compression == "none" and output_format != "binary":
+        output = open(filename, "w", buffering=buffer_size, encoding="utf-8")
+    else:
+        output = open(filename, "wb", buffering=buffer_size)
+
+    if compression == "gzip":
+        output = gzip.GzipFile(fileobj=output, mode="wb", compresslevel=config.get("compression_level") or 6)
+        output = _ClosingStream(output, output.fileobj)
+    elif compression == "zstd":
+        output = zstandard.ZstdCompressor(level=config.get("compression_level") or 3).stream_writer(output)
+
+    if output_format == "binary":
+        return BinaryTripleWriter(output, config.get("binary_max_terms"))
+
+    if compression != "none":
+        output = io.TextIOWrapper(output, encoding="utf-8", write_through=True)
+
+    if output_format == "nquads":
+        return _NQuadsWriter(output, config.get("graph") or DEFAULT_GRAPH)
+
+    return output
+
+
+def _readVarint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos = pos + 1
+        value = value | ((byte & 0x7F) << shift)
+        if byte < 0x80:
+            return value, pos
+        shift = shift + 7
+
+
+class BinaryTripleReader:
+    """
+    Reads the binary triple format. Iterating gives (subject, predicate, object) tuples of
+    term ids, which are indexes into "terms" (the terms in NTriples syntax). The ids are only
+    valid until the dictionary starts over, so use the terms right away or iterate over
+    triples() to get the terms themselves.
+    """
+    def __init__(self, infile):
+        self._infile = infile
+        self.terms = []
+
+    def _records(self):
+        # The files are read in chunks, a record is never longer than a term
+        data = b""
+        pos = 0
+        eof = False
+        while True:
+            if not eof and len(data) - pos < 65536:
+                chunk = self._infile.read(1024 * 1024)
+                eof = not chunk
+                data = data[pos:] + chunk
+                pos = 0
+
+            if pos >= len(data):
+                return
+
+            if data.startswith(BINARY_MAGIC, pos):
+                self.terms = []
+                pos = pos + len(BINARY_MAGIC)
+                continue
+
+            tag = data[pos]
+            if tag == TAG_TERM:
+                length, start = _readVarint(data, pos + 1)
+                while start + length > len(data) and not eof:
+                    chunk = self._infile.read(max(1024 * 1024, length))
+                    eof = not chunk
+                    data = data + chunk
+                self.terms.append(data[start:start + length].decode("utf-8"))
+                pos = start + length
+            elif tag == TAG_TRIPLE:
+                subject, pos = _readVarint(data, pos + 1)
+                predicate, pos = _readVarint(data, pos)
+                object, pos = _readVarint(data, pos)
+                yield subject, predicate, object
+            elif tag == TAG_RESET:
+                self.terms = []
+                pos = pos + 1
+            else:
+                raise ValueError("Not a binary triple file, unknown record %r" % tag)
+
+    def __iter__(self):
+        return self._records()
+
+    def triples(self):
+        """ Iterate over the triples as (subject, predicate, object) tuples of terms """
+        for subject, predicate, object in self._records():
+            terms = self.terms
+            yield terms[subject], terms[predicate], terms[object]
+
+
+def openBinaryTriples(path):
+    """ Open a binary triple file (optionally .gz or .zst compressed) as a BinaryTripleReader """
+    if path.endswith(".gz"):
+        infile = gzip.open(path, "rb")
+    elif path.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError("Reading '%s' needs the zstandard package, which is not installed" % path)
+        infile = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    else:
+        infile = open(path, "rb")
+
+    return BinaryTripleReader(infile)
+
+
+def binaryToNTriples(path, output):
+    """ Write the triples of a binary triple file to "output" (a text stream) as NTriples """
+    reader = openBinaryTriples(path)
+    try:
+        for subject, predicate, object in reader.triples():
+            output.write("%s %s %s.\n" % (subject, predicate, object))
+    finally:
+        reader._infile.close()
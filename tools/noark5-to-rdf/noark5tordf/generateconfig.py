@@ -4,84 +4,517 @@
 # Generate config for the XML to RDF Converter
 # Author: Tom Bech, tom.bech@sesam.io
 
-import sys, os, errno, shutil, glob, argparse, logging, time
-import xml.sax
+import sys, os, re, json, argparse, logging, time, traceback
+from concurrent.futures import ProcessPoolExecutor
 import yaml
 
+from .utils import *
+from .elements import compactAttributes
+from .parsers import getParser
+from .inputs import openInput
+from .validation import DATATYPE_PATTERNS
+from .batch import expandInputs
 
-class Entity:
-    """ Class to encapsulate XML entities """
-    def __init__(self, name, attrs, parent=None):
-        self._name = name
-        self._attrs = attrs
-        self._parent = parent
-        self._entities = []
-        if parent is not None:
-            parent.addEntity(self)
+# Distinct values kept per element name (and attribute), and values kept per element name and
+# child to find unique ids. Beyond that a profile only knows "at least this many", so memory
+# doesn't grow with the size of the input
+MAX_VALUES = 1000
+MAX_ID_VALUES = 100000
 
-    def getAttrs(self):
-        return self._attrs
-    
-    def getName(self):
-        return self._name
+# Values listed in the comments of the generated config, for vocabulary-like elements
+MAX_LISTED_VALUES = 10
 
-    def addEntity(self, entity):
-        """ Add a contained entity """
-        self._entities.append(entity)
-    
-    def getEntities(self):
-        return self._entities
+# The datatypes that are inferred, the first one that all values match wins
+DATATYPES = [("integer", DATATYPE_PATTERNS["integer"]), ("decimal", DATATYPE_PATTERNS["decimal"]),
+             ("boolean", DATATYPE_PATTERNS["boolean"]), ("date", DATATYPE_PATTERNS["date"]), ("dateTime", DATATYPE_PATTERNS["datetime"]),
+             ("anyURI", re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*://\S+$"))]
+_datatype_patterns = dict(DATATYPES)
+_id_name_pattern = re.compile(r"id$", re.IGNORECASE)
+_all_datatypes = tuple(name for name, pattern in DATATYPES)
 
 
-class ConfigXmlHandler(xml.sax.ContentHandler):
+class ValueProfile:
+    """ The values of a element name (its text) or of a attribute """
+    __slots__ = ["count", "empty", "values", "capped", "datatypes"]
+
+    def __init__(self):
+        self.count = 0
+        self.empty = 0
+        self.values = set()
+        self.capped = False
+        # The datatypes all values so far match
+        self.datatypes = _all_datatypes
+
+    def add(self, value, max_values=MAX_VALUES):
+        self.count = self.count + 1
+        value = value.strip()
+        if not value:
+            self.empty = self.empty + 1
+            return
+
+        if self.datatypes:
+            self.datatypes = tuple(name for name in self.datatypes if _datatype_patterns[name].match(value))
+
+        if not self.capped and value not in self.values:
+            if len(self.values) < max_values:
+                self.values.add(value)
+            else:
+                self.capped = True
+
+    def merge(self, other, max_values=MAX_VALUES):
+        self.count = self.count + other.count
+        self.empty = self.empty + other.empty
+        self.datatypes = tuple(name for name in self.datatypes if name in other.datatypes)
+        self.capped = self.capped or other.capped
+        for value in other.values:
+            if len(self.values) >= max_values:
+                self.capped = True
+                break
+            self.values.add(value)
+
+    def getDatatype(self):
+        """ Get the inferred datatype, "string" if the values match none of the others """
+        if self.count == self.empty:
+            return "string"
+        return self.datatypes and self.datatypes[0] or "string"
+
+    def getDistinct(self):
+        """ The number of distinct values, and if there are more than that """
+        return len(self.values), self.capped
+
+    def asDict(self):
+        distinct, capped = self.getDistinct()
+        result = {"count": self.count, "empty": self.empty, "distinct": distinct, "more": capped,
+                  "datatype": self.getDatatype()}
+        if distinct <= MAX_LISTED_VALUES and not capped:
+            result["values"] = sorted(self.values)
+        return result
+
+
+class ElementProfile:
     """
-    SAX content handler class that can traverse a XML file
-    and output a template for a XML to RDF config file
+    What is known about the elements of one name: how often they occur, their parents, how many
+    of each child they have (with, total, min and max per element), their attributes and values,
+    and which children and attributes have had a unique value in every element so far
     """
-    def __init__(self, outputfile, logger=None):
-        self.root = None
-        self.currentEntity = []
-        self.outputfile = outputfile
-        self.logger = logger
-        self.entities = {}
-
-    def startElement(self, name, attrs):
-        parent = len(self.currentEntity) > 0 and self.currentEntity[0] or None
-        entity = Entity(name, attrs, parent)
-        if parent is None:
-            # This entity is the root
-            self.root = entity
-        self.currentEntity.insert(0, entity)
- 
-    def endElement(self, name):
-        entity = self.currentEntity[0]
-        
-        if not name in self.entities and len(entity.getEntities()) > 0:
-            self.entities[name] = {"id" : None}
-        
-        entity._entities = []
-        del entity
-        self.currentEntity = self.currentEntity[1:]
+    __slots__ = ["name", "namespace", "count", "subjects", "parents", "children", "attributes", "text",
+                 "not_unique", "_ids"]
+
+    def __init__(self, name, namespace=None):
+        self.name = name
+        self.namespace = namespace
+        self.count = 0
+        # Elements of this name that have child elements
+        self.subjects = 0
+        self.parents = {}
+        self.children = {}
+        self.attributes = {}
+        self.text = ValueProfile()
+        self.not_unique = set()
+        self._ids = {}
+
+    def addId(self, key, value, max_values=MAX_ID_VALUES):
+        """ Remember the value of a child (or "@attribute") to find out if it is unique """
+        if key in self.not_unique:
+            return
+        seen = self._ids.get(key)
+        if seen is None:
+            seen = self._ids[key] = set()
+        if value in seen:
+            self.not_unique.add(key)
+            del self._ids[key]
+        elif len(seen) < max_values:
+            seen.add(value)
+
+    def endChildren(self, counts):
+        """ Add the numbers of children (name -> count) of one element """
+        children = self.children
+        for name, count in counts.items():
+            stats = children.get(name)
+            if stats is None:
+                children[name] = [1, count, count, count]
+            else:
+                stats[0] = stats[0] + 1
+                stats[1] = stats[1] + count
+                if count < stats[2]:
+                    stats[2] = count
+                if count > stats[3]:
+                    stats[3] = count
+
+    def finish(self):
+        """ Forget the values kept to find unique ids, at the end of a file """
+        self._ids = {}
+
+    def merge(self, other, max_values=MAX_VALUES):
+        if self.namespace is None:
+            self.namespace = other.namespace
+        self.count = self.count + other.count
+        self.subjects = self.subjects + other.subjects
+        for name, count in other.parents.items():
+            self.parents[name] = self.parents.get(name, 0) + count
+        for name, (with_, total, low, high) in other.children.items():
+            stats = self.children.get(name)
+            if stats is None:
+                self.children[name] = [with_, total, low, high]
+            else:
+                self.children[name] = [stats[0] + with_, stats[1] + total, min(stats[2], low), max(stats[3], high)]
+        for qname, values in other.attributes.items():
+            if qname in self.attributes:
+                self.attributes[qname].merge(values, max_values)
+            else:
+                self.attributes[qname] = values
+        self.text.merge(other.text, max_values)
+        self.not_unique.update(other.not_unique)
+
+    def getCardinality(self, name):
+        """ Get the min and max number of a child in a element of this name """
+        with_, total, low, high = self.children[name]
+        return (low if with_ == self.count else 0), high
+
+
+class Profile:
+    """ The element profiles of one or more XML files, by element name in the order they were first seen """
+    def __init__(self, max_values=MAX_VALUES):
+        self.elements = {}
+        self.files = 0
+        self.failed = []
+        self.max_values = max_values
+
+    def getElement(self, name, namespace=None):
+        element = self.elements.get(name)
+        if element is None:
+            element = self.elements[name] = ElementProfile(name, namespace)
+        return element
+
+    def merge(self, other):
+        """ Add the profile of other files """
+        self.files = self.files + other.files
+        self.failed.extend(other.failed)
+        for name, element in other.elements.items():
+            if name in self.elements:
+                self.elements[name].merge(element, self.max_values)
+            else:
+                self.elements[name] = element
+        return self
+
+    def isSubject(self, name):
+        """ Elements with child elements become subjects, the others properties """
+        return self.elements[name].subjects > 0
+
+    def getIdCandidates(self, name):
+        """
+        Get the children (and "@attributes") that can be the id of a element: they occur once in
+        every element, are not empty and were unique in each file
+        """
+        element = self.elements[name]
+        candidates = []
+        for child in element.children:
+            profile = self.elements.get(child)
+            if profile is None or profile.subjects or child in element.not_unique or profile.text.empty:
+                continue
+            if element.getCardinality(child) == (1, 1):
+                candidates.append(child)
+
+        for qname, values in element.attributes.items():
+            key = "@" + qname
+            if values.count == element.count and not values.empty and key not in element.not_unique:
+                candidates.append(key)
+
+        return candidates
+
+    def isGloballyUnique(self, name, key):
+        """
+        Checks that the values of a child (or "@attribute") of a element are not repeated anywhere
+        in the input, as all subjects share a prefix. Returns None if it is unknown, because there
+        were more distinct values than the profile keeps
+        """
+        if key[0] == "@":
+            values = self.elements[name].attributes[key[1:]]
+        else:
+            values = self.elements[key].text
+        distinct, capped = values.getDistinct()
+        if capped:
+            return None
+        return distinct == values.count - values.empty
+
+    def getNamespace(self):
+        """ The most common namespace of the elements, or None """
+        counts = {}
+        for element in self.elements.values():
+            if element.namespace:
+                counts[element.namespace] = counts.get(element.namespace, 0) + element.count
+        return counts and max(counts, key=counts.get) or None
+
+    def asDict(self):
+        elements = {}
+        for name, element in self.elements.items():
+            elements[name] = {
+                "namespace": element.namespace,
+                "count": element.count,
+                "subject": element.subjects > 0,
+                "parents": element.parents,
+                "children": dict((child, dict(zip(["min", "max", "total"], element.getCardinality(child) + (element.children[child][1],))))
+                                 for child in element.children),
+                "attributes": dict((qname, values.asDict()) for qname, values in element.attributes.items()),
+                "id_candidates": self.getIdCandidates(name) if element.subjects else [],
+            }
+            if not element.subjects:
+                elements[name]["values"] = element.text.asDict()
+
+        return {"files": self.files, "failed": self.failed, "elements": elements}
+
+
+class ProfileXmlHandler:
+    """
+    Content handler (for the parsers in parsers.py) that adds the elements of a XML file to a
+    Profile. Only the open elements are kept, as [profile, child counts, text] frames
+    """
+    def __init__(self, profile, max_id_values=MAX_ID_VALUES):
+        self.profile = profile
+        self.max_values = profile.max_values
+        self.max_id_values = max_id_values
+        self._stack = []
+
+    def startDocument(self):
+        self._stack = []
 
     def endDocument(self):
-        # Generate template config
-        
-        config = {
-            # Default "schema" prefix
-            "type_prefix" : "http://sesam.io/schema/",
-
-            # Default subject prefix
-            "subject_prefix" : "http://data.sesam.io/",
-            "ids" : ["id"],
-            "ObjectElements" : self.entities,
-            "output_dir" : "output",
-            "input_dir" : "input",
-            "backup_dir" : "backup",
-            "interval" : 5,
-        }
-        
-        with open(self.outputfile, "w") as f:
-            f.write(yaml.dump(config, default_flow_style=False))
+        for element in self.profile.elements.values():
+            element.finish()
+
+    def startElementNS(self, nsname, qname, attrs):
+        uri, name = nsname
+        element = self.profile.elements.get(name)
+        if element is None:
+            element = self.profile.getElement(name, uri)
+        element.count = element.count + 1
+
+        stack = self._stack
+        if stack:
+            parent = stack[-1]
+            counts = parent[1]
+            if counts is None:
+                # The parent has children, its text is just whitespace
+                counts = parent[1] = {}
+                parent[2] = None
+            counts[name] = counts.get(name, 0) + 1
+            parents = element.parents
+            parents[parent[0].name] = parents.get(parent[0].name, 0) + 1
+
+        if attrs:
+            attributes = element.attributes
+            for attr_uri, local, attr_qname, value in compactAttributes(attrs):
+                values = attributes.get(attr_qname)
+                if values is None:
+                    values = attributes[attr_qname] = ValueProfile()
+                values.add(value, self.max_values)
+                element.addId("@" + attr_qname, value, self.max_id_values)
+
+        stack.append([element, None, []])
+
+    def endElementNS(self, nsname, qname):
+        element, counts, text = self._stack.pop()
+
+        if counts is None:
+            value = "".join(text)
+            element.text.add(value, self.max_values)
+            if self._stack:
+                parent = self._stack[-1]
+                # Only the first one, a second one means it is no id anyway
+                if parent[1][element.name] == 1:
+                    parent[0].addId(element.name, value.strip(), self.max_id_values)
+        else:
+            element.subjects = element.subjects + 1
+            element.endChildren(counts)
+
+    def characters(self, content):
+        if self._stack:
+            text = self._stack[-1][2]
+            if text is not None:
+                text.append(content)
+
+    # xml.sax calls these too
+    def setDocumentLocator(self, locator):
+        pass
+
+    def startPrefixMapping(self, prefix, uri):
+        pass
+
+    def endPrefixMapping(self, prefix):
+        pass
+
+    def ignorableWhitespace(self, whitespace):
+        pass
+
+    def processingInstruction(self, target, data):
+        pass
+
+
+def profileFile(path, max_values=MAX_VALUES, max_id_values=MAX_ID_VALUES, parser=None):
+    """ Profile a single (possibly compressed) XML file """
+    profile = Profile(max_values)
+    source = openInput(path)
+    try:
+        getParser(parser)(ProfileXmlHandler(profile, max_id_values), source)
+    finally:
+        source.close()
+    profile.files = 1
+    return profile
+
+
+def _profileFile(path, max_values, max_id_values, parser):
+    try:
+        return profileFile(path, max_values, max_id_values, parser)
+    except Exception as e:
+        profile = Profile(max_values)
+        profile.failed.append({"file": path, "error": "".join(traceback.format_exception_only(type(e), e)).strip()})
+        return profile
+
+
+def profileFiles(inputs, workers=None, max_values=MAX_VALUES, max_id_values=MAX_ID_VALUES, parser=None, logger=None):
+    """
+    Profile many files, directories and glob patterns (see batch.expandInputs), in parallel with
+    "workers" processes (default the number of CPUs). The profiles are merged in input order
+    """
+    files = expandInputs(inputs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(files)))
+
+    start = time.time()
+    profile = Profile(max_values)
+    if workers == 1:
+        results = (_profileFile(path, max_values, max_id_values, parser) for path in files)
+        for path, result in zip(files, results):
+            if logger:
+                logger.info("Profiled " + path)
+            profile.merge(result)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_profileFile, path, max_values, max_id_values, parser) for path in files]
+            for path, future in zip(files, futures):
+                if logger:
+                    logger.info("Profiled " + path)
+                profile.merge(future.result())
+
+    if logger:
+        for failed in profile.failed:
+            logger.error("Failed to profile '%s': %s" % (failed["file"], failed["error"]))
+        logger.info("Profiled %s files (%s elements) in %.2f seconds" % (
+            profile.files, sum(element.count for element in profile.elements.values()), time.time() - start))
+
+    return profile
+
+
+def generateConfig(profile):
+    """
+    Make a config from a profile. Only id candidates with a id-like name are used: the ones that
+    most subject elements have in common become the "ids", other elements get their own "id" or
+    are blank nodes ("id" set to None) if they have none. Properties with only URI values are
+    not literals
+    """
+    candidates = dict((name, profile.getIdCandidates(name)) for name in profile.elements if profile.isSubject(name))
+
+    popularity = {}
+    for keys in candidates.values():
+        for key in keys:
+            popularity[key] = popularity.get(key, 0) + 1
+
+    chosen = {}
+    for name, keys in candidates.items():
+        unique = dict((key, profile.isGloballyUnique(name, key)) for key in keys if _id_name_pattern.search(key))
+        # Keys that are known to be unique across the input, or else the ones it is unknown for
+        keys = [key for key in unique if unique[key]] or [key for key in unique if unique[key] is None]
+        if keys:
+            # The most common one, or else the first one
+            chosen[name] = sorted(keys, key=lambda key: -popularity[key])[0]
+
+    shared = {}
+    for key in chosen.values():
+        shared[key] = shared.get(key, 0) + 1
+    ids = sorted((key for key, count in shared.items() if count > 1), key=lambda key: (-shared[key], key))
+    if not ids:
+        ids = sorted(shared) or ["id"]
+
+    elements = {}
+    for name, element in profile.elements.items():
+        entry = {}
+        if name in candidates:
+            if name not in chosen:
+                entry["id"] = None
+            else:
+                # The first of the ids that the element has is the one that is used
+                present = [key for key in ids if (key[1:] in element.attributes if key[0] == "@" else key in element.children)]
+                if not present or present[0] != chosen[name]:
+                    entry["id"] = chosen[name]
+        elif element.text.getDatatype() == "anyURI":
+            entry["literal"] = False
+        elements[name] = entry
+
+    namespace = profile.getNamespace()
+    if namespace and not namespace.endswith("/"):
+        namespace = namespace + "/"
+
+    return {
+        # Default "schema" prefix
+        "type_prefix" : namespace or "http://sesam.io/schema/",
+
+        # Default subject prefix
+        "subject_prefix" : "http://data.sesam.io/",
+        "ids" : ids,
+        "ObjectElements" : elements,
+        "output_dir" : "output",
+        "input_dir" : "input",
+        "backup_dir" : "backup",
+        "interval" : 5,
+    }
+
+
+def _describe(profile, name):
+    """ Comment lines about a element for the generated config """
+    element = profile.elements[name]
+    where = ", ".join(sorted(element.parents)) or "the root"
+    lines = ["%s in %s" % (element.count, where)]
+
+    if element.subjects:
+        children = []
+        for child in element.children:
+            low, high = element.getCardinality(child)
+            children.append(low == high and "%s %s" % (child, low) or "%s %s..%s" % (child, low, high))
+        lines.append("children: " + ", ".join(children))
+        if element.attributes:
+            lines.append("attributes: " + ", ".join(element.attributes))
+        candidates = profile.getIdCandidates(name)
+        lines.append("id candidates: " + (", ".join(candidates) or "none"))
+        unknown = [key for key in candidates if profile.isGloballyUnique(name, key) is None]
+        if unknown:
+            lines.append("not known to be unique across the input (too many distinct values): " + ", ".join(unknown))
+    else:
+        distinct, capped = element.text.getDistinct()
+        lines[0] = lines[0] + ", %s%s distinct values, %s" % (capped and "over " or "", distinct, element.text.getDatatype())
+        if element.text.empty:
+            lines[0] = lines[0] + ", %s empty" % element.text.empty
+        if not capped and 0 < distinct <= MAX_LISTED_VALUES and element.text.count > distinct:
+            lines.append("values: " + ", ".join(sorted(element.text.values)))
+
+    return lines
+
+
+def writeConfig(profile, output):
+    """ Write the config of a profile as YAML to a text stream, with what is known about each element as comments """
+    config = generateConfig(profile)
+    elements = config.pop("ObjectElements")
+
+    output.write(yaml.dump(config, default_flow_style=False))
+    output.write("ObjectElements:\n")
+    for name, entry in elements.items():
+        for line in _describe(profile, name):
+            output.write("    # %s\n" % line)
+        for line in yaml.dump({name: entry}, default_flow_style=False).splitlines():
+            output.write("    %s\n" % line)
+
+    return config
+
 
 def getCurrDir():
     """ Get the current directory """
@@ -89,18 +522,26 @@ def getCurrDir():
 
 
 def main():
-    """ Parse arguments, set logger, read config and parse input """
+    """ Parse arguments, set logger, profile the input and write the config """
     format_string = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logger = logging.getLogger('generateconfig')
     stdout_handler = logging.StreamHandler()
     stdout_handler.setFormatter(logging.Formatter(format_string))
     logger.addHandler(stdout_handler)
 
-    parser = argparse.ArgumentParser(description="Genewrate config file templates for the XML to RDF converted")
-    parser.add_argument("-i", "--input", dest='inputfile',
-                        help='Path to input XML files', default=None)
+    parser = argparse.ArgumentParser(description="Generate config file templates for the XML to RDF converter")
+    parser.add_argument("-i", "--input", dest='inputfile', nargs="+", required=True,
+                        help='Path to input XML files. Several files, directories or glob patterns can be given to profile them in parallel')
     parser.add_argument("-o", "--output", dest='outputfile',
-                        help='Path to output NTriple files', default=None)
+                        help='Path to the config file to write, the default is stdout', default=None)
+    parser.add_argument("--profile", dest="profilefile", default=None,
+                        help="Also write what is known about each element as JSON to this file")
+    parser.add_argument("--workers", dest="workers", type=int, default=None,
+                        help="Number of files to profile in parallel, the default is the number of CPUs")
+    parser.add_argument("--max-values", dest="max_values", type=int, default=MAX_VALUES,
+                        help="Number of distinct values to keep per element name, the default is %s" % MAX_VALUES)
+    parser.add_argument("-p", "--parser", dest="parser", default=None,
+                        help="XML parser backend (auto, expat, lxml or sax), the default is auto")
     parser.add_argument("-l", "--loglevel", dest="loglevel",
                         help="Loglevel (INFO, DEBUG, WARN..), default is INFO", metavar="LOGLEVEL", default="INFO")
     parser.add_argument("-f", "--logfile", dest="logfile", default="generateconfig.log",
@@ -114,9 +555,20 @@ def main():
     file_handler.setFormatter(logging.Formatter(format_string))
     logger.addHandler(file_handler)
 
-    parser = xml.sax.make_parser()
-    parser.setContentHandler(ConfigXmlHandler(options.outputfile, logger=logger))
-    parser.parse(open(options.inputfile,"r"))
+    profile = profileFiles(options.inputfile, workers=options.workers, max_values=options.max_values, parser=options.parser, logger=logger)
+    if not profile.files:
+        logger.error("Nothing to profile")
+        sys.exit(1)
+
+    if options.outputfile:
+        with open(options.outputfile, "w", encoding="utf-8") as f:
+            writeConfig(profile, f)
+    else:
+        writeConfig(profile, sys.stdout)
+
+    if options.profilefile:
+        with open(options.profilefile, "w", encoding="utf-8") as f:
+            json.dump(profile.asDict(), f, indent=2, ensure_ascii=False)
 
 
 # Check if called from command line
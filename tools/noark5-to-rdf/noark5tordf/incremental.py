@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, time, sqlite3, hashlib
+
+from .utils import *
+from .formats import splitTriples
+
+# How many manifest updates are written to the database in one transaction
+MANIFEST_BATCH_SIZE = 1000
+
+ADDED = "added"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+def hashSubject(data):
+    """
+    Hash the NTriples of a subject. The hash doesn't depend on the order of the triples (which
+    is different when streaming) or the labels of blank nodes
+    """
+    if "_:" in data:
+        # Blank node labels depend on how many blank nodes came before in the file, so they are
+        # left out of the hash. Only the subjects and objects are blank nodes, not "_:" in literals
+        lines = []
+        for subject, predicate, object in splitTriples(data):
+            if subject.startswith("_:"):
+                subject = "_:"
+            if object.startswith("_:"):
+                object = "_: "
+            lines.append("%s %s %s." % (subject, predicate, object))
+    else:
+        # Only "\n" ends a line, literals in UTF-8 output may have U+2028 and U+0085 unescaped
+        lines = data.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+    lines.sort()
+
+    return hashlib.blake2b("\n".join(lines).encode("utf-8"), digest_size=16).digest()
+
+
+class Manifest:
+    """
+    A SQLite database of the subjects written by earlier conversions and the hashes of their
+    triples. Every conversion is a run, and the subjects a run has seen are marked with its
+    number, so the subjects that were not seen by a complete run are the deleted ones. Several
+    processes can use the same manifest (and run) at the same time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS subjects (subject TEXT NOT NULL, type TEXT NOT NULL, "
+                             "hash BLOB NOT NULL, run INTEGER NOT NULL, PRIMARY KEY (subject, type))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY AUTOINCREMENT, "
+                             "started REAL NOT NULL, finished REAL)")
+        self._pending = []
+
+    def startRun(self):
+        """ Start a new run, and return its number """
+        with self._db:
+            cursor = self._db.execute("INSERT INTO runs (started) VALUES (?)", (time.time(),))
+        return cursor.lastrowid
+
+    def check(self, run, subject, type, digest):
+        """ Record that "run" has seen a subject, and return if it is ADDED, CHANGED or UNCHANGED """
+        row = self._db.execute("SELECT hash FROM subjects WHERE subject = ? AND type = ?", (subject, type)).fetchone()
+        self._pending.append((subject, type, digest, run))
+        if len(self._pending) >= MANIFEST_BATCH_SIZE:
+            self.flush()
+
+        if row is None:
+            return ADDED
+        if row[0] != digest:
+            return CHANGED
+        return UNCHANGED
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        with self._db:
+            self._db.executemany("INSERT INTO subjects (subject, type, hash, run) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT (subject, type) DO UPDATE SET hash = excluded.hash, run = excluded.run",
+                                 self._pending)
+        self._pending = []
+
+    def finishRun(self, run, deletions=True):
+        """
+        Mark a run as finished. If "deletions" is True the subjects that the run has not seen
+        are removed from the manifest and returned as a list of (subject, type) tuples
+        """
+        self.flush()
+
+        deleted = []
+        with self._db:
+            if deletions:
+                deleted = self._db.execute("SELECT subject, type FROM subjects WHERE run < ? ORDER BY subject, type", (run,)).fetchall()
+                self._db.execute("DELETE FROM subjects WHERE run < ?", (run,))
+            self._db.execute("UPDATE runs SET finished = ? WHERE run = ?", (time.time(), run))
+
+        return deleted
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def getManifestPath(config):
+    """ Get the path of the manifest of the config, relative paths are in the output dir """
+    path = config.get("manifest")
+    if path and not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+def getTombstoneFile(config):
+    """ Get the file that the subjects deleted since the previous run are written to """
+    path = config.get("tombstone_file") or "deleted-subjects.txt"
+    if not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+def writeTombstones(config, deleted, logger=None):
+    """ Write the subject URIs (one per line) of the deleted subjects to the tombstone file """
+    filename = getTombstoneFile(config)
+    with open(filename, "w", encoding="utf-8") as output:
+        for subject, type in deleted:
+            output.write(subject + "\n")
+
+    if logger:
+        logger.info("Wrote %s deleted subjects to '%s'" % (len(deleted), filename))
+
+    return filename
+
+
+def startRun(config):
+    """
+    Start a incremental run that several conversions (e.g. the workers of a batch) take part
+    in. Returns a copy of the config with the run in "manifest_run", or the config itself if
+    it has no manifest
+    """
+    path = getManifestPath(config)
+    if not path:
+        return config
+
+    manifest = Manifest(path)
+    try:
+        run = manifest.startRun()
+    finally:
+        manifest.close()
+
+    return dict(config, manifest_run=run)
+
+
+def finishRun(config, deletions=True, logger=None):
+    """
+    Finish the run started by startRun(). With "deletions" the subjects that were not seen are
+    written to the tombstone file. Returns the deleted subjects as (subject, type) tuples
+    """
+    path = getManifestPath(config)
+    if not path or config.get("manifest_run") is None:
+        return []
+
+    manifest = Manifest(path)
+    try:
+        deleted = manifest.finishRun(config["manifest_run"], deletions=deletions)
+    finally:
+        manifest.close()
+
+    if deletions:
+        writeTombstones(config, deleted, logger=logger)
+
+    return deleted
+
+
+class _HashingWriter:
+    """ Collects the NTriples of a subject, and writes them to the sink when the subject is new or changed """
+    def __init__(self, sink, entity):
+        self._sink = sink
+        self._entity = entity
+        self._subject = entity.getSubject()
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(data)
+
+    def close(self):
+        self._sink._checkSubject(self._entity, self._subject, "".join(self._parts))
+        self._parts = None
+
+
+class IncrementalSink:
+    """
+    Wraps a sink, and only hands it the subjects that are new or have changed since the previous
+    run according to the manifest (see Manifest). Each subject is kept in memory until it ends,
+    also when streaming. If the config has no "manifest_run" the sink is a run of its own, and
+    writes the subjects that were not seen to the tombstone file when closed.
+    """
+    def __init__(self, config, sink, logger=None):
+        self._config = config
+        self._sink = sink
+        self._logger = logger
+        self._manifest = Manifest(getManifestPath(config))
+        self._run = config.get("manifest_run")
+        self._owns_run = self._run is None
+        if self._owns_run:
+            self._run = self._manifest.startRun()
+
+        self.added = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.deleted = []
+
+    def __getattr__(self, name):
+        # The counts, file names etc. of the wrapped sink
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._sink, name)
+
+    def _checkSubject(self, entity, subject, data):
+        status = self._manifest.check(self._run, subject, entity.getType(), hashSubject(data))
+
+        if status == UNCHANGED:
+            self.unchanged = self.unchanged + 1
+            return
+
+        if status == ADDED:
+            self.added = self.added + 1
+        else:
+            self.changed = self.changed + 1
+
+        writer = self._sink.openSubject(entity)
+        writer.write(data)
+        writer.close()
+
+    def writeSubject(self, entity, data):
+        self._checkSubject(entity, entity.getSubject(), data)
+
+    def openSubject(self, entity):
+        return _HashingWriter(self, entity)
+
+    def getFilenames(self):
+        return self._sink.getFilenames()
+
+    def getCounts(self):
+        """ Get the number of added, changed, unchanged and deleted subjects """
+        return {ADDED: self.added, CHANGED: self.changed, UNCHANGED: self.unchanged, "deleted": len(self.deleted)}
+
+    def close(self):
+        if self._manifest is None:
+            return
+
+        try:
+            self._sink.close()
+            if self._owns_run:
+                self.deleted = self._manifest.finishRun(self._run)
+                writeTombstones(self._config, self.deleted, logger=self._logger)
+        finally:
+            self._manifest.close()
+            self._manifest = None
+
+        if self._logger:
+            self._logger.info("%s subjects added, %s changed, %s unchanged, %s deleted" % (
+                self.added, self.changed, self.unchanged, len(self.deleted)))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, io, mmap, gzip, bz2, lzma, tarfile, zipfile
+
+from .utils import *
+
+# Single compressed XML files
+COMPRESSED_EXTENSIONS = {".gz" : gzip.open, ".bz2" : bz2.open, ".xz" : lzma.open}
+
+# Submission packages, a member is given as "<archive>!<member>"
+ARCHIVE_EXTENSIONS = [".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".zip"]
+MEMBER_SEPARATOR = "!"
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+def isArchive(path):
+    """ Checks if "path" is a tar or zip archive (by its name) """
+    return path.lower().endswith(tuple(ARCHIVE_EXTENSIONS))
+
+
+def isXmlInput(name):
+    """ Checks if "name" is a XML file, possibly compressed """
+    name = name.lower()
+    for extension in COMPRESSED_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+
+    return name.endswith(".xml")
+
+
+def splitMember(path):
+    """ Split "<archive>!<member>" into (archive, member), or return (path, None) for other paths """
+    archive, sep, member = path.partition(MEMBER_SEPARATOR)
+    if sep and member and isArchive(archive) and os.path.isfile(archive):
+        return archive, member
+
+    return path, None
+
+
+def getInputBasename(path):
+    """ Get the file name of a input without the archive and compression parts, e.g. "arkivstruktur.xml" """
+    archive, member = splitMember(path)
+    name = os.path.basename(member or path)
+
+    for extension in COMPRESSED_EXTENSIONS:
+        if name.lower().endswith(extension) and isXmlInput(name):
+            return name[:-len(extension)]
+
+    return name
+
+
+def listArchive(path):
+    """ Get the XML members of a tar or zip archive as "<archive>!<member>" paths, in archive order """
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    else:
+        with tarfile.open(path, "r:*") as archive:
+            names = [info.name for info in archive.getmembers() if info.isfile()]
+
+    return [path + MEMBER_SEPARATOR + name for name in names if isXmlInput(name)]
+
+
+def isPlainFile(path):
+    """ Checks if "path" is a uncompressed file, that can be read at any offset """
+    return isinstance(path, str) and os.path.isfile(path) and not isArchive(path) and \
+        os.path.splitext(path)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+class MappedInput:
+    """
+    A uncompressed file mapped into memory. It can be read like a file, and getBuffer()
+    gives the parsers that support it the whole file without copying
+    """
+    def __init__(self, path):
+        self.name = path
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+    def read(self, size=-1):
+        return self._mmap.read(size)
+
+    def getBuffer(self):
+        return memoryview(self._mmap)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class _InputReader(io.BufferedReader):
+    """ A buffered reader that also closes the files and archives it reads through """
+    def __init__(self, raw, name, buffer_size, closing=()):
+        io.BufferedReader.__init__(self, raw, buffer_size)
+        self._name = name
+        self._closing = closing
+
+    @property
+    def name(self):
+        return self._name
+
+    def close(self):
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            for other in self._closing:
+                other.close()
+
+
+def _decompress(fileobj, name, path, buffer_size, closing):
+    """ Wrap a binary file in a decompressor if "name" ends with a compression extension """
+    decompressor = COMPRESSED_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+    if decompressor is not None:
+        closing = (fileobj,) + closing
+        fileobj = decompressor(fileobj, "rb")
+
+    return _InputReader(fileobj, path, buffer_size, closing)
+
+
+def openInput(path, buffer_size=None):
+    """
+    Open a input file for reading as a binary file-like object. Compressed files (.gz, .bz2,
+    .xz) are decompressed on the fly, archive members ("<archive>!<member>", tar or zip) are read
+    straight from the archive, and uncompressed files are mapped into memory (see MappedInput).
+    """
+    buffer_size = buffer_size or DEFAULT_BUFFER_SIZE
+    archive_path, member = splitMember(path)
+
+    if member is not None:
+        if archive_path.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(archive_path)
+            try:
+                raw = archive.open(member)
+            except:
+                archive.close()
+                raise
+        else:
+            archive = tarfile.open(archive_path, "r:*")
+            try:
+                raw = archive.extractfile(member)
+                if raw is None:
+                    raise ValueError("'%s' is not a file in '%s'" % (member, archive_path))
+            except:
+                archive.close()
+                raise
+
+        return _decompress(raw, member, path, buffer_size, (archive,))
+
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return _decompress(open(path, "rb", buffering=buffer_size), path, path, buffer_size, ())
+
+    if os.path.getsize(path) > 0:
+        return MappedInput(path)
+
+    # Empty files can't be mapped, let the parser report them
+    return open(path, "rb")
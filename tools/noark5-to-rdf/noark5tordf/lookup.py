@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Look up the triples of subjects in the output of a conversion, see subjectindex.py
+
+import os, sys, argparse
+
+from .utils import *
+from .subjectindex import SubjectIndex
+
+
+def main():
+    """ Look up the triples of a subject in a subject index """
+    parser = argparse.ArgumentParser(description="Get the triples of a subject from the output of noark5tordf, using its subject index")
+    parser.add_argument("index", help="The subject index (see --index of noark5tordf)")
+    parser.add_argument("key", nargs="+", help="Ids (e.g. systemIDs) of the subjects, or their URIs with --subject")
+    parser.add_argument("--subject", dest="subject", action="store_true",
+                        help="The keys are subject URIs (with or without angle brackets) instead of ids")
+    parser.add_argument("--subtree", dest="subtree", action="store_true",
+                        help="Also get the subjects below them, e.g. the registreringer and dokumentbeskrivelser of a mappe")
+    parser.add_argument("--locations", dest="locations", action="store_true",
+                        help="Print the files, offsets and lengths of the triples instead of the triples")
+
+    options = parser.parse_args()
+
+    if not os.path.isfile(options.index):
+        parser.error("'%s' is not a file" % options.index)
+
+    index = SubjectIndex(options.index)
+    found = True
+    try:
+        for key in options.key:
+            subject, id = None, key
+            if options.subject:
+                subject, id = key.startswith("<") and key or "<%s>" % key, None
+
+            locations = index.find(subject, id)
+            if not locations:
+                sys.stderr.write("'%s' is not in the index\n" % key)
+                found = False
+                continue
+
+            if options.locations:
+                if options.subtree:
+                    subjects = sorted(set(location.subject for location in locations))
+                    locations = []
+                    for subject in subjects:
+                        locations.extend(index.getSubtree(subject))
+                for location in locations:
+                    sys.stdout.write("%s\t%s\t%s\t%s\t%s\n" % (location.subject, location.type, location.file, location.offset, location.length))
+            else:
+                sys.stdout.write(index.getTriples(subject, id, subtree=options.subtree))
+    finally:
+        index.close()
+
+    return found and 0 or 1
+
+
+# Check if called from command line
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, json, time
+
+from .utils import *
+from .inputs import getInputBasename
+from .xmlhandler import GeneralXmlHandler
+
+COUNTERS = ["files", "elements", "properties", "objects", "blank_nodes", "triples"]
+
+# "parse" is the XML parser itself (and reading the input), "build" building the entity tree,
+# "id" finding the ids of objects, "expressions" the value and id expressions of the config,
+# "escape" escaping literals, "serialize" formatting the NTriples and "write" the output sink
+PHASES = ["parse", "build", "id", "expressions", "escape", "serialize", "write"]
+
+
+class Metrics:
+    """
+    Counters, the time spent in each phase (see PHASES) and the count, time and triples per
+    element name of one or more conversions. The time of a phase doesn't include the time of
+    the phases entered while it runs, so the phases add up to the time of the conversion.
+    """
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.elements = {}
+        self.seconds = 0.0
+        self._stack = []
+
+    def count(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def getElement(self, name):
+        """ Get the [count, seconds, triples] of a element name """
+        element = self.elements.get(name)
+        if element is None:
+            element = self.elements[name] = [0, 0.0, 0]
+        return element
+
+    def enter(self, phase):
+        self._stack.append([phase, time.perf_counter(), 0.0])
+
+    def exit(self):
+        """ Leave the innermost phase, returns its time including the phases within it """
+        phase, start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] = self._stack[-1][2] + elapsed
+        return elapsed
+
+    def timed(self, function, phase):
+        """ Wrap a function so its calls are timed as "phase" """
+        def timedFunction(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit()
+
+        return timedFunction
+
+    def merge(self, other):
+        """ Add the metrics of another conversion (a Metrics or its asDict()) """
+        if isinstance(other, Metrics):
+            other = other.asDict()
+
+        self.seconds = self.seconds + other["seconds"]
+        for name, count in other["counters"].items():
+            self.count(name, count)
+        for phase, seconds in other["phases"].items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        for element in other["elements"]:
+            counts = self.getElement(element["element"])
+            counts[0] = counts[0] + element["count"]
+            counts[1] = counts[1] + element["seconds"]
+            counts[2] = counts[2] + element["triples"]
+
+    def getElements(self):
+        """ Get (name, count, seconds, triples) of every element name, the slowest first """
+        return sorted(((name, count, seconds, triples) for name, (count, seconds, triples) in self.elements.items()),
+                      key=lambda element: (-element[2], element[0]))
+
+    def asDict(self):
+        seconds = self.seconds or None
+        return {
+            "seconds" : self.seconds,
+            "counters" : dict(self.counters),
+            "phases" : dict(self.phases),
+            "rates" : {
+                "elements_per_second" : seconds and self.counters["elements"] / seconds or 0,
+                "triples_per_second" : seconds and self.counters["triples"] / seconds or 0,
+            },
+            "elements" : [{"element" : name, "count" : count, "seconds" : seconds, "triples" : triples,
+                           "microseconds_per_element" : count and seconds * 1000000 / count or 0}
+                          for name, count, seconds, triples in self.getElements()],
+        }
+
+    def getSummary(self, elements=5):
+        """ A line about the counts and phases and the "elements" slowest element names, for the log """
+        phases = ", ".join("%s %.2fs" % (phase, seconds) for phase, seconds in self.phases.items())
+        slowest = ", ".join("%s %.2fs" % (name, seconds) for name, count, seconds, triples in self.getElements()[:elements])
+        return "%s elements, %s triples in %.2fs (%s), slowest elements: %s" % (
+            self.counters["elements"], self.counters["triples"], self.seconds, phases, slowest)
+
+    def writeJson(self, filename):
+        _writeAtomically(filename, json.dumps(self.asDict(), indent=2) + "\n")
+
+    def writePrometheus(self, filename, prefix="noark5tordf"):
+        """ Write the metrics in the Prometheus text format, e.g. for the textfile collector of node_exporter """
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s counter" % (prefix, name))
+            for labels, value in samples:
+                lines.append("%s_%s%s %r" % (prefix, name, labels, value))
+
+        for name, count in self.counters.items():
+            metric(name + "_total", "Number of %s converted" % name.replace("_", " "), [("", count)])
+        metric("seconds_total", "Seconds spent converting", [("", self.seconds)])
+        metric("phase_seconds_total", "Seconds spent in each phase of converting",
+               [('{phase="%s"}' % _label(phase), seconds) for phase, seconds in self.phases.items()])
+
+        elements = self.getElements()
+        metric("element_count_total", "Number of elements by name",
+               [('{element="%s"}' % _label(name), count) for name, count, seconds, triples in elements])
+        metric("element_seconds_total", "Seconds spent on the elements by name",
+               [('{element="%s"}' % _label(name), seconds) for name, count, seconds, triples in elements])
+        metric("element_triples_total", "Number of triples of the subjects by element name",
+               [('{element="%s"}' % _label(name), triples) for name, count, seconds, triples in elements])
+
+        _writeAtomically(filename, "\n".join(lines) + "\n")
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _writeAtomically(filename, data):
+    """ Write a file so readers never see it half written """
+    temp = "%s.%s.tmp" % (filename, os.getpid())
+    with open(temp, "w", encoding="utf-8") as output:
+        output.write(data)
+    os.replace(temp, filename)
+
+
+class _TimedExpression:
+    """ A value or id expression that is timed as "expressions" """
+    def __init__(self, expression, metrics):
+        self.expression = expression
+        self.evaluate = metrics.timed(expression.evaluate, "expressions")
+
+
+class MeteredXmlHandler(GeneralXmlHandler):
+    """
+    A GeneralXmlHandler that records Metrics: the counts, the time per element name and the time
+    spent finding ids, evaluating expressions, escaping literals and serializing. Only used when
+    metrics are turned on, so a normal conversion doesn't pay for it.
+    """
+    def __init__(self, config, metrics, logger=None, sink=None, bnode_prefix="", context_depth=0):
+        GeneralXmlHandler.__init__(self, config, logger=logger, sink=sink, bnode_prefix=bnode_prefix, context_depth=context_depth)
+        self.metrics = metrics
+        self._metered_rules = set()
+
+    def _meterRule(self, rule):
+        # The rules are compiled for this handler only, so they can be wrapped in place
+        rule.escape = self.metrics.timed(rule.escape, "escape")
+        if rule.value is not None:
+            rule.value = _TimedExpression(rule.value, self.metrics)
+        if rule.id_expression is not None:
+            rule.id_expression = _TimedExpression(rule.id_expression, self.metrics)
+        self._metered_rules.add(rule.name)
+
+    def startElementNS(self, nsname, qname, attrs):
+        name = nsname[1]
+        if name not in self._metered_rules:
+            self._meterRule(self.rules[name])
+
+        metrics = self.metrics
+        metrics.enter("build")
+        try:
+            GeneralXmlHandler.startElementNS(self, nsname, qname, attrs)
+        finally:
+            elapsed = metrics.exit()
+
+        element = metrics.getElement(name)
+        element[0] = element[0] + 1
+        element[1] = element[1] + elapsed
+        metrics.counters["elements"] = metrics.counters["elements"] + 1
+
+    def endElementNS(self, nsname, qname):
+        metrics = self.metrics
+        entity = self.getCurrentEntity()
+
+        # Elements with children are objects (or blank nodes) and are serialized, the others are properties
+        if entity.hasChildren():
+            metrics.enter("serialize")
+            metrics.enter("id")
+            try:
+                kind = entity.getId() is None and "blank_nodes" or "objects"
+            finally:
+                metrics.exit()
+        else:
+            metrics.enter("build")
+            kind = "properties"
+
+        try:
+            GeneralXmlHandler.endElementNS(self, nsname, qname)
+        finally:
+            elapsed = metrics.exit()
+
+        element = metrics.getElement(nsname[1])
+        element[1] = element[1] + elapsed
+        metrics.counters[kind] = metrics.counters[kind] + 1
+
+    def characters(self, text):
+        self.metrics.enter("build")
+        try:
+            GeneralXmlHandler.characters(self, text)
+        finally:
+            self.metrics.exit()
+
+
+class _MeteredWriter:
+    """ Times the writes of a subject, and counts its triples for its element name """
+    __slots__ = ["_metrics", "_element", "_writer", "_triples"]
+
+    def __init__(self, metrics, element, writer):
+        self._metrics = metrics
+        self._element = element
+        self._writer = writer
+        self._triples = 0
+
+    def write(self, data):
+        self._metrics.enter("write")
+        try:
+            self._writer.write(data)
+        finally:
+            self._metrics.exit()
+        self._triples = self._triples + data.count("\n")
+
+    def close(self):
+        self._metrics.enter("write")
+        try:
+            self._writer.close()
+        finally:
+            self._metrics.exit()
+
+        self._element[2] = self._element[2] + self._triples
+        self._metrics.count("triples", self._triples)
+
+
+class MeteredSink:
+    """ Wraps a sink, and times and counts what is written to it in "metrics" """
+    def __init__(self, sink, metrics):
+        self._sink = sink
+        self._closed = False
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        # The counts, file names, report etc. of the wrapped sink
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._sink, name)
+
+    def openSubject(self, entity):
+        self.metrics.enter("write")
+        try:
+            writer = self._sink.openSubject(entity)
+        finally:
+            self.metrics.exit()
+        return _MeteredWriter(self.metrics, self.metrics.getElement(entity.getName()), writer)
+
+    def writeSubject(self, entity, data):
+        writer = self.openSubject(entity)
+        writer.write(data)
+        writer.close()
+
+    def getFilenames(self):
+        return self._sink.getFilenames()
+
+    def getCounts(self):
+        if hasattr(self._sink, "getCounts"):
+            return self._sink.getCounts()
+        return {}
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        self.metrics.enter("write")
+        try:
+            self._sink.close()
+        finally:
+            self.metrics.exit()
+
+
+def isMetered(config):
+    """ Checks if the config asks for metrics, as JSON ("metrics") or for Prometheus ("metrics_textfile") """
+    return bool(config.get("metrics") or config.get("metrics_textfile"))
+
+
+def _getOutputPath(config, path, inputfile, suffix):
+    """ A path relative to the output dir, or "<input name><suffix>" in the output dir if "path" is just true """
+    if path is True:
+        name = inputfile and getInputBasename(inputfile) or "output"
+        if name.endswith(".xml"):
+            name = name[:-4]
+        path = name + suffix
+
+    if not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+def getMetricsPath(config, inputfile=None):
+    """
+    Get the file the JSON metrics of a input are written to: "metrics" (relative to the output dir),
+    or "<input name>-metrics.json" in the output dir if it is true. None if there are no JSON metrics
+    """
+    path = config.get("metrics")
+    if not path:
+        return None
+    return _getOutputPath(config, path, inputfile, "-metrics.json")
+
+
+def getTextfilePath(config):
+    """ Get the Prometheus textfile ("metrics_textfile", relative to the output dir), or None """
+    path = config.get("metrics_textfile")
+    if not path:
+        return None
+    return _getOutputPath(config, path, None, ".prom")
+
+
+def getProfilePath(config, inputfile=None):
+    """
+    Get the file the cProfile statistics of a input are written to: "profile" (relative to the output
+    dir), or "<input name>.prof" in the output dir if it is true. None if profiling is off
+    """
+    path = config.get("profile")
+    if not path:
+        return None
+    return _getOutputPath(config, path, inputfile, ".prof")
+
+
+def writeMetrics(config, metrics, inputfile=None, logger=None):
+    """ Write the metrics to the JSON file and the Prometheus textfile of the config """
+    path = getMetricsPath(config, inputfile)
+    if path:
+        metrics.writeJson(path)
+
+    textfile = getTextfilePath(config)
+    if textfile:
+        metrics.writePrometheus(textfile)
+
+    if logger:
+        logger.info("Metrics: %s" % metrics.getSummary())
@@ -4,29 +4,111 @@
 # Noark5 to RDF Converter version 1.0.0
 # Author: Graham Moore, graham.moore@sesam.io
 
-import os, argparse, logging
-import xml.sax
-from xml.sax.handler import feature_namespaces
+import os, sys, time, argparse, logging, cProfile
 
 from .config import *
 from .utils import *
+from .sinks import OUTPUT_MODES, createSink
+from .watcher import watch
+from .batch import process_xml_files, expandInputs
+from .split import process_large_xml_file
 from .xmlhandler import GeneralXmlHandler
+from .parsers import PARSER_BACKENDS, getParser
+from .formats import OUTPUT_FORMATS, OUTPUT_COMPRESSIONS
+from .store import STORE_BACKENDS
+from .inputs import openInput, isArchive, isPlainFile
+from .metrics import Metrics, MeteredSink, MeteredXmlHandler, isMetered, writeMetrics, getProfilePath
+from .checksums import ChecksumVerifier, ChecksumSink, writeChecksumReport
 
 
-def process_xml_file(config, inputfile, logger=None):
-    """ Process a single XML file and output RDF to output dir """
+def process_xml_file(config, inputfile, logger=None, sink=None, bnode_prefix="", context_depth=0):
+    """
+    Process a single XML file (a path or a binary file-like object) and output RDF to output dir.
+    The path can be a compressed file (.gz, .bz2, .xz) or a member of a tar or zip archive
+    ("<archive>!<member>", see inputs.openInput).
+    If no sink is given, one is created from the "output_mode" of the config and closed when done.
+    "bnode_prefix" is prepended to all blank node labels, and the outermost "context_depth"
+    elements are not serialized (see split.process_large_xml_file).
+    With "metrics" or "metrics_textfile" in the config the returned sink has the Metrics of the
+    conversion (see metrics.py), and with "profile" the conversion is profiled with cProfile.
+    With "verify_checksums" the document files are checked while converting, the returned sink
+    has the ChecksumReport in "checksums" (see checksums.py)
+    """
+    if not isinstance(inputfile, str):
+        inputname = getattr(inputfile, "name", "<stream>")
+    else:
+        inputname = inputfile
+
     if logger:
-        logger.info("Processing XML from " + inputfile)
+        logger.info("Processing XML from " + inputname)
         logger.info("Writing RDF into " + config["output_dir"])
 
-    parser = xml.sax.make_parser()
-    
-    # Turn on namespace support
-    parser.setFeature(feature_namespaces, 1)
-    parser.setContentHandler(GeneralXmlHandler(config, logger=logger))
+    owns_sink = sink is None
+    if owns_sink:
+        sink = createSink(config, inputfile=inputname, logger=logger)
+
+    parse = getParser(config.get("parser"))
+    metrics = None
+    if isMetered(config):
+        metrics = Metrics()
+        sink = MeteredSink(sink, metrics)
+        handler = MeteredXmlHandler(config, metrics, logger=logger, sink=sink, bnode_prefix=bnode_prefix, context_depth=context_depth)
+    else:
+        handler = GeneralXmlHandler(config, logger=logger, sink=sink, bnode_prefix=bnode_prefix, context_depth=context_depth)
+
+    verifier = None
+    if config.get("verify_checksums"):
+        verifier = ChecksumVerifier(config, inputname, logger=logger)
+        handler.verifier = verifier
+        sink = ChecksumSink(sink, verifier)
+
+    profiler = None
+    if config.get("profile"):
+        profiler = cProfile.Profile()
+
+    # Compressed files and archive members are decompressed on the fly, other files are memory mapped
+    start = time.perf_counter()
+    source = inputfile
+    if isinstance(inputfile, str):
+        source = openInput(inputfile, config.get("input_buffer_size"))
     
     # Process the input file
-    parser.parse(inputfile)
+    try:
+        if metrics is not None:
+            metrics.enter("parse")
+        if profiler is not None:
+            profiler.enable()
+        try:
+            parse(handler, source)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if metrics is not None:
+                metrics.exit()
+    finally:
+        if source is not inputfile:
+            source.close()
+        # The files still being hashed
+        if verifier is not None:
+            verifier.close()
+        if owns_sink:
+            sink.close()
+
+    inputpath = isinstance(inputfile, str) and inputfile or None
+    if profiler is not None:
+        profiler.dump_stats(getProfilePath(config, inputpath))
+
+    if metrics is not None:
+        metrics.seconds = time.perf_counter() - start
+        metrics.count("files")
+        # Many files (or parts of one) are collected and written together, see batch.py and split.py
+        if not config.get("metrics_collect"):
+            writeMetrics(config, metrics, inputpath, logger=logger)
+
+    if verifier is not None and not config.get("checksums_collect"):
+        writeChecksumReport(config, verifier.report, inputpath, logger=logger)
+
+    return sink
 
 
 def main():
@@ -38,8 +120,24 @@ def main():
     logger.addHandler(stdout_handler)
 
     parser = argparse.ArgumentParser(description="Noark5 to RDF 1.0.0")
-    parser.add_argument("-i", "--input", dest='inputfile',
-                        help='Path to input XML file', required=True)
+    parser.add_argument("-i", "--input", dest='inputfile', nargs="+",
+                        help='Path to input XML file. Several files, directories or glob patterns can be given to convert them in parallel', default=None)
+    parser.add_argument("-w", "--watch", dest="watch", action="store_true",
+                        help="Keep running and convert every XML file that arrives in the input dir, moving it to the backup dir when done")
+    parser.add_argument("--once", dest="once", action="store_true",
+                        help="With --watch, convert the files that are in the input dir and exit")
+    parser.add_argument("--input-dir", dest="input_dir", default=None,
+                        help="Directory to watch for XML files (overrides 'input_dir' in the config)")
+    parser.add_argument("--backup-dir", dest="backup_dir", default=None,
+                        help="Directory to move converted XML files to (overrides 'backup_dir' in the config)")
+    parser.add_argument("--interval", dest="interval", type=int, default=None,
+                        help="Seconds between polls of the input dir (overrides 'interval' in the config)")
+    parser.add_argument("--workers", dest="workers", type=int, default=None,
+                        help="Max number of files to convert concurrently, the default is the number of CPUs")
+    parser.add_argument("--merge", dest="merge", action="store_true",
+                        help="When converting several files in stream or sharded mode, merge the output into a single file in input order")
+    parser.add_argument("-s", "--split", dest="split", action="store_true",
+                        help="Convert a single large file in parallel by splitting it at the 'mappe' elements below each 'arkivdel'")
 
     parser.add_argument("-c", "--config", dest='configfile',
                         help='Path to config yaml file', default="config/config.yaml")
@@ -47,10 +145,71 @@ def main():
                         help="Loglevel (INFO, DEBUG, WARN..), default is INFO", metavar="LOGLEVEL", default="INFO")
     parser.add_argument("-f", "--logfile", dest="logfile", default="noark5-to-rdf.log",
                         help="Filename to log to if logging to file, the default is 'noark5-to-rdf.log' in the current directory")
+    parser.add_argument("-m", "--output-mode", dest="output_mode", choices=OUTPUT_MODES, default=None,
+                        help="How to write the RDF: one file per subject (per-subject, the default), a single NTriples file (stream), rotating shard files (sharded) or straight into a triple store (store)")
+    parser.add_argument("-o", "--output-file", dest="output_file", default=None,
+                        help="File (or shard name prefix) to write to in stream and sharded mode, '-' means stdout. The default is derived from the input file name")
+    parser.add_argument("--shard-bytes", dest="shard_max_bytes", type=int, default=None,
+                        help="Start a new shard file when the current one exceeds this many bytes")
+    parser.add_argument("--shard-triples", dest="shard_max_triples", type=int, default=None,
+                        help="Start a new shard file when the current one exceeds this many triples")
+    parser.add_argument("--streaming", dest="streaming", action="store_true",
+                        help="Write the triples of a subject as soon as its id is known, to keep memory use low for very large records")
+    parser.add_argument("--utf8", dest="utf8_output", action="store_true",
+                        help="Write literals as UTF-8 (RDF 1.1 NTriples) instead of escaping everything but ASCII")
+    parser.add_argument("-p", "--parser", dest="parser", choices=["auto"] + PARSER_BACKENDS, default=None,
+                        help="The XML parser to use, the default (auto) picks the fastest one available")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default=None,
+                        help="The output format, default ntriples")
+    parser.add_argument("--compress", dest="output_compression", choices=OUTPUT_COMPRESSIONS, default=None,
+                        help="Compress the output files, default none")
+    parser.add_argument("--graph", dest="graph", default=None,
+                        help="The graph of the triples in nquads format and in the triple store")
+    parser.add_argument("--manifest", dest="manifest", default=None,
+                        help="Convert incrementally: only write subjects that are new or changed since the run recorded in this SQLite file, and list deleted ones")
+    parser.add_argument("--stable-ids", dest="stable_ids", action="store_true",
+                        help="Derive blank node labels and generated ids from the content, so the same input always gives the same output")
+    parser.add_argument("--store", dest="store_path", default=None,
+                        help="The triple store to load into in store mode, relative to the output dir (default triples.db)")
+    parser.add_argument("--store-backend", dest="store_backend", choices=STORE_BACKENDS, default=None,
+                        help="The kind of triple store: a built-in SQLite quad store (sqlite, the default) or a rdflib store plugin (rdflib)")
+    parser.add_argument("--validate", dest="validation_schema", nargs="+", default=None, metavar="RMIL",
+                        help="Check the subjects against the constraints of these RMIL files while converting, and write the violations to a JSON report. Exits with status 2 if there are violations")
+    parser.add_argument("--validation-report", dest="validation_report", default=None,
+                        help="The file to write the validation report to, relative to the output dir (default '<input name>-validation.json')")
+    parser.add_argument("--index", dest="subject_index", default=None, metavar="FILE",
+                        help="Record where the triples of every subject are written in this SQLite file, relative to the output dir (see noark5tordf-lookup)")
+    parser.add_argument("--id-index", dest="id_index", default=None, metavar="FILE",
+                        help="Map the ids of subjects to their URIs in this SQLite file, relative to the output dir, and resolve the references between subjects against it, across files and runs")
+    parser.add_argument("--verify-checksums", dest="verify_checksums", action="store_true",
+                        help="Check the document files of the dokumentobjekter against their checksum and size while converting, and write the mismatches to '<input name>-checksums.json' in the output dir")
+    parser.add_argument("--document-dir", dest="document_dir", default=None,
+                        help="The dir the document files (referanseDokumentfil) are relative to, the default is the dir of the input file")
+    parser.add_argument("--metrics", dest="metrics", nargs="?", const=True, default=None, metavar="FILE",
+                        help="Write counts and the time spent per phase and per element name as JSON, relative to the output dir (default '<input name>-metrics.json')")
+    parser.add_argument("--metrics-textfile", dest="metrics_textfile", default=None, metavar="FILE",
+                        help="Write the metrics in the Prometheus text format to this file, relative to the output dir")
+    parser.add_argument("--profile", dest="profile", nargs="?", const=True, default=None, metavar="FILE",
+                        help="Profile the conversion with cProfile and write the statistics to this file, relative to the output dir (default '<input name>.prof')")
 
     options = parser.parse_args()
 
-    config = readConfig(options.configfile, logfile=options.logfile, loglevel=options.loglevel, logger=logger)
+    if not options.inputfile and not options.watch:
+        parser.error("one of -i/--input or -w/--watch is required")
+
+    config = readConfig(options.configfile, logfile=options.logfile, loglevel=options.loglevel, logger=logger,
+                        input_dir=options.input_dir, backup_dir=options.backup_dir, interval=options.interval,
+                        output_mode=options.output_mode, output_file=options.output_file,
+                        shard_max_bytes=options.shard_max_bytes, shard_max_triples=options.shard_max_triples,
+                        streaming=options.streaming, utf8_output=options.utf8_output,
+                        parser=options.parser, output_format=options.output_format,
+                        output_compression=options.output_compression, graph=options.graph,
+                        manifest=options.manifest, stable_ids=options.stable_ids,
+                        store_path=options.store_path, store_backend=options.store_backend,
+                        validation_schema=options.validation_schema, validation_report=options.validation_report,
+                        metrics=options.metrics, metrics_textfile=options.metrics_textfile, profile=options.profile,
+                        subject_index=options.subject_index, id_index=options.id_index,
+                        verify_checksums=options.verify_checksums, document_dir=options.document_dir)
 
     logger.setLevel({"INFO":logging.INFO, "DEBUG":logging.DEBUG, "WARN":logging.WARNING, "ERROR":logging.ERROR}.get(config["loglevel"], logging.INFO))
     logger.debug("Config: \n%s" % str(config))
@@ -59,10 +218,39 @@ def main():
     file_handler.setFormatter(logging.Formatter(format_string))
     logger.addHandler(file_handler)
 
-    logger.info("Processing XML from " + options.inputfile)
+    if options.watch:
+        watch(config, workers=options.workers, once=options.once, logger=logger)
+        return
+
+    if options.split:
+        invalid = False
+        for inputfile in expandInputs(options.inputfile):
+            if isPlainFile(inputfile):
+                result = process_large_xml_file(config, inputfile, workers=options.workers, logger=logger)
+                invalid = invalid or bool(result.get("violations"))
+            else:
+                # Splitting needs to seek in the file
+                logger.warning("Can't split '%s', it is compressed or in a archive. Converting it as a whole" % inputfile)
+                sink = process_xml_file(config, inputfile, logger=logger)
+                invalid = invalid or bool(hasattr(sink, "getCounts") and sink.getCounts().get("violations"))
+        if invalid:
+            sys.exit(2)
+        return
+
+    if len(options.inputfile) > 1 or not os.path.isfile(options.inputfile[0]) or isArchive(options.inputfile[0]) or options.workers or options.merge:
+        stats = process_xml_files(config, options.inputfile, workers=options.workers, merge=options.merge, logger=logger)
+        if [s for s in stats if s["error"]]:
+            sys.exit(1)
+        if [s for s in stats if s.get("violations")]:
+            sys.exit(2)
+        return
+
+    logger.info("Processing XML from " + options.inputfile[0])
     logger.info("Writing RDF into " + config["output_dir"])
 
-    process_xml_file(config, options.inputfile, logger=logger)
+    sink = process_xml_file(config, options.inputfile[0], logger=logger)
+    if hasattr(sink, "getCounts") and sink.getCounts().get("violations"):
+        sys.exit(2)
 
 
 # Check if called from command line
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import xml.sax
+from xml.sax.handler import feature_namespaces
+from xml.parsers import expat
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from .utils import *
+
+# In order of preference when the parser is "auto"
+PARSER_BACKENDS = ["expat", "lxml", "sax"]
+
+# How much the expat parser reads from a file at a time, or takes from a memory mapped file
+READ_SIZE = 64 * 1024
+MAPPED_CHUNK_SIZE = 1024 * 1024
+
+
+def availableParsers():
+    """ Get the names of the parser backends that can be used here """
+    return [name for name in PARSER_BACKENDS if name != "lxml" or etree is not None]
+
+
+def getParser(name=None):
+    """ Get the parse function of a backend, "auto" (or None) picks the fastest one available """
+    if not name or name == "auto":
+        name = availableParsers()[0]
+
+    if name not in PARSER_BACKENDS:
+        raise ValueError("Unknown parser '%s', must be one of auto, %s" % (name, ", ".join(PARSER_BACKENDS)))
+
+    if name == "lxml" and etree is None:
+        raise ValueError("The lxml parser needs the lxml package, which is not installed")
+
+    return {"expat" : parseExpat, "lxml" : parseLxml, "sax" : parseSax}[name]
+
+
+def parseSax(handler, inputfile):
+    """ Parse a XML file (a path or a binary file-like object) with xml.sax, in namespace mode """
+    parser = xml.sax.make_parser()
+
+    # Turn on namespace support
+    parser.setFeature(feature_namespaces, 1)
+    parser.setContentHandler(handler)
+    parser.parse(inputfile)
+
+
+def _splitName(name):
+    """ Split a "uri local" name from expat into (uri, local), the way xml.sax does """
+    uri, sep, local = name.rpartition(" ")
+    return uri or None, local
+
+
+class _Locator:
+    """ Enough of a SAX locator to report parse errors as SAXParseException """
+    def __init__(self, line, column, name):
+        self._line = line
+        self._column = column
+        self._name = name
+
+    def getColumnNumber(self):
+        return self._column
+
+    def getLineNumber(self):
+        return self._line
+
+    def getPublicId(self):
+        return None
+
+    def getSystemId(self):
+        return self._name
+
+
+def parseExpat(handler, inputfile):
+    """
+    Parse a XML file (a path or a binary file-like object) with pyexpat directly, calling the
+    namespace-aware SAX methods of the handler. Text is buffered into larger chunks, and the
+    attributes are handed over as a tuple of (uri, local name, qname, value) tuples instead of
+    a AttributesNSImpl. The names and qnames are the same as xml.sax would give.
+    """
+    parser = expat.ParserCreate(namespace_separator=" ")
+    parser.buffer_text = True
+    parser.buffer_size = 64 * 1024
+    parser.ordered_attributes = True
+
+    names = {}
+    start = handler.startElementNS
+    end = handler.endElementNS
+
+    def startElement(name, attributes):
+        try:
+            pair = names[name]
+        except KeyError:
+            pair = names[name] = _splitName(name)
+
+        if attributes:
+            compact = []
+            for index in range(0, len(attributes), 2):
+                uri, local = _splitName(attributes[index])
+                compact.append((uri, local, local, attributes[index + 1]))
+            attributes = tuple(compact)
+        else:
+            attributes = ()
+
+        start(pair, None, attributes)
+
+    def endElement(name):
+        end(names[name], None)
+
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = handler.characters
+
+    if isinstance(inputfile, str):
+        infile = open(inputfile, "rb")
+        name = inputfile
+    else:
+        infile = inputfile
+        name = getattr(inputfile, "name", None)
+
+    handler.startDocument()
+    try:
+        if hasattr(infile, "getBuffer"):
+            # Feed a memory mapped file to expat in slices, without copying it
+            buffer = infile.getBuffer()
+            try:
+                for offset in range(0, len(buffer), MAPPED_CHUNK_SIZE):
+                    parser.Parse(buffer[offset:offset + MAPPED_CHUNK_SIZE], False)
+            finally:
+                buffer.release()
+        else:
+            # Larger reads than ParseFile() does
+            read = infile.read
+            data = read(READ_SIZE)
+            while data:
+                parser.Parse(data, False)
+                data = read(READ_SIZE)
+
+        parser.Parse(b"", True)
+    except expat.ExpatError as e:
+        raise xml.sax.SAXParseException(expat.ErrorString(e.code), e, _Locator(e.lineno, e.offset, name))
+    finally:
+        if infile is not inputfile:
+            infile.close()
+
+    handler.endDocument()
+
+
+def _splitTag(tag):
+    """ Split a "{uri}local" name from lxml into (uri, local) """
+    if tag[0] == "{":
+        uri, sep, local = tag[1:].partition("}")
+        return uri, local
+    return None, tag
+
+
+def parseLxml(handler, inputfile):
+    """
+    Parse a XML file (a path or a binary file-like object) with lxml's iterparse, calling the
+    namespace-aware SAX methods of the handler. Elements are cleared as soon as they end, so
+    only the open elements are kept in memory.
+    """
+    handler.startDocument()
+    try:
+        _iterparse(handler, inputfile)
+    except etree.XMLSyntaxError as e:
+        line, column = e.position
+        raise xml.sax.SAXParseException(e.msg, e, _Locator(line, column, getattr(inputfile, "name", inputfile)))
+
+    handler.endDocument()
+
+
+def _iterparse(handler, inputfile):
+    names = {}
+    start = handler.startElementNS
+    end = handler.endElementNS
+
+    for event, element in etree.iterparse(inputfile, events=("start", "end"), huge_tree=True):
+        tag = element.tag
+        if not isinstance(tag, str):
+            # Comments and processing instructions
+            continue
+
+        try:
+            pair = names[tag]
+        except KeyError:
+            pair = names[tag] = _splitTag(tag)
+
+        if event == "start":
+            attributes = element.attrib
+            if attributes:
+                attributes = tuple((uri, local, local, value) for (uri, local), value
+                                   in ((_splitTag(key), value) for key, value in attributes.items()))
+            else:
+                attributes = ()
+
+            start(pair, None, attributes)
+            continue
+
+        # The text of a element is only complete at its end, and only used for leaf elements
+        children = [child for child in element if isinstance(child.tag, str)]
+        if not children:
+            text = [element.text or ""] + [child.tail or "" for child in element]
+            handler.characters("".join(text))
+
+        end(pair, None)
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
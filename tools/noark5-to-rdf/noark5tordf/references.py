@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, re, glob, json, time, sqlite3
+
+from .utils import *
+from .inputs import getInputBasename
+
+# How many keys and references a conversion writes to its shard in one transaction
+REFERENCE_BATCH_SIZE = 10000
+
+# Literal objects of NTriples lines, with a datatype or language or neither
+_literal_object = r' "((?:[^"\\]|\\.)*)"(?:\^\^<[^>]*>|@[\w-]+)?\.$'
+
+
+def _createTables(db, shard=False):
+    if shard:
+        db.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT NOT NULL, subject TEXT NOT NULL, type TEXT, file TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS refs (source TEXT NOT NULL, predicate TEXT NOT NULL, key TEXT NOT NULL, file TEXT)")
+        return
+
+    db.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, subject TEXT NOT NULL, type TEXT, file TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS refs (source TEXT NOT NULL, predicate TEXT NOT NULL, key TEXT NOT NULL, "
+               "file TEXT, UNIQUE (source, predicate, key))")
+    db.execute("CREATE INDEX IF NOT EXISTS refs_key ON refs (key)")
+
+
+class IdShard:
+    """
+    The keys and references found by the conversions of one process, written in large batches to a
+    SQLite file of its own so the processes of a run don't wait for each other. The shards are
+    merged into the IdIndex when the run is finished
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=600)
+        # A shard is thrown away if the conversion fails anyway
+        self._db.execute("PRAGMA synchronous=OFF")
+        with self._db:
+            _createTables(self._db, shard=True)
+        self._keys = []
+        self._refs = []
+
+    def addKey(self, key, subject, type, file):
+        self._keys.append((key, subject, type, file))
+        if len(self._keys) >= REFERENCE_BATCH_SIZE:
+            self.flush()
+
+    def addReference(self, source, predicate, key, file):
+        self._refs.append((source, predicate, key, file))
+        if len(self._refs) >= REFERENCE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        with self._db:
+            self._db.executemany("INSERT INTO keys (key, subject, type, file) VALUES (?, ?, ?, ?)", self._keys)
+            self._db.executemany("INSERT INTO refs (source, predicate, key, file) VALUES (?, ?, ?, ?)", self._refs)
+        self._keys = []
+        self._refs = []
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+class IdIndex:
+    """
+    A SQLite database that maps the natural keys of subjects (their ids, e.g. systemIDs) to their
+    subject URIs, and keeps the references between subjects (the elements listed in "references"
+    in the config) whose keys are not known yet. It outlives a run, so references to subjects of
+    earlier or later deliveries are resolved too. The first subject of a key is the canonical one,
+    other subjects with the same key are conflicts.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            _createTables(self._db)
+            self._db.execute("CREATE TEMP TABLE current (source TEXT, predicate TEXT, key TEXT, file TEXT)")
+        self.conflicts = []
+
+    def merge(self, shard_path):
+        """ Add the keys of a shard, and keep its references for resolve() """
+        self._db.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+        try:
+            with self._db:
+                self._db.execute("INSERT OR IGNORE INTO main.keys (key, subject, type, file) "
+                                 "SELECT key, subject, type, file FROM shard.keys ORDER BY rowid")
+                self.conflicts.extend(self._db.execute(
+                    "SELECT DISTINCT other.key, known.subject, other.subject, other.file FROM shard.keys AS other "
+                    "JOIN main.keys AS known ON known.key = other.key WHERE known.subject != other.subject").fetchall())
+                self._db.execute("INSERT INTO temp.current SELECT source, predicate, key, file FROM shard.refs")
+        finally:
+            self._db.execute("DETACH DATABASE shard")
+
+    def getSubject(self, key):
+        """ Get the canonical subject of a key, or None """
+        row = self._db.execute("SELECT subject FROM keys WHERE key = ?", (key,)).fetchone()
+        return row and row[0] or None
+
+    def resolve(self):
+        """
+        Resolve the references of the merged shards and the ones left over from earlier runs, in a
+        single join. Returns the (source, predicate, target subject) of the resolved references.
+        The others are kept for later runs, see getDangling()
+        """
+        with self._db:
+            links = self._db.execute(
+                "SELECT DISTINCT refs.source, refs.predicate, keys.subject FROM "
+                "(SELECT source, predicate, key FROM temp.current UNION SELECT source, predicate, key FROM refs) AS refs "
+                "JOIN keys ON keys.key = refs.key ORDER BY 1, 2, 3").fetchall()
+            self._db.execute("INSERT OR IGNORE INTO refs (source, predicate, key, file) SELECT source, predicate, key, file FROM temp.current")
+            self._db.execute("DELETE FROM refs WHERE key IN (SELECT key FROM keys)")
+            self._db.execute("DELETE FROM temp.current")
+        return links
+
+    def getDangling(self, limit=None):
+        """ Get the (source, predicate, key, file) of the references to keys that are not known (yet) """
+        sql = "SELECT source, predicate, key, file FROM refs ORDER BY key, source, predicate"
+        if limit is not None:
+            sql = sql + " LIMIT %d" % limit
+        return self._db.execute(sql).fetchall()
+
+    def countDangling(self):
+        return self._db.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+def getIdIndexPath(config):
+    """ Get the path of the id index of the config, relative paths are in the output dir """
+    path = config.get("id_index")
+    if path and not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+def getShardPath(config):
+    """
+    Get the shard of the id index that this process writes to. The processes of a larger run
+    ("references_collect" is the name of the run) write to shards named after the run
+    """
+    shard_dir = getIdIndexPath(config) + ".shards"
+    assertDir(shard_dir)
+    run = config.get("references_collect")
+    if run:
+        return os.path.join(shard_dir, "%s-%s.db" % (run, os.getpid()))
+    return os.path.join(shard_dir, "%s.db" % os.getpid())
+
+
+def collectReferences(config):
+    """ Get a config for the processes of a larger run, whose shards are merged by finishReferences() at the end """
+    return dict(config, references_collect="run%s-%s" % (os.getpid(), int(time.time() * 1000)))
+
+
+def _getOutputPath(config, key, inputfile, suffix):
+    path = config.get(key)
+    if not path:
+        name = inputfile and getInputBasename(inputfile) or "output"
+        if name.endswith(".xml"):
+            name = name[:-4]
+        path = name + suffix
+
+    if not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+def getReferencePaths(config, inputfile=None):
+    """
+    Get the NTriples file the resolved references are written to ("reference_output" or
+    "<input name>-references.nt") and the JSON report of dangling references ("reference_report"
+    or "<input name>-references.json"), both relative to the output dir
+    """
+    return (_getOutputPath(config, "reference_output", inputfile, "-references.nt"),
+            _getOutputPath(config, "reference_report", inputfile, "-references.json"))
+
+
+def finishReferences(config, inputfile=None, shards=None, logger=None):
+    """
+    Merge the shards (default: the shards of the run, see collectReferences()) into the id index,
+    resolve the references and write the links to the subjects they refer to as NTriples, and a
+    report of the dangling references and conflicting keys as JSON. Returns the number of
+    references, resolved ones, dangling ones and conflicts
+    """
+    path = getIdIndexPath(config)
+    if shards is None:
+        shards = sorted(glob.glob(os.path.join(path + ".shards", "%s-*.db" % config["references_collect"])))
+
+    index = IdIndex(path)
+    try:
+        for shard in shards:
+            index.merge(shard)
+        references = index._db.execute("SELECT COUNT(*) FROM temp.current").fetchone()[0]
+        links = index.resolve()
+        max_details = config.get("reference_max_details")
+        dangling = index.getDangling(max_details)
+        counts = {"references": references, "resolved": len(links), "dangling": index.countDangling(),
+                  "conflicting_keys": len(index.conflicts)}
+        conflicts = index.conflicts[:max_details]
+    finally:
+        index.close()
+
+    # Merged shards are done with
+    for shard in shards:
+        os.remove(shard)
+
+    output_file, report_file = getReferencePaths(config, inputfile)
+    with open(output_file, "w", encoding="utf-8") as output:
+        for source, predicate, target in links:
+            output.write("%s <%s> %s.\n" % (source, predicate, target))
+
+    report = dict(input=inputfile, index=path, **counts)
+    report["details"] = [{"source": source, "predicate": predicate, "key": key, "file": file} for source, predicate, key, file in dangling]
+    report["conflicts"] = [{"key": key, "subject": subject, "other": other, "file": file} for key, subject, other, file in conflicts]
+    with open(report_file, "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=2, ensure_ascii=False)
+
+    if logger:
+        logger.info("Found %s references, linked %s to their subjects, %s are dangling (see '%s'), %s conflicting keys" % (
+            counts["references"], counts["resolved"], counts["dangling"], report_file, counts["conflicting_keys"]))
+
+    return counts
+
+
+def getReferencePattern(config):
+    """ Compile a regular expression for the NTriples lines of the "references" elements of the config """
+    names = config.get("references") or []
+    if not names:
+        return None
+    return re.compile(r'^\S+ <([^>]*[/#](?:%s))>%s' % ("|".join(re.escape(name) for name in names), _literal_object), re.MULTILINE)
+
+
+class _ReferenceWriter:
+    """ Passes the triples of a subject on, and picks out its key and references """
+    __slots__ = ["_sink", "_entity", "_writer", "_references"]
+
+    def __init__(self, sink, entity, writer):
+        self._sink = sink
+        self._entity = entity
+        self._writer = writer
+        self._references = []
+
+    def write(self, data):
+        self._writer.write(data)
+        pattern = self._sink._pattern
+        if pattern is not None and "\"" in data:
+            for match in pattern.finditer(data):
+                self._references.append((match.group(1), unescape_literal(match.group(2))))
+
+    def close(self):
+        self._writer.close()
+        self._sink._addSubject(self._entity, self._references)
+        self._references = None
+
+
+class ReferenceSink:
+    """
+    Wraps a sink, and records the key (id) of every subject written to it and the references it
+    has (see the "references" config) in the shard of this process (see IdShard). References to
+    subjects in blank nodes are recorded for the subject that has the blank node. Unless the
+    conversion is part of a larger run ("references_collect"), the references are resolved when
+    the sink is closed.
+    """
+    def __init__(self, config, sink, inputfile=None, logger=None):
+        self._config = config
+        self._sink = sink
+        self._inputfile = inputfile
+        self._logger = logger
+        self._pattern = getReferencePattern(config)
+        self._shard = IdShard(getShardPath(config))
+        self.references = 0
+        self.counts = {}
+
+    def __getattr__(self, name):
+        # The counts, file names etc. of the wrapped sink
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._sink, name)
+
+    def _addSubject(self, entity, references):
+        subject = entity.getSubject()
+        key = entity.getId()
+        if key is not None:
+            self._shard.addKey(key, subject, entity.getTypePredicate(), self._inputfile)
+
+        for predicate, key in references:
+            self._shard.addReference(subject, predicate, key, self._inputfile)
+        self.references = self.references + len(references)
+
+    def openSubject(self, entity):
+        return _ReferenceWriter(self, entity, self._sink.openSubject(entity))
+
+    def writeSubject(self, entity, data):
+        writer = self.openSubject(entity)
+        writer.write(data)
+        writer.close()
+
+    def getFilenames(self):
+        return self._sink.getFilenames()
+
+    def getCounts(self):
+        """ Get the counts of the wrapped sink (if any) and the number of references """
+        counts = {}
+        if hasattr(self._sink, "getCounts"):
+            counts.update(self._sink.getCounts())
+        counts["references"] = self.references
+        if self.counts:
+            counts["dangling"] = self.counts["dangling"]
+        return counts
+
+    def close(self):
+        if self._shard is None:
+            return
+
+        try:
+            self._sink.close()
+        finally:
+            self._shard.close()
+
+        if not self._config.get("references_collect"):
+            self.counts = finishReferences(self._config, self._inputfile, [self._shard.path], logger=self._logger)
+        self._shard = None
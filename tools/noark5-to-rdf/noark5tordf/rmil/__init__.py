@@ -0,0 +1,3 @@
+from .parser import RmilError, PropertyConstraint, RmilClass, RmilInstance, Schema, parseRmil, readRmil, XSD
+from .emitter import VOCABULARIES, generateTriples, writeNTriples, writeTurtle, parseSchemaTriples
+from .cache import compileSchema, loadCompiled, writeCache, readCache, readSchema, loadSchema, getCachePath
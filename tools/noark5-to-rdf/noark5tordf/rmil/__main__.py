@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, argparse
+
+from .parser import RmilError
+from .emitter import VOCABULARIES, writeNTriples, writeTurtle
+from .cache import readSchema, writeCache, getSourceKey
+
+
+def main(args=None):
+    """ Convert RMIL files to NTriples or Turtle, or compile them into a cache file """
+    parser = argparse.ArgumentParser(description="Convert RMIL schemas to RDF")
+    parser.add_argument("inputfiles", nargs="+", metavar="SCHEMA",
+                        help="RMIL files (or NTriples files ending with .nt) to read, as one schema")
+    parser.add_argument("-o", "--output", dest="outputfile", default=None,
+                        help="File to write to, the default is stdout")
+    parser.add_argument("--format", dest="format", choices=["nt", "ttl"], default="nt",
+                        help="Write NTriples (nt, the default) or Turtle (ttl)")
+    parser.add_argument("--vocabulary", dest="vocabulary", choices=sorted(VOCABULARIES), default="rmil",
+                        help="The constraint vocabulary, 'rmil' (like rdf/*.nt, the default) or 'rdfcl'")
+    parser.add_argument("--compile", dest="compiled", default=None, metavar="CACHEFILE",
+                        help="Write the compiled schema (with its subclass closure) to CACHEFILE instead")
+
+    options = parser.parse_args(args)
+
+    try:
+        schema = readSchema(options.inputfiles)
+    except (RmilError, OSError) as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+    if options.compiled:
+        schema.buildClosure()
+        writeCache(schema, options.compiled, getSourceKey(options.inputfiles))
+        return 0
+
+    write = writeTurtle if options.format == "ttl" else writeNTriples
+    if options.outputfile:
+        with open(options.outputfile, "w", encoding="utf-8") as output:
+            write(schema, output, options.vocabulary)
+    else:
+        write(schema, sys.stdout, options.vocabulary)
+    return 0
+
+
+# Check if called from command line
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, sys, marshal, hashlib
+
+from .parser import RmilError, Schema, RmilClass, RmilInstance, PropertyConstraint, readRmil
+from .emitter import parseSchemaTriples
+
+# A cache file is the magic, a 16 byte key of the source files and the marshalled schema.
+# marshal is only readable by the Python version that wrote it, so the version is in the key
+CACHE_MAGIC = b"RMILC\x01"
+_KEY_SIZE = 16
+
+
+def getSourceKey(paths):
+    """ A key of the source files (their paths, sizes and modification times) and the Python version """
+    parts = [sys.implementation.cache_tag or sys.version]
+    for path in paths:
+        stat = os.stat(path)
+        parts.append("%s %s %s" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return hashlib.blake2b("\n".join(parts).encode("utf-8"), digest_size=_KEY_SIZE).digest()
+
+
+def getCachePath(paths, cache_dir=None):
+    """ Get the cache file of a list of schema files, in "cache_dir" or the user's cache dir """
+    if not cache_dir:
+        cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "noark5tordf")
+    name = hashlib.blake2b("\n".join(os.path.abspath(path) for path in paths).encode("utf-8"), digest_size=8).hexdigest()
+    return os.path.join(cache_dir, "rmil-%s.bin" % name)
+
+
+def compileSchema(schema):
+    """ Turn a schema, with its subclass closure, into plain tuples and dicts that marshal can write """
+    if schema._ancestors is None:
+        schema.buildClosure()
+
+    classes = tuple((c.iri, c.name, tuple(c.superclasses),
+                     tuple((p.name, p.iri, tuple(p.ranges), p.min, p.max, None if p.values is None else tuple(p.values))
+                           for p in c.properties))
+                    for c in schema.classes.values())
+    instances = tuple((i.iri, i.name, tuple(i.classes), i.values, i.links) for i in schema.instances.values())
+
+    return (dict(schema.prefixes), schema.default_prefix, tuple(schema.sources), classes, instances,
+            schema._ancestors, schema._descendants)
+
+
+def loadCompiled(compiled):
+    """ Turn the result of compileSchema() back into a Schema """
+    prefixes, default_prefix, sources, classes, instances, ancestors, descendants = compiled
+
+    schema = Schema()
+    schema.prefixes = prefixes
+    schema.default_prefix = default_prefix
+    schema.sources = list(sources)
+
+    for iri, name, superclasses, properties in classes:
+        rmil_class = schema.classes[iri] = RmilClass(iri, name, list(superclasses))
+        rmil_class.properties = [PropertyConstraint(p_name, p_iri, list(ranges), min, max, None if values is None else list(values))
+                                 for p_name, p_iri, ranges, min, max, values in properties]
+
+    for iri, name, classes, values, links in instances:
+        instance = schema.instances[iri] = RmilInstance(iri, name, list(classes))
+        instance.values = values
+        instance.links = links
+
+    schema.setClosure(ancestors, descendants)
+    return schema
+
+
+def writeCache(schema, filename, key=b""):
+    """ Write the compiled schema to "filename" (atomically, several processes may do it at once) """
+    key = key.ljust(_KEY_SIZE, b"\0")[:_KEY_SIZE]
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temp = "%s.%s.tmp" % (filename, os.getpid())
+    with open(temp, "wb") as output:
+        output.write(CACHE_MAGIC + key)
+        output.write(marshal.dumps(compileSchema(schema)))
+    os.replace(temp, filename)
+    return filename
+
+
+def readCache(filename, key=None):
+    """ Read a compiled schema, or return None if there is none (or it is not for "key") """
+    try:
+        with open(filename, "rb") as infile:
+            data = infile.read()
+    except OSError:
+        return None
+
+    if not data.startswith(CACHE_MAGIC):
+        return None
+    if key is not None and data[len(CACHE_MAGIC):len(CACHE_MAGIC) + _KEY_SIZE] != key.ljust(_KEY_SIZE, b"\0")[:_KEY_SIZE]:
+        return None
+
+    try:
+        return loadCompiled(marshal.loads(data[len(CACHE_MAGIC) + _KEY_SIZE:]))
+    except (ValueError, EOFError, TypeError):
+        return None
+
+
+def readSchema(paths):
+    """ Read schema files into a Schema: RMIL, or the NTriples form (files ending with .nt) """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    schema = None
+    for path in paths:
+        if path.endswith(".nt"):
+            with open(path, encoding="utf-8") as infile:
+                try:
+                    schema = parseSchemaTriples(infile, schema)
+                except ValueError as e:
+                    raise RmilError("%s: %s" % (path, e))
+            schema.sources.append(path)
+        else:
+            schema = readRmil(path, schema)
+
+    return schema
+
+
+def loadSchema(paths, cache_dir=None, cache=True):
+    """
+    Load schema files (see readSchema) through the compiled cache: the cache is used if the
+    files have not changed since it was written, or else the files are read and the cache is
+    (re)written. A cache that can't be written is skipped
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    if not cache:
+        schema = readSchema(paths)
+        schema.buildClosure()
+        return schema
+
+    key = getSourceKey(paths)
+    filename = getCachePath(paths, cache_dir)
+
+    schema = readCache(filename, key)
+    if schema is not None:
+        return schema
+
+    schema = readSchema(paths)
+    schema.buildClosure()
+    try:
+        writeCache(schema, filename, key)
+    except OSError:
+        pass
+
+    return schema
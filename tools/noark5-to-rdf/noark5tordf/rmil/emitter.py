@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re, hashlib
+
+from ..utils import escape_literal, unescape_literal
+from .parser import Schema, RmilClass, RmilInstance, PropertyConstraint, XSD
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+RDFS = "http://www.w3.org/2000/01/rdf-schema#"
+
+# The constraint vocabularies of the ontologies in the repository: "rmil" has a single
+# ClassPropertyConstraint with both cardinalities (rdf/*.nt), "rdfcl" has separate min and
+# max constraints (continuous-delivery/validation/noark5-schema.nt)
+VOCABULARIES = {"rmil": "http://data.bouvet.no/rmil/", "rdfcl": "http://data.sesam.io/validation/rdfcl/"}
+
+_turtle_local = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_-]*$")
+_line_pattern = re.compile(r'^(<[^>]*>) (<[^>]*>) (<[^>]*>|"(?:[^"\\]|\\.)*"\S*) ?\.$')
+
+
+def _iri(iri):
+    return "<%s>" % iri
+
+
+def _literal(value):
+    return '"%s"' % escape_literal(str(value))
+
+
+def _constraintId(vocabulary, rmil_class, constraint, index, kind):
+    # Stable ids, so the same schema always gives the same triples
+    key = "%s %s %s %s" % (rmil_class.iri, constraint.iri, index, kind)
+    return vocabulary + hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def generateTriples(schema, vocabulary="rmil"):
+    """
+    Generate the triples of the RDF form of a schema, as (subject, predicate, object) tuples of
+    terms in NTriples syntax. Every triple is generated once, in the order of the RMIL source
+    """
+    if vocabulary not in VOCABULARIES:
+        raise ValueError("Unknown vocabulary '%s', must be one of %s" % (vocabulary, ", ".join(sorted(VOCABULARIES))))
+
+    voc = VOCABULARIES[vocabulary]
+    rdf_type = _iri(RDF + "type")
+    seen = set()
+    declared = set()
+    properties = []
+
+    def triple(subject, predicate, object):
+        key = (subject, predicate, object)
+        if key not in seen:
+            seen.add(key)
+            return [key]
+        return []
+
+    def declareClass(iri, kind="Class"):
+        declared.add(iri)
+        return triple(_iri(iri), rdf_type, _iri(voc + kind)) + triple(_iri(iri), rdf_type, _iri(RDFS + kind))
+
+    def constraintNode(node, kind, rmil_class, constraint):
+        triples = triple(node, rdf_type, _iri(voc + kind))
+        triples += triple(node, _iri(voc + "applies-to-type"), _iri(rmil_class.iri))
+        triples += triple(node, _iri(voc + "applies-to-propertytype"), _iri(constraint.iri))
+        for range in constraint.ranges:
+            triples += triple(node, _iri(voc + "valuetype"), _iri(range))
+        return triples
+
+    for iri in [voc + "Class", RDFS + "Class", RDFS + "PropertyClass", voc + "PropertyClass"]:
+        for triple_ in declareClass(iri):
+            yield triple_
+
+    for rmil_class in schema.classes.values():
+        triples = declareClass(rmil_class.iri)
+        for superclass in rmil_class.superclasses:
+            triples += triple(_iri(rmil_class.iri), _iri(RDFS + "subClassOf"), _iri(superclass))
+
+        for index, constraint in enumerate(rmil_class.properties):
+            if constraint.iri not in properties:
+                properties.append(constraint.iri)
+
+            max = "*" if constraint.max is None else constraint.max
+            if vocabulary == "rmil":
+                node = _iri(_constraintId(voc, rmil_class, constraint, index, "ClassPropertyConstraint"))
+                triples += constraintNode(node, "ClassPropertyConstraint", rmil_class, constraint)
+                triples += triple(node, _iri(voc + "mincard"), _literal(constraint.min))
+                triples += triple(node, _iri(voc + "maxcard"), _literal(max))
+            else:
+                node = _iri(_constraintId(voc, rmil_class, constraint, index, "MinCardClassPropertyConstraint"))
+                triples += constraintNode(node, "MinCardClassPropertyConstraint", rmil_class, constraint)
+                triples += triple(node, _iri(voc + "mincard"), _literal(constraint.min))
+                max_node = _iri(_constraintId(voc, rmil_class, constraint, index, "MaxCardClassPropertyConstraint"))
+                triples += constraintNode(max_node, "MaxCardClassPropertyConstraint", rmil_class, constraint)
+                triples += triple(max_node, _iri(voc + "maxcard"), _literal(max))
+
+            for value in constraint.values or []:
+                triples += triple(node, _iri(voc + "allowed-value"), _literal(value))
+
+            triples += triple(_iri(constraint.iri), _iri(RDFS + "domain"), _iri(rmil_class.iri))
+            for range in constraint.ranges:
+                triples += triple(_iri(constraint.iri), _iri(RDFS + "range"), _iri(range))
+
+        # The value types are classes too
+        for constraint in rmil_class.properties:
+            for range in constraint.ranges:
+                if range not in declared:
+                    triples += declareClass(range)
+
+        for triple_ in triples:
+            yield triple_
+
+    for iri in properties:
+        for triple_ in declareClass(iri, "PropertyClass"):
+            yield triple_
+
+    for instance in schema.instances.values():
+        for iri in instance.classes:
+            for triple_ in triple(_iri(instance.iri), rdf_type, _iri(iri)):
+                yield triple_
+        for predicate, values in instance.values.items():
+            for value in values:
+                for triple_ in triple(_iri(instance.iri), _iri(predicate), _literal(value)):
+                    yield triple_
+        for predicate, links in instance.links.items():
+            for link in links:
+                for triple_ in triple(_iri(instance.iri), _iri(predicate), _iri(link)):
+                    yield triple_
+
+
+def writeNTriples(schema, output, vocabulary="rmil"):
+    """ Write the RDF form of a schema as NTriples to "output" (a text stream), like the ontologies in rdf/ """
+    count = 0
+    for subject, predicate, object in generateTriples(schema, vocabulary):
+        output.write("%s %s %s .\n" % (subject, predicate, object))
+        count = count + 1
+    return count
+
+
+def writeTurtle(schema, output, vocabulary="rmil"):
+    """ Write the RDF form of a schema as Turtle to "output" (a text stream), grouped by subject """
+    prefixes = [("rdf", RDF), ("rdfs", RDFS), ("xsd", XSD), (vocabulary, VOCABULARIES[vocabulary])]
+    names = set(name for name, iri in prefixes)
+    for name, iri in sorted(schema.prefixes.items()):
+        if name not in names and iri not in [p[1] for p in prefixes]:
+            prefixes.append((name, iri))
+            names.add(name)
+    if schema.default_prefix and schema.default_prefix not in [p[1] for p in prefixes]:
+        prefixes.append(("", schema.default_prefix))
+
+    # The longest namespace that matches wins
+    by_length = sorted(prefixes, key=lambda prefix: -len(prefix[1]))
+
+    def shorten(term):
+        if not term.startswith("<"):
+            return term
+        iri = term[1:-1]
+        if iri == RDF + "type":
+            return "a"
+        for name, namespace in by_length:
+            if iri.startswith(namespace) and _turtle_local.match(iri[len(namespace):]):
+                return "%s:%s" % (name, iri[len(namespace):])
+        return term
+
+    for name, iri in prefixes:
+        output.write("@prefix %s: <%s> .\n" % (name, iri))
+
+    grouped = {}
+    for subject, predicate, object in generateTriples(schema, vocabulary):
+        grouped.setdefault(subject, {}).setdefault(predicate, []).append(object)
+
+    count = 0
+    for subject, predicates in grouped.items():
+        output.write("\n%s" % shorten(subject))
+        separator = " "
+        for predicate, objects in predicates.items():
+            output.write("%s%s %s" % (separator, shorten(predicate), ", ".join(shorten(o) for o in objects)))
+            separator = " ;\n    "
+            count = count + len(objects)
+        output.write(" .\n")
+
+    return count
+
+
+def _localName(iri):
+    return re.split(r"[/#]", iri)[-1]
+
+
+def parseSchemaTriples(lines, schema=None):
+    """
+    Read the RDF form of a schema (NTriples lines, in either vocabulary) back into a Schema, e.g.
+    to use the ontologies in rdf/ for validation
+    """
+    if schema is None:
+        schema = Schema()
+
+    rdf_type = RDF + "type"
+    nodes = {}
+    other = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = _line_pattern.match(line)
+        if match is None:
+            raise ValueError("Line %s: not a NTriples line: %r" % (lineno, line))
+
+        subject, predicate, object = match.group(1)[1:-1], match.group(2)[1:-1], match.group(3)
+        for voc in VOCABULARIES.values():
+            if predicate.startswith(voc) or (predicate == rdf_type and object.startswith("<" + voc) and "Constraint" in object):
+                nodes.setdefault(subject, {}).setdefault(predicate[len(voc):] if predicate != rdf_type else "type", []).append(object)
+                break
+        else:
+            other.append((subject, predicate, object))
+
+    class_types = set(voc + "Class" for voc in VOCABULARIES.values())
+    for subject, predicate, object in other:
+        if predicate == rdf_type and object[1:-1] in class_types and subject not in schema.classes:
+            schema.classes[subject] = RmilClass(subject, _localName(subject))
+    for subject, predicate, object in other:
+        if predicate == RDFS + "subClassOf" and subject in schema.classes:
+            schema.classes[subject].superclasses.append(object[1:-1])
+
+    # A constraint is a node with both cardinalities, or a min and a max node of the same property
+    constraints = {}
+    for node, values in nodes.items():
+        if "applies-to-type" not in values or "applies-to-propertytype" not in values:
+            continue
+        key = (values["applies-to-type"][0][1:-1], values["applies-to-propertytype"][0][1:-1])
+        constraint = constraints.get(key)
+        if constraint is None:
+            ranges = [term[1:-1] for term in values.get("valuetype", [])]
+            constraint = constraints[key] = PropertyConstraint(_localName(key[1]), key[1], ranges)
+            rmil_class = schema.classes.get(key[0])
+            if rmil_class is None:
+                rmil_class = schema.classes[key[0]] = RmilClass(key[0], _localName(key[0]))
+            rmil_class.properties.append(constraint)
+        if "mincard" in values:
+            constraint.min = int(unescape_literal(values["mincard"][0][1:-1]))
+        if "maxcard" in values:
+            max = unescape_literal(values["maxcard"][0][1:-1])
+            constraint.max = None if max == "*" else int(max)
+        if "allowed-value" in values:
+            constraint.values = [unescape_literal(term[1:-1]) for term in values["allowed-value"]]
+
+    # Everything else is about instances (the properties themselves can be instances too)
+    meta = set([RDFS + "Class", RDFS + "PropertyClass"])
+    for voc in VOCABULARIES.values():
+        meta.update([voc + "Class", voc + "PropertyClass"])
+
+    for subject, predicate, object in other:
+        if subject in schema.classes or predicate in [RDFS + "domain", RDFS + "range", RDFS + "subClassOf"]:
+            continue
+        if predicate == rdf_type and object[1:-1] in meta:
+            continue
+        instance = schema.instances.get(subject)
+        if instance is None:
+            instance = schema.instances[subject] = RmilInstance(subject, _localName(subject))
+        if predicate == rdf_type:
+            instance.classes.append(object[1:-1])
+        elif object.startswith("<"):
+            instance.links.setdefault(predicate, []).append(object[1:-1])
+        else:
+            instance.values.setdefault(predicate, []).append(unescape_literal(object[1:object.rindex('"')]))
+
+    schema.setClosure(None, None)
+    return schema
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+# Quoted strings, the brackets of enumerations, "||" between alternative ranges and names
+_token_pattern = re.compile(r'"(?:[^"\\]|\\.)*"|\[|\]|\|\||,|[^\s\[\],"|]+')
+_cardinality_pattern = re.compile(r"^(\d+|\*)$")
+
+
+class RmilError(Exception):
+    pass
+
+
+class PropertyConstraint:
+    """
+    A property of a class: the allowed ranges (class or datatype URIs, several when separated by
+    "||"), the min and max number of values (max is None for "*") and the allowed values
+    """
+    def __init__(self, name, iri, ranges, min=0, max=None, values=None):
+        self.name = name
+        self.iri = iri
+        self.ranges = ranges
+        self.min = min
+        self.max = max
+        self.values = values
+
+    def __repr__(self):
+        return "PropertyConstraint(%r, %r, %s..%s)" % (self.name, self.ranges, self.min, "*" if self.max is None else self.max)
+
+
+class RmilClass:
+    """ A class of a RMIL schema, with the URIs of its superclasses and its own (not inherited) properties """
+    def __init__(self, iri, name, superclasses=None):
+        self.iri = iri
+        self.name = name
+        self.superclasses = superclasses or []
+        self.properties = []
+
+
+class RmilInstance:
+    """
+    A instance (usually a vocabulary value) with its classes, its literal property values and
+    the URIs it links to (dicts of property URI to a list of strings)
+    """
+    def __init__(self, iri, name, classes=None):
+        self.iri = iri
+        self.name = name
+        self.classes = classes or []
+        self.values = {}
+        self.links = {}
+
+
+class Schema:
+    """ The classes and instances of one or more RMIL files, by URI """
+    def __init__(self):
+        self.prefixes = {"xsd": XSD}
+        self.default_prefix = ""
+        self.classes = {}
+        self.instances = {}
+        self.sources = []
+        self._ancestors = None
+        self._descendants = None
+
+    def expand(self, name):
+        """ Expand a (possibly prefixed) name into a URI, using the prefixes seen so far """
+        prefix, sep, local = name.partition(":")
+        if sep and prefix in self.prefixes:
+            return self.prefixes[prefix] + local
+        return self.default_prefix + name
+
+    def getClass(self, iri):
+        return self.classes.get(iri)
+
+    def getInstancesOf(self, iri):
+        """ Get the instances that are declared to be of the class """
+        return [instance for instance in self.instances.values() if iri in instance.classes]
+
+    def _walkAncestors(self, iri):
+        ancestors = [iri]
+        pos = 0
+        while pos < len(ancestors):
+            rmil_class = self.classes.get(ancestors[pos])
+            pos = pos + 1
+            if rmil_class is None:
+                continue
+            for superclass in rmil_class.superclasses:
+                if superclass not in ancestors:
+                    ancestors.append(superclass)
+
+        return ancestors
+
+    def buildClosure(self):
+        """
+        Precompute the subclass closure: the superclasses and subclasses (direct or not) of every
+        class. It is rebuilt when classes are added
+        """
+        self._ancestors = {}
+        self._descendants = {}
+        for iri in self.classes:
+            ancestors = self._ancestors[iri] = tuple(self._walkAncestors(iri))
+            for ancestor in ancestors:
+                self._descendants.setdefault(ancestor, []).append(iri)
+
+        self._descendants = dict((iri, tuple(descendants)) for iri, descendants in self._descendants.items())
+
+    def setClosure(self, ancestors, descendants):
+        """ Use a subclass closure computed earlier (see buildClosure and cache.py) """
+        self._ancestors = ancestors
+        self._descendants = descendants
+
+    def getAncestors(self, iri):
+        """ Get the URIs of a class and all of its superclasses, the class first """
+        if self._ancestors is None:
+            self.buildClosure()
+        return list(self._ancestors.get(iri) or (iri,))
+
+    def getDescendants(self, iri):
+        """ Get the URIs of a class and all of its subclasses, the class first """
+        if self._descendants is None:
+            self.buildClosure()
+        return list(self._descendants.get(iri) or (iri,))
+
+    def isSubclass(self, iri, superclass):
+        """ Checks if the class "iri" is "superclass" or a (direct or not) subclass of it """
+        return superclass in self.getAncestors(iri)
+
+    def getProperties(self, iri):
+        """ Get the property constraints of a class, including the inherited ones """
+        properties = []
+        for ancestor in self.getAncestors(iri):
+            rmil_class = self.classes.get(ancestor)
+            if rmil_class is not None:
+                properties.extend(rmil_class.properties)
+        return properties
+
+
+def _tokenize(line):
+    return _token_pattern.findall(line)
+
+
+def _unquote(token):
+    if token.startswith('"'):
+        return re.sub(r"\\(.)", r"\1", token[1:-1])
+    return token
+
+
+def _addNew(items, new):
+    # A class or instance can be declared more than once
+    for item in new:
+        if item not in items:
+            items.append(item)
+
+
+def _parseCardinality(token, lineno):
+    if token == "*":
+        return None
+    try:
+        return int(token)
+    except ValueError:
+        raise RmilError("Line %s: '%s' is not a cardinality" % (lineno, token))
+
+
+def _parseProperty(schema, tokens, lineno):
+    ranges = [schema.expand(tokens[0])]
+    pos = 1
+    while pos + 2 < len(tokens) and tokens[pos] == "||":
+        ranges.append(schema.expand(tokens[pos + 1]))
+        pos = pos + 2
+
+    if pos >= len(tokens):
+        raise RmilError("Line %s: the property has no name" % lineno)
+
+    name = tokens[pos]
+    pos = pos + 1
+
+    min, max = 0, None
+    if pos < len(tokens) and _cardinality_pattern.match(tokens[pos]):
+        min = _parseCardinality(tokens[pos], lineno) or 0
+        pos = pos + 1
+        if pos < len(tokens) and _cardinality_pattern.match(tokens[pos]):
+            max = _parseCardinality(tokens[pos], lineno)
+            pos = pos + 1
+
+    values = None
+    if pos < len(tokens) and tokens[pos] == "[":
+        values = []
+        pos = pos + 1
+        while pos < len(tokens) and tokens[pos] != "]":
+            if tokens[pos] != ",":
+                values.append(_unquote(tokens[pos]))
+            pos = pos + 1
+        if pos >= len(tokens):
+            raise RmilError("Line %s: the list of values is not closed with ']'" % lineno)
+        pos = pos + 1
+
+    # Alternatives can also be given at the end, e.g. "Mappe parent 0 1 || Klasse". A "||"
+    # with nothing after it is ignored
+    while pos < len(tokens) and tokens[pos] == "||":
+        if pos + 1 < len(tokens):
+            ranges.append(schema.expand(tokens[pos + 1]))
+        pos = pos + 2
+
+    if pos < len(tokens):
+        raise RmilError("Line %s: unexpected '%s'" % (lineno, tokens[pos]))
+
+    return PropertyConstraint(name, schema.expand(name), ranges, min, max, values)
+
+
+def parseRmil(lines, schema=None, source=None):
+    """
+    Parse RMIL (an iterable of lines) into a Schema, or add the classes and instances to
+    "schema". Raises RmilError for lines that can't be parsed
+    """
+    if schema is None:
+        schema = Schema()
+    if source:
+        schema.sources.append(source)
+
+    current = None
+    for lineno, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+
+        tokens = _tokenize(stripped)
+        keyword = tokens[0]
+
+        if keyword == "end":
+            current = None
+        elif keyword == "prefix" and current is None:
+            if len(tokens) == 2:
+                schema.default_prefix = tokens[1]
+            elif len(tokens) == 3:
+                schema.prefixes[tokens[1]] = tokens[2]
+            else:
+                raise RmilError("Line %s: a prefix is 'prefix [name] uri'" % lineno)
+        elif keyword == "class" and len(tokens) > 1:
+            iri = schema.expand(tokens[1])
+            current = schema.classes.get(iri)
+            if current is None:
+                current = schema.classes[iri] = RmilClass(iri, tokens[1])
+            _addNew(current.superclasses, [schema.expand(token) for token in tokens[2:]])
+            schema.setClosure(None, None)
+        elif keyword == "instance" and len(tokens) > 1:
+            iri = schema.expand(tokens[1])
+            current = schema.instances.get(iri)
+            if current is None:
+                current = schema.instances[iri] = RmilInstance(iri, tokens[1])
+            _addNew(current.classes, [schema.expand(token) for token in tokens[2:]])
+        elif isinstance(current, RmilClass):
+            current.properties.append(_parseProperty(schema, tokens, lineno))
+        elif isinstance(current, RmilInstance):
+            if len(tokens) < 2:
+                raise RmilError("Line %s: a instance value is 'property value'" % lineno)
+            predicate = schema.expand(tokens[0])
+            for token in tokens[1:]:
+                if token.startswith('"'):
+                    _addNew(current.values.setdefault(predicate, []), [_unquote(token)])
+                else:
+                    _addNew(current.links.setdefault(predicate, []), [schema.expand(token)])
+        else:
+            raise RmilError("Line %s: unexpected '%s' outside of a class or instance" % (lineno, keyword))
+
+    return schema
+
+
+def readRmil(paths, schema=None):
+    """ Read one or more RMIL files (a path or a list of paths) into a Schema """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    for path in paths:
+        with open(path, encoding="utf-8") as infile:
+            try:
+                schema = parseRmil(infile, schema, source=path)
+            except RmilError as e:
+                raise RmilError("%s: %s" % (path, e))
+
+    return schema
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+
+from .utils import *
+from .expressions import compileExpressions
+
+
+class ElementRule:
+    """
+    The config of a single element name, resolved once so entities don't have to look
+    things up in the ObjectElements config over and over. Rules are shared by all entities
+    with the same name and must not be modified.
+    """
+    __slots__ = ["name", "table", "is_blank", "ids", "literal", "datatype", "lang", "subject_prefix",
+                 "id_elements", "type_prefix", "default_type_prefix", "type", "value", "id_expression", "escape", "stable_ids",
+                 "_type_prefixes"]
+
+    def __init__(self, name, element_config, config, expressions, table):
+        self.name = sys.intern(name)
+        self.table = table
+
+        # Blank nodes are explicitly configured with "id" set to None
+        self.is_blank = "id" in element_config and element_config["id"] is None
+
+        ids = element_config.get("id", [])
+        if ids is None:
+            ids = []
+        elif not is_sequence(ids):
+            ids = [ids]
+
+        # The ids to look for, in order: (attribute qname, None) or (None, element name)
+        self.ids = tuple((id_element[1:], None) if id_element[0] == "@" else (None, id_element)
+                         for id_element in list(ids) + list(config.get("ids", [])))
+
+        # The names of the child elements that can give the id, blank nodes don't need them
+        self.id_elements = frozenset(id_element for id_attribute, id_element in self.ids
+                                     if id_element is not None and not self.is_blank)
+
+        self.literal = element_config.get("literal", True)
+        self.datatype = self.literal and element_config.get("datatype") or None
+        self.lang = self.literal and element_config.get("lang") or None
+        self.subject_prefix = element_config.get("subject_prefix", config.get("subject_prefix"))
+        self.type_prefix = element_config.get("type_prefix")
+        self.default_type_prefix = config.get("type_prefix")
+        self.type = element_config.get("type", self.name)
+        self.value = expressions.get("value")
+        self.id_expression = expressions.get("id-expression")
+        self.escape = getLiteralEscaper(config)
+        self.stable_ids = bool(config.get("stable_ids"))
+        self._type_prefixes = {}
+
+    def getTypePrefix(self, namespace):
+        """ Get the type prefix for a element of this name in the given namespace """
+        try:
+            return self._type_prefixes[namespace]
+        except KeyError:
+            pass
+
+        type_prefix = self.type_prefix or namespace or self.default_type_prefix
+        if type_prefix[-1] != "/":
+            type_prefix = type_prefix + "/"
+
+        self._type_prefixes[namespace] = type_prefix
+        return type_prefix
+
+    def __repr__(self):
+        return "ElementRule(%r)" % self.name
+
+
+class RuleTable(dict):
+    """
+    Element name -> ElementRule. Names that are not in the ObjectElements config get a default
+    rule the first time they are looked up, so a lookup is always a single dict access.
+    """
+    def __init__(self, config):
+        dict.__init__(self)
+        self._config = config
+        self._expressions = compileExpressions(config)
+
+        for name, element_config in (config.get("ObjectElements") or {}).items():
+            self[name] = ElementRule(name, element_config or {}, config, self._expressions.get(name, {}), self)
+
+    def __missing__(self, name):
+        rule = ElementRule(name, {}, self._config, {}, self)
+        self[rule.name] = rule
+        return rule
+
+
+def compileRules(config):
+    """ Compile the config into a RuleTable. Raises ConfigError for invalid expressions """
+    return RuleTable(config)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, sys
+
+from .utils import *
+from .inputs import getInputBasename
+from .formats import openOutput, getOutputExtension, stripOutputExtension
+from .incremental import IncrementalSink, getManifestPath
+from .store import openStore
+from .validation import ValidatingSink, getValidator, getReportPath
+from .subjectindex import IndexingSink, getIndexPath
+from .references import ReferenceSink, getIdIndexPath
+
+OUTPUT_MODES = ["per-subject", "stream", "sharded", "store"]
+
+
+class SubjectWriter:
+    """ Collects the pieces of a streamed subject, and hands them to writeSubject() of the sink when closed """
+    def __init__(self, sink, entity):
+        self._sink = sink
+        self._entity = entity
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(data)
+
+    def close(self):
+        self._sink.writeSubject(self._entity, "".join(self._parts))
+        self._parts = None
+
+
+class _DirectWriter:
+    """ Writes the pieces of a streamed subject straight to the output of the sink """
+    def __init__(self, sink):
+        self._sink = sink
+
+    def write(self, data):
+        self._sink._writeData(data)
+
+    def close(self):
+        self._sink.subjects = self._sink.subjects + 1
+
+
+class _FileWriter:
+    """ Writes the pieces of a streamed subject to a file of its own """
+    def __init__(self, sink, filename):
+        self._sink = sink
+        self._output = openOutput(filename, sink._config)
+
+    def write(self, data):
+        self._output.write(data)
+        self._sink.triples = self._sink.triples + data.count("\n")
+
+    def close(self):
+        self._output.close()
+        self._sink.subjects = self._sink.subjects + 1
+
+
+class Sink:
+    """
+    Base class for output sinks. The XML handler hands each finished RDF subject
+    (serialized as NTriples) to the sink, the sink decides where it ends up.
+    """
+    def __init__(self, config, logger=None):
+        self._config = config
+        self._logger = logger
+        self._buffer_size = config.get("output_buffer_size") or 1024 * 1024
+        self.subjects = 0
+        self.triples = 0
+
+    def getOutputDir(self):
+        return self._config.get("output_dir", ".")
+
+    def writeSubject(self, entity, data):
+        """ Write the NTriples of a finished entity """
+        raise NotImplementedError
+
+    def openSubject(self, entity):
+        """
+        Get a writer (with write() and close()) for the NTriples of a entity, which are written in
+        several pieces. Subjects that are serialized while they are parsed (see the "streaming"
+        option) may be interleaved with other subjects.
+        """
+        return SubjectWriter(self, entity)
+
+    def getFilenames(self):
+        """ Get the files written by this sink, if it writes to a known set of files """
+        return []
+
+    def close(self):
+        pass
+
+    def _count(self, data):
+        self.subjects = self.subjects + 1
+        self.triples = self.triples + data.count("\n")
+
+
+class PerSubjectSink(Sink):
+    """ The original layout: one .nt file (or other format, see formats.py) per RDF subject in the output dir """
+    def getFilename(self, entity):
+        id = entity.getSubject() + "-" + entity.getType()
+
+        return self.getOutputDir() + os.path.sep + "%s%s" % (stringToFilename(id), getOutputExtension(self._config))
+
+    def writeSubject(self, entity, data):
+        filename = self.getFilename(entity)
+
+        if self._logger:
+            self._logger.info("Writing %s to file '%s'" % (entity, filename))
+
+        output = openOutput(filename, self._config)
+        try:
+            output.write(data)
+        finally:
+            output.close()
+
+        self._count(data)
+
+    def openSubject(self, entity):
+        filename = self.getFilename(entity)
+
+        if self._logger:
+            self._logger.info("Writing %s to file '%s'" % (entity, filename))
+
+        return _FileWriter(self, filename)
+
+
+class StreamSink(Sink):
+    """ Writes all subjects to a single buffered stream, either a file or stdout ("-") """
+    def __init__(self, config, filename, logger=None):
+        Sink.__init__(self, config, logger=logger)
+        self.filename = filename
+
+        self._output = openOutput(filename, config, self._buffer_size)
+
+        if self._logger:
+            self._logger.info("Writing RDF to '%s'" % filename)
+
+    def writeSubject(self, entity, data):
+        self._output.write(data)
+        self._count(data)
+
+    def openSubject(self, entity):
+        return _DirectWriter(self)
+
+    def _writeData(self, data):
+        self._output.write(data)
+        self.triples = self.triples + data.count("\n")
+
+    def getCurrentFile(self):
+        """ Get the file that is being written to """
+        return self.filename
+
+    def getFilenames(self):
+        if self.filename == "-":
+            return []
+        return [self.filename]
+
+    def close(self):
+        if self._output is None:
+            return
+
+        self._output.close()
+        self._output = None
+
+
+class ShardedSink(Sink):
+    """
+    Writes subjects to a series of rotating shard files named <stem>-00000.nt, <stem>-00001.nt...
+    (or the extension of the output format).
+    A new shard is started when the current one exceeds "shard_max_bytes" or "shard_max_triples".
+    A subject is never split across two shards, unless it is streamed (see the "streaming" option)
+    and other subjects fill up the shard before it ends.
+    """
+    def __init__(self, config, stem, logger=None):
+        Sink.__init__(self, config, logger=logger)
+        self.stem = stem
+        self.filenames = []
+        self._max_bytes = config.get("shard_max_bytes")
+        self._max_triples = config.get("shard_max_triples")
+        self._output = None
+        self._shard_bytes = 0
+        self._shard_triples = 0
+
+    def _rotate(self):
+        if self._output is not None:
+            self._output.close()
+
+        filename = "%s-%05d%s" % (self.stem, len(self.filenames), getOutputExtension(self._config))
+        self.filenames.append(filename)
+
+        if self._logger:
+            self._logger.info("Writing RDF to shard '%s'" % filename)
+
+        self._output = openOutput(filename, self._config, self._buffer_size)
+        self._shard_bytes = 0
+        self._shard_triples = 0
+
+    def _isFull(self):
+        if self._shard_bytes == 0:
+            return False
+
+        if self._max_bytes and self._shard_bytes >= self._max_bytes:
+            return True
+
+        if self._max_triples and self._shard_triples >= self._max_triples:
+            return True
+
+        return False
+
+    def writeSubject(self, entity, data):
+        if self._output is None or self._isFull():
+            self._rotate()
+
+        self._writeData(data)
+        self.subjects = self.subjects + 1
+
+    def openSubject(self, entity):
+        if self._output is None or self._isFull():
+            self._rotate()
+
+        return _DirectWriter(self)
+
+    def _writeData(self, data):
+        triples = data.count("\n")
+        self._output.write(data)
+        self._shard_bytes = self._shard_bytes + len(data)
+        self._shard_triples = self._shard_triples + triples
+        self.triples = self.triples + triples
+
+    def getCurrentFile(self):
+        return self.filenames[-1]
+
+    def getFilenames(self):
+        return list(self.filenames)
+
+    def close(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+
+class StoreSink(Sink):
+    """
+    Loads the triples straight into a triple store (see store.openStore), in the graph given by
+    "graph" in the config, instead of writing files that have to be parsed again
+    """
+    def __init__(self, config, logger=None):
+        Sink.__init__(self, config, logger=logger)
+        self._store = openStore(config)
+
+        if self._logger:
+            self._logger.info("Loading RDF into store '%s'" % self._store.path)
+
+    def writeSubject(self, entity, data):
+        self._writeData(data)
+        self.subjects = self.subjects + 1
+
+    def openSubject(self, entity):
+        return _DirectWriter(self)
+
+    def _writeData(self, data):
+        self._store.add(data)
+        self.triples = self.triples + data.count("\n")
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+def getOutputStem(config, inputfile=None):
+    """
+    Get the path (without extension) of the stream or shard output. It is either
+    given by "output_file" or derived from the name of the input file
+    """
+    output_file = config.get("output_file")
+
+    if output_file:
+        stem = output_file
+    elif inputfile:
+        stem = getInputBasename(inputfile)
+    else:
+        stem = "output"
+
+    if stem.endswith(".xml"):
+        stem = stem[:-4]
+    else:
+        stem = stripOutputExtension(stem)
+
+    if not os.path.isabs(stem):
+        stem = os.path.join(config.get("output_dir", "."), stem)
+
+    return stem
+
+
+def createSink(config, inputfile=None, logger=None):
+    """
+    Create the output sink selected by "output_mode" in the config. With a "subject_index" the
+    location of every subject is recorded (see subjectindex.IndexingSink), with a "manifest" only
+    new and changed subjects are written (see incremental.IncrementalSink), with a "id_index" the
+    references between subjects are resolved (see references.ReferenceSink), and with a
+    "validation_schema" all subjects are checked against it (see validation.ValidatingSink)
+    """
+    mode = config.get("output_mode") or "per-subject"
+
+    if mode == "per-subject":
+        sink = PerSubjectSink(config, logger=logger)
+    elif mode == "stream":
+        if config.get("output_file") == "-":
+            sink = StreamSink(config, "-", logger=logger)
+        else:
+            sink = StreamSink(config, getOutputStem(config, inputfile) + getOutputExtension(config), logger=logger)
+    elif mode == "sharded":
+        sink = ShardedSink(config, getOutputStem(config, inputfile), logger=logger)
+    elif mode == "store":
+        sink = StoreSink(config, logger=logger)
+    else:
+        raise ValueError("Unknown output mode '%s', must be one of %s" % (mode, ", ".join(OUTPUT_MODES)))
+
+    # Next to the output, so only what is actually written is indexed
+    if getIndexPath(config):
+        sink = IndexingSink(config, sink, logger=logger)
+
+    if getManifestPath(config):
+        sink = IncrementalSink(config, sink, logger=logger)
+
+    # Unchanged subjects have their keys and references too
+    if getIdIndexPath(config):
+        sink = ReferenceSink(config, sink, inputfile=inputfile, logger=logger)
+
+    # Outside of the incremental sink, so unchanged subjects are checked too
+    validator = getValidator(config)
+    if validator is not None:
+        report_file = None
+        if not config.get("validation_collect"):
+            report_file = getReportPath(config, inputfile)
+        sink = ValidatingSink(config, sink, validator, report_file=report_file, inputfile=inputfile, logger=logger)
+
+    return sink
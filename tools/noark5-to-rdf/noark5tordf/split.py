@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, io, time, shutil
+from concurrent.futures import ProcessPoolExecutor
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
+
+from .utils import *
+from . import batch
+from .sinks import createSink, getOutputStem
+from .formats import getOutputExtension
+from .incremental import startRun, finishRun
+from .validation import ValidationReport, getValidator, getReportPath, getSchemaPaths
+from .metrics import Metrics, isMetered, writeMetrics
+from .references import getIdIndexPath, collectReferences, finishReferences
+from .checksums import ChecksumReport, writeChecksumReport
+from .subjectindex import relocateOutputs
+
+
+class _Frame:
+    """ A element on the pre-scan stack """
+    __slots__ = ["qname", "attrs", "leaves", "text", "has_children", "index"]
+
+    def __init__(self, qname, attrs):
+        self.qname = qname
+        self.attrs = attrs
+        self.leaves = []
+        self.text = []
+        self.has_children = False
+        self.index = None
+
+    def getLocalName(self):
+        return self.qname.rpartition(":")[2]
+
+
+class Scan:
+    """
+    Result of a pre-scan of a XML file: "ranges" is a list of (context index, start, end)
+    byte ranges of the split elements, "contexts" is a list of ancestor chains (lists of
+    _Frame objects from the root down to the split parent) the ranges refer to
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.ranges = []
+        self.contexts = []
+
+    def getContextXml(self, index):
+        """
+        Get the XML (as bytes in the encoding of the document) that opens and closes the context
+        of a range: the start tags of the ancestors, each followed by its leaf children (so the
+        ancestors resolve to the same ids), and the matching end tags
+        """
+        head = ['<?xml version="1.0" encoding="%s"?>' % self.encoding]
+        tail = []
+        for frame in self.contexts[index]:
+            head.append("<" + frame.qname + "".join(" %s=%s" % (k, quoteattr(v)) for k, v in frame.attrs.items()) + ">")
+            for qname, attrs, text in frame.leaves:
+                head.append("<" + qname + "".join(" %s=%s" % (k, quoteattr(v)) for k, v in attrs.items()) + ">" + escape(text) + "</" + qname + ">")
+            tail.insert(0, "</" + frame.qname + ">")
+
+        return ("".join(head).encode(self.encoding, "xmlcharrefreplace"),
+                "".join(tail).encode(self.encoding, "xmlcharrefreplace"))
+
+    def getSkeleton(self, size):
+        """ Get the byte ranges of the document that are left when the split elements are cut out """
+        segments = []
+        pos = 0
+        for index, start, end in self.ranges:
+            if start > pos:
+                segments.append((pos, start))
+            pos = end
+
+        if pos < size:
+            segments.append((pos, size))
+
+        return segments
+
+
+def scanFile(path, split_element="mappe", parent_element="arkivdel"):
+    """
+    Find the byte ranges of all "split_element" elements that are direct children of a
+    "parent_element", without building any entities. The element names are matched on their
+    local name. Only the text of leaf elements outside of the ranges is kept.
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = 1024 * 1024
+
+    scan = Scan("UTF-8")
+    stack = []
+    pending = []
+    state = {"depth": 0, "start": None, "children": False}
+
+    def xmlDecl(version, encoding, standalone):
+        if encoding:
+            scan.encoding = encoding
+
+    def characters(text):
+        if stack and not stack[-1].has_children:
+            stack[-1].text.append(text)
+
+    def startElement(qname, attrs):
+        if state["start"] is not None:
+            # Inside a split element, only keep track of the depth
+            state["depth"] = state["depth"] + 1
+            state["children"] = True
+            return
+
+        if stack and not stack[-1].has_children:
+            # Only the text of leaf elements is kept
+            stack[-1].has_children = True
+            stack[-1].text = []
+
+        local = qname.rpartition(":")[2]
+        if local == split_element and stack and stack[-1].getLocalName() == parent_element:
+            parent = stack[-1]
+            if parent.index is None:
+                parent.index = len(scan.contexts)
+                scan.contexts.append(list(stack))
+
+            state["start"] = parser.CurrentByteIndex
+            state["depth"] = 1
+            state["children"] = False
+            parser.CharacterDataHandler = None
+            return
+
+        stack.append(_Frame(qname, attrs))
+
+    def endElement(qname):
+        if state["start"] is not None:
+            state["depth"] = state["depth"] - 1
+            if state["depth"] == 0:
+                pending.append((stack[-1].index, state["start"], parser.CurrentByteIndex, not state["children"]))
+                state["start"] = None
+                parser.CharacterDataHandler = characters
+            return
+
+        frame = stack.pop()
+        if stack and not frame.has_children:
+            stack[-1].leaves.append((frame.qname, frame.attrs, "".join(frame.text)))
+
+    parser.XmlDeclHandler = xmlDecl
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = characters
+
+    with open(path, "rb") as infile:
+        parser.ParseFile(infile)
+
+        # The end index of a element points at its end tag, except for empty
+        # elements ("<mappe/>") where it points right after the tag
+        for index, start, end, empty in pending:
+            infile.seek(end - 2)
+            window = infile.read(256)
+            if not (empty and window[:2] == b"/>"):
+                end = end + window.find(b">", 2) - 1
+            scan.ranges.append((index, start, end))
+
+    return scan
+
+
+class _SegmentReader(io.RawIOBase):
+    """ A file-like object that reads a sequence of byte strings and (start, end) ranges of a file """
+    def __init__(self, path, segments):
+        self._file = open(path, "rb")
+        self._segments = list(reversed(segments))
+        self._data = b""
+        self._left = 0
+        self.name = path
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not len(buffer):
+            return 0
+
+        while not self._data and not self._left:
+            if not self._segments:
+                return 0
+
+            segment = self._segments.pop()
+            if isinstance(segment, bytes):
+                self._data = segment
+            else:
+                self._file.seek(segment[0])
+                self._left = segment[1] - segment[0]
+
+        if self._data:
+            size = min(len(buffer), len(self._data))
+            buffer[:size] = self._data[:size]
+            self._data = self._data[size:]
+        else:
+            size = self._file.readinto(memoryview(buffer)[:min(len(buffer), self._left)])
+            if not size:
+                raise EOFError("Unexpected end of '%s'" % self.name)
+            self._left = self._left - size
+
+        return size
+
+    def close(self):
+        self._file.close()
+        io.RawIOBase.close(self)
+
+
+def _convertSegments(path, segments, stem, bnode_prefix, context_depth):
+    """ Convert a synthetic document made of segments in a worker process """
+    # Imported here to avoid a circular import with the command line module
+    from .noark5tordf import process_xml_file
+
+    config = batch._worker_config
+    if stem is not None:
+        config = dict(config, output_file=stem)
+
+    start = time.time()
+    sink = createSink(config, inputfile=path, logger=batch._worker_logger)
+    reader = _SegmentReader(path, segments)
+    try:
+        result = process_xml_file(config, reader, logger=batch._worker_logger, sink=sink, bnode_prefix=bnode_prefix, context_depth=context_depth)
+    except Exception as e:
+        raise batch.getPortableError(e)
+    finally:
+        reader.close()
+        sink.close()
+
+    stats = {"file": path, "subjects": sink.subjects, "triples": sink.triples,
+             "seconds": time.time() - start, "output": sink.getFilenames(), "error": None}
+    # Added, changed etc. subjects of incremental runs, and the violations when validating
+    if hasattr(sink, "getCounts"):
+        stats.update(sink.getCounts())
+    if config.get("validation_collect"):
+        stats["validation"] = sink.report.asDict()
+    if hasattr(result, "metrics"):
+        stats["metrics"] = result.metrics.asDict()
+    if hasattr(result, "checksums"):
+        stats["checksums"] = result.checksums.asDict()
+
+    return stats
+
+
+def _groupRanges(ranges, chunk_size):
+    """ Group consecutive ranges with the same context into tasks of about "chunk_size" bytes """
+    tasks = []
+    for index, start, end in ranges:
+        if tasks and tasks[-1][0] == index and tasks[-1][2] < chunk_size:
+            tasks[-1][1].append((start, end))
+            tasks[-1][2] = tasks[-1][2] + end - start
+        else:
+            tasks.append([index, [(start, end)], end - start])
+
+    return tasks
+
+
+def process_large_xml_file(config, inputfile, workers=None, chunk_size=None, logger=None):
+    """
+    Convert a single large XML file in parallel. The file is pre-scanned for the byte ranges
+    of "split_element" (default "mappe") elements directly below a "split_parent" (default
+    "arkivdel"), and the ranges are converted by a pool of worker processes. Each worker sees
+    the ranges wrapped in their ancestors (with the ancestors' leaf elements, so parent links
+    resolve to the same subjects), the ancestors themselves are converted from the rest of
+    the file. The output is the same as process_xml_file would produce, in the same order,
+    except for blank node labels which are prefixed with the chunk number.
+    """
+    workers = workers or os.cpu_count() or 1
+    mode = config.get("output_mode") or "per-subject"
+    per_file = mode in ["stream", "sharded"]
+    config = startRun(config)
+
+    # The chunks are validated by the workers, but the report is for the whole file
+    validating = getValidator(config) is not None
+    if validating:
+        config = dict(config, validation_collect=True)
+
+    # Likewise the metrics, and every chunk would overwrite the profile of the file
+    metered = isMetered(config)
+    if metered:
+        config = dict(config, metrics_collect=True)
+    config = dict(config, profile=None)
+
+    # And the checksums of the document files
+    verifying = bool(config.get("verify_checksums"))
+    if verifying:
+        config = dict(config, checksums_collect=True)
+
+    # And the references between the subjects of the chunks
+    referencing = bool(getIdIndexPath(config))
+    if referencing:
+        config = collectReferences(config)
+
+    start = time.time()
+    scan = scanFile(inputfile, config.get("split_element", "mappe"), config.get("split_parent", "arkivdel"))
+    size = os.path.getsize(inputfile)
+    total = sum(end - begin for index, begin, end in scan.ranges)
+
+    if not chunk_size:
+        chunk_size = max(1024 * 1024, total // (workers * 4))
+
+    tasks = _groupRanges(scan.ranges, chunk_size)
+
+    if logger:
+        logger.info("Scanned '%s' in %.2fs, found %s ranges in %s contexts, converting in %s chunks with %s workers" % (
+            inputfile, time.time() - start, len(scan.ranges), len(scan.contexts), len(tasks), workers))
+
+    assertDir(config.get("output_dir", "."))
+    stem = getOutputStem(config, inputfile)
+    parts_dir = os.path.join(config.get("output_dir", "."), ".parts-%s" % os.path.basename(stem))
+    if per_file:
+        assertDir(parts_dir)
+
+    contexts = {}
+    logger_name = logger and logger.name or None
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=batch._initWorker, initargs=(config, logger_name)) as executor:
+            futures = []
+            part_stem = per_file and os.path.join(parts_dir, "00000") or None
+            futures.append(executor.submit(_convertSegments, inputfile, scan.getSkeleton(size), part_stem, "", 0))
+
+            for number, (index, ranges, length) in enumerate(tasks):
+                if index not in contexts:
+                    contexts[index] = scan.getContextXml(index)
+                head, tail = contexts[index]
+
+                part_stem = per_file and os.path.join(parts_dir, "%05d" % (number + 1)) or None
+                futures.append(executor.submit(_convertSegments, inputfile, [head] + ranges + [tail], part_stem,
+                                               "p%05d-" % (number + 1), len(scan.contexts[index])))
+
+            stats = [future.result() for future in futures]
+
+        outputs = []
+        if mode == "stream":
+            batch._mergeOutputs(stats, stem + getOutputExtension(config), logger=logger, config=config)
+            outputs = [stem + getOutputExtension(config)]
+        elif mode == "sharded":
+            # Keep the shards, but number them in document order
+            moves = []
+            for file_stats in stats:
+                for part in file_stats["output"]:
+                    outputs.append("%s-%05d%s" % (stem, len(outputs), getOutputExtension(config)))
+                    os.replace(part, outputs[-1])
+                    moves.append((part, outputs[-1]))
+            relocateOutputs(config, moves)
+    except Exception:
+        # The subjects that were not seen are not deleted when a chunk fails
+        finishRun(config, deletions=False, logger=logger)
+        raise
+    finally:
+        # Also removes the parts of failed chunks
+        if per_file:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+
+    result = {"file": inputfile, "subjects": sum(s["subjects"] for s in stats), "triples": sum(s["triples"] for s in stats),
+              "seconds": time.time() - start, "output": outputs, "chunks": len(tasks), "error": None}
+
+    if config.get("manifest_run") is not None:
+        for key in ["added", "changed", "unchanged"]:
+            result[key] = sum(s[key] for s in stats)
+        result["deleted"] = len(finishRun(config, logger=logger))
+
+    if validating:
+        report = ValidationReport(config.get("validation_max_details"))
+        for file_stats in stats:
+            report.merge(file_stats["validation"])
+        report.write(getReportPath(config, inputfile), input=inputfile, schema=getSchemaPaths(config))
+        result["violations"] = report.violations
+        if logger:
+            logger.info("Checked %s subjects, found %s violations, see '%s'" % (
+                report.subjects, report.violations, getReportPath(config, inputfile)))
+
+    if verifying:
+        report = ChecksumReport(config.get("checksum_max_details"))
+        for file_stats in stats:
+            report.merge(file_stats["checksums"])
+        writeChecksumReport(config, report, inputfile, logger=logger)
+        result["checksum_mismatches"] = report.mismatches
+
+    if referencing:
+        counts = finishReferences(config, inputfile, logger=logger)
+        result["references"] = counts["references"]
+        result["dangling"] = counts["dangling"]
+
+    if metered:
+        metrics = Metrics()
+        for file_stats in stats:
+            metrics.merge(file_stats["metrics"])
+        writeMetrics(config, metrics, inputfile, logger=logger)
+
+    if logger:
+        logger.info("Converted '%s' (%s subjects, %s triples) in %.2fs" % (inputfile, result["subjects"], result["triples"], result["seconds"]))
+
+    return result
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, uuid, sqlite3
+
+try:
+    import rdflib
+except ImportError:
+    rdflib = None
+
+from .utils import *
+from .formats import DEFAULT_GRAPH, splitTriples
+
+STORE_BACKENDS = ["sqlite", "rdflib"]
+
+DEFAULT_BATCH_SIZE = 100000
+
+# How many term ids are cached in memory, the cache starts over when it is full
+DEFAULT_CACHE_SIZE = 1000000
+
+# SQLite limits the number of parameters of a statement
+_SELECT_CHUNK = 500
+
+
+def _scopeBlank(term, scope):
+    """ Give a blank node term (e.g. "_:dokumentobjekt-1") the label prefix of a load """
+    if term.startswith("_:"):
+        return "_:" + scope + term[2:]
+    return term
+
+
+def getStorePath(config):
+    """ Get the path of the triple store of the config, relative paths are in the output dir """
+    path = config.get("store_path") or "triples.db"
+    if not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+class SQLiteQuadStore:
+    """
+    A simple quad store in a SQLite database. Terms (in NTriples syntax) are stored once in the
+    "terms" table, and the quads are rows of four term ids. Triples are added as NTriples text and
+    written in transactions of "batch_size" triples. Several processes can load into the same
+    store, they take turns writing batches. Blank node labels are only unique within a conversion,
+    so every SQLiteQuadStore gives its blank nodes a label prefix of its own.
+    """
+    def __init__(self, path, graph=None, batch_size=None, cache_size=None):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS quads (g INTEGER NOT NULL, s INTEGER NOT NULL, p INTEGER NOT NULL, "
+                             "o INTEGER NOT NULL, PRIMARY KEY (g, s, p, o)) WITHOUT ROWID")
+
+        self._graph = "<%s>" % (graph or DEFAULT_GRAPH)
+        self._batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self._cache_size = cache_size or DEFAULT_CACHE_SIZE
+        self._ids = {}
+        self._pending = []
+        self._scope = uuid.uuid4().hex + "-"
+
+    def add(self, data):
+        """ Add the triples in "data" (whole lines of NTriples) """
+        triples = splitTriples(data)
+        if "_:" in data:
+            scope = self._scope
+            triples = [(_scopeBlank(s, scope), p, _scopeBlank(o, scope)) for s, p, o in triples]
+        self._pending.extend(triples)
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def _resolve(self, terms):
+        """ Make sure the terms are in the terms table, and their ids in the cache """
+        self._db.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", ((term,) for term in terms))
+
+        terms = list(terms)
+        for start in range(0, len(terms), _SELECT_CHUNK):
+            chunk = terms[start:start + _SELECT_CHUNK]
+            query = "SELECT term, id FROM terms WHERE term IN (%s)" % ",".join("?" * len(chunk))
+            self._ids.update(self._db.execute(query, chunk))
+
+    def flush(self):
+        """ Write the added triples in a single transaction """
+        if not self._pending:
+            return
+
+        ids = self._ids
+        with self._db:
+            missing = set()
+            for triple in self._pending:
+                for term in triple:
+                    if term not in ids:
+                        missing.add(term)
+            missing.add(self._graph)
+            missing.difference_update(ids)
+
+            # A full cache is emptied, so all terms of the batch are looked up again
+            if missing and len(ids) + len(missing) > self._cache_size:
+                self._ids = ids = {}
+                missing = {self._graph}
+                for triple in self._pending:
+                    missing.update(triple)
+
+            if missing:
+                self._resolve(missing)
+                ids = self._ids
+
+            graph = ids[self._graph]
+            self._db.executemany("INSERT OR IGNORE INTO quads (g, s, p, o) VALUES (?, ?, ?, ?)",
+                                 ((graph, ids[s], ids[p], ids[o]) for s, p, o in self._pending))
+
+        self._pending = []
+
+    def count(self, graph=None):
+        """ Count the quads, optionally only those in "graph" (a URI) """
+        self.flush()
+        if graph is None:
+            return self._db.execute("SELECT COUNT(*) FROM quads").fetchone()[0]
+        return self._db.execute("SELECT COUNT(*) FROM quads JOIN terms ON quads.g = terms.id WHERE terms.term = ?",
+                                ("<%s>" % graph,)).fetchone()[0]
+
+    def quads(self):
+        """ Iterate over the quads as (graph, subject, predicate, object) tuples of terms in NTriples syntax """
+        self.flush()
+        return self._db.execute("SELECT tg.term, ts.term, tp.term, tobj.term FROM quads "
+                                "JOIN terms tg ON quads.g = tg.id JOIN terms ts ON quads.s = ts.id "
+                                "JOIN terms tp ON quads.p = tp.id JOIN terms tobj ON quads.o = tobj.id")
+
+    def close(self):
+        if self._db is None:
+            return
+
+        try:
+            self.flush()
+            # Lookups by object, built once the bulk of the data is in
+            with self._db:
+                self._db.execute("CREATE INDEX IF NOT EXISTS quads_pos ON quads (p, o, s)")
+        finally:
+            self._db.close()
+            self._db = None
+
+
+class RdflibStore:
+    """
+    Loads triples into a rdflib Dataset with a persistent store plugin (e.g. "BerkeleyDB", or
+    "Oxigraph" with the oxrdflib package) opened at "path". The triples go into the named graph,
+    in transactions of "batch_size" triples. The batches share one map of blank node labels, so
+    a subject streamed in two batches is still one node, and the nodes of another load are not.
+    """
+    def __init__(self, path, graph=None, batch_size=None, store="BerkeleyDB"):
+        self.path = path
+        self._dataset = rdflib.Dataset(store=store)
+        self._dataset.open(path, create=True)
+        self._graph = self._dataset.graph(rdflib.URIRef(graph or DEFAULT_GRAPH))
+        self._batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self._pending = []
+        self._triples = 0
+        self._bnodes = {}
+
+    def add(self, data):
+        self._pending.append(data)
+        self._triples = self._triples + data.count("\n")
+        if self._triples >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        self._graph.parse(data="".join(self._pending), format="nt", bnode_context=self._bnodes)
+        self._dataset.commit()
+        self._pending = []
+        self._triples = 0
+
+    def close(self):
+        if self._dataset is None:
+            return
+
+        try:
+            self.flush()
+        finally:
+            self._dataset.close()
+            self._dataset = None
+
+
+def openStore(config):
+    """ Open the triple store of the config ("store_backend", "store_path", "graph" etc.) for loading """
+    backend = config.get("store_backend") or "sqlite"
+    path = getStorePath(config)
+
+    if backend == "sqlite":
+        return SQLiteQuadStore(path, graph=config.get("graph"), batch_size=config.get("store_batch_size"))
+
+    if backend == "rdflib":
+        if rdflib is None:
+            raise ValueError("The rdflib store backend needs the rdflib package, which is not installed")
+        return RdflibStore(path, graph=config.get("graph"), batch_size=config.get("store_batch_size"),
+                           store=config.get("rdflib_store") or "BerkeleyDB")
+
+    raise ValueError("Unknown store backend '%s', must be one of %s" % (backend, ", ".join(STORE_BACKENDS)))
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, gzip, time, sqlite3
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .utils import *
+
+# How many locations are written to the index in one transaction
+INDEX_BATCH_SIZE = 10000
+
+
+class Location:
+    """ A range of bytes of a output file with the triples of a subject (a subject may have several) """
+    __slots__ = ["subject", "id", "type", "parent", "file", "offset", "length"]
+
+    def __init__(self, subject, id, type, parent, file, offset, length):
+        self.subject = subject
+        self.id = id
+        self.type = type
+        self.parent = parent
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def asDict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return "Location(%r, %r, %s, %s)" % (self.subject, self.file, self.offset, self.length)
+
+
+def _openRange(path, offset):
+    """ Open a output file for reading at a offset of its (uncompressed) content """
+    if path.endswith(".gz"):
+        infile = gzip.open(path, "rb")
+    elif path.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError("Reading '%s' needs the zstandard package, which is not installed" % path)
+        infile = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    else:
+        infile = open(path, "rb")
+
+    # Compressed files can only be read up to the offset
+    infile.seek(offset)
+    return infile
+
+
+def _setWalMode(db, timeout):
+    """
+    Switch a database to WAL. SQLite doesn't wait for the lock this takes like it does for
+    writes, so processes that open a new index at the same time retry until "timeout" seconds
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or time.time() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+class SubjectIndex:
+    """
+    A SQLite database of where the triples of every subject are in the output files: the subject,
+    its id (e.g. the systemID), its type, the subject of its parent and the file, byte offset and
+    length of each range of its triples. Compressed files have offsets into their uncompressed
+    content. The columns are indexed, so finding a subject is a B-tree lookup. Several processes
+    can write to the same index at the same time. File names are relative to the index.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._dir = os.path.dirname(os.path.abspath(path))
+        self._db = sqlite3.connect(path, timeout=600)
+        _setWalMode(self._db, 600)
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS locations (subject TEXT NOT NULL, id TEXT, type TEXT, "
+                             "parent TEXT, file TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS locations_subject ON locations (subject)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS locations_id ON locations (id)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS locations_parent ON locations (parent)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS locations_file ON locations (file, offset)")
+        self._pending = []
+        self._pending_files = set()
+        self._forgotten = []
+
+    def _getName(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self._dir)
+
+    def getPath(self, location):
+        """ Get the path of the file of a location """
+        return os.path.join(self._dir, location.file)
+
+    def add(self, subject, id, type, parent, filename, offset, length):
+        name = self._getName(filename)
+        self._pending.append((subject, id, type, parent, name, offset, length))
+        self._pending_files.add(name)
+        if len(self._pending) + len(self._forgotten) >= INDEX_BATCH_SIZE:
+            self.flush()
+
+    def forget(self, filename):
+        """ Remove the locations in a file, before it is written again """
+        name = self._getName(filename)
+        # The removals come first when flushing
+        if name in self._pending_files:
+            self.flush()
+        self._forgotten.append((name,))
+        if len(self._pending) + len(self._forgotten) >= INDEX_BATCH_SIZE:
+            self.flush()
+
+    def relocate(self, filename, new_filename, shift=0):
+        """ Move the locations in a file to another file, "shift" bytes further on (when files are concatenated) """
+        self.flush()
+        with self._db:
+            self._db.execute("UPDATE locations SET file = ?, offset = offset + ? WHERE file = ?",
+                             (self._getName(new_filename), shift, self._getName(filename)))
+
+    def getSize(self, filename):
+        """ Get the (uncompressed) size of the indexed content of a file """
+        self.flush()
+        row = self._db.execute("SELECT MAX(offset + length) FROM locations WHERE file = ?", (self._getName(filename),)).fetchone()
+        return row[0] or 0
+
+    def flush(self):
+        if not (self._pending or self._forgotten):
+            return
+
+        with self._db:
+            self._db.executemany("DELETE FROM locations WHERE file = ?", self._forgotten)
+            self._db.executemany("INSERT INTO locations (subject, id, type, parent, file, offset, length) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 self._pending)
+        self._pending = []
+        self._pending_files = set()
+        self._forgotten = []
+
+    def _select(self, where, args):
+        self.flush()
+        rows = self._db.execute("SELECT subject, id, type, parent, file, offset, length FROM locations WHERE %s "
+                                "ORDER BY file, offset" % where, args).fetchall()
+        return [Location(*row) for row in rows]
+
+    def find(self, subject=None, id=None):
+        """ Get the locations of a subject (a URI in angle brackets) or of the subjects with a id """
+        if subject is not None:
+            return self._select("subject = ?", (subject,))
+        return self._select("id = ?", (id,))
+
+    def getChildren(self, subject):
+        """ Get the locations of the subjects whose parent is "subject" """
+        return self._select("parent = ?", (subject,))
+
+    def getSubtree(self, subject):
+        """ Get the locations of a subject and all subjects below it (e.g. a mappe and its registreringer) """
+        self.flush()
+        rows = self._db.execute("WITH RECURSIVE tree (subject) AS (SELECT ? UNION SELECT locations.subject FROM locations "
+                                "JOIN tree ON locations.parent = tree.subject) "
+                                "SELECT subject, id, type, parent, file, offset, length FROM locations "
+                                "WHERE subject IN tree ORDER BY file, offset", (subject,)).fetchall()
+        return [Location(*row) for row in rows]
+
+    def read(self, locations):
+        """ Read the triples of a list of locations, in order, as a string """
+        parts = []
+        infile, current = None, None
+        try:
+            for location in locations:
+                # Compressed files are read on from the previous location if it comes before
+                if infile is None or current != location.file or infile.tell() > location.offset:
+                    if infile is not None:
+                        infile.close()
+                    infile = _openRange(self.getPath(location), location.offset)
+                    current = location.file
+                elif infile.tell() < location.offset:
+                    infile.seek(location.offset)
+
+                parts.append(infile.read(location.length))
+        finally:
+            if infile is not None:
+                infile.close()
+
+        return b"".join(parts).decode("utf-8")
+
+    def getTriples(self, subject=None, id=None, subtree=False):
+        """ Get the triples of a subject (or of the subjects with a id), optionally with all subjects below it """
+        locations = self.find(subject, id)
+        if subtree:
+            subjects = sorted(set(location.subject for location in locations))
+            locations = []
+            for subject in subjects:
+                locations.extend(self.getSubtree(subject))
+            locations.sort(key=lambda location: (location.file, location.offset))
+        return self.read(locations)
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def getIndexPath(config):
+    """ Get the path of the subject index of the config, relative paths are in the output dir """
+    path = config.get("subject_index")
+    if path and not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+def _byteLength(data):
+    if data.isascii():
+        return len(data)
+    return len(data.encode("utf-8"))
+
+
+class _IndexingWriter:
+    """ Writes a subject to the wrapped writer, and remembers the ranges of bytes it ends up in """
+    __slots__ = ["_sink", "_entity", "_writer", "_filename", "_ranges"]
+
+    def __init__(self, sink, entity, writer, filename):
+        self._sink = sink
+        self._entity = entity
+        self._writer = writer
+        self._filename = filename
+        self._ranges = []
+
+    def write(self, data):
+        filename = self._filename or self._sink._sink.getCurrentFile()
+        offset = self._sink._advance(filename, _byteLength(data))
+        self._writer.write(data)
+
+        # Other subjects are written in between when streaming
+        ranges = self._ranges
+        if ranges and ranges[-1][0] == filename and ranges[-1][1] + ranges[-1][2] == offset:
+            ranges[-1][2] = self._sink._offsets[filename] - ranges[-1][1]
+        else:
+            ranges.append([filename, offset, self._sink._offsets[filename] - offset])
+
+    def close(self):
+        self._writer.close()
+
+        # The parent link is written by now, so the parent can't change its id anymore
+        entity = self._entity
+        parent = entity.getParent()
+        parent = parent is not None and parent.getSubject() or None
+        for filename, offset, length in self._ranges:
+            self._sink._index.add(entity.getSubject(), entity.getId(), entity.getTypePredicate(), parent, filename, offset, length)
+        self._ranges = None
+
+        if self._filename is not None:
+            del self._sink._offsets[self._filename]
+
+
+class IndexingSink:
+    """
+    Wraps a output sink (stream, sharded or per-subject, in ntriples format), and records where the
+    triples of every subject are written in a SubjectIndex. Files that are written again are
+    removed from the index first.
+    """
+    def __init__(self, config, sink, logger=None):
+        self._config = config
+        self._sink = sink
+        self._logger = logger
+        self._index = SubjectIndex(getIndexPath(config))
+        self._offsets = {}
+
+    def __getattr__(self, name):
+        # The counts, file names etc. of the wrapped sink
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._sink, name)
+
+    def _advance(self, filename, length):
+        """ Reserve "length" bytes at the end of a file, returns their offset """
+        offset = self._offsets.get(filename)
+        if offset is None:
+            self._index.forget(filename)
+            offset = 0
+        self._offsets[filename] = offset + length
+        return offset
+
+    def openSubject(self, entity):
+        writer = self._sink.openSubject(entity)
+        filename = None
+        if hasattr(self._sink, "getFilename"):
+            # A file of its own, written from the start
+            filename = self._sink.getFilename(entity)
+            self._offsets.pop(filename, None)
+        return _IndexingWriter(self, entity, writer, filename)
+
+    def writeSubject(self, entity, data):
+        writer = self.openSubject(entity)
+        writer.write(data)
+        writer.close()
+
+    def getFilenames(self):
+        return self._sink.getFilenames()
+
+    def getCounts(self):
+        if hasattr(self._sink, "getCounts"):
+            return self._sink.getCounts()
+        return {}
+
+    def close(self):
+        if self._index is None:
+            return
+
+        try:
+            self._sink.close()
+        finally:
+            self._index.close()
+            self._index = None
+
+
+def relocateOutputs(config, moves):
+    """
+    Update the subject index of the config (if any) after output files were renamed or concatenated.
+    "moves" is a list of (file, new file), files moved to the same new file are concatenated in order
+    """
+    path = getIndexPath(config)
+    if not path:
+        return
+
+    index = SubjectIndex(path)
+    try:
+        sizes = {}
+        for filename, new_filename in moves:
+            if new_filename not in sizes:
+                index.forget(new_filename)
+                sizes[new_filename] = 0
+            size = index.getSize(filename)
+            index.relocate(filename, new_filename, sizes[new_filename])
+            sizes[new_filename] = sizes[new_filename] + size
+    finally:
+        index.close()
+
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Generate synthetic Noark5 arkivstruktur.xml files of any size, for tests and benchmarks
+
+import sys, re, uuid, random, argparse, datetime
+from xml.sax.saxutils import escape
+
+from .utils import *
+
+NAMESPACE = "http://www.arkivverket.no/standarder/noark5/arkivstruktur"
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+
+_words = ["arkiv", "sak", "melding", "vedtak", "klage", "rapport", "budsjett", "plan", "avtale", "kontrakt",
+          "innstilling", "tilsyn", "helse", "skole", "vei", "bydel", "kommune", "barnevern", "bolig", "regulering",
+          "referat", "notat", "brev", "svar", "om", "for", "til", "og", "av", "med"]
+# Letters of the Norwegian and Sami alphabets, accented letters and a character outside the BMP
+_non_ascii = "æøåÆØÅéèüöáčđŋšŧž\U0001F4C4"
+
+_journalposttyper = ["Inngående dokument", "Utgående dokument", "Organinternt dokument for oppfølging",
+                     "Organinternt dokument uten oppfølging"]
+_journalstatuser = ["Journalført", "Ferdigstilt fra saksbehandler", "Godkjent av leder", "Ekspedert", "Arkivert"]
+_saksstatuser = ["Under behandling", "Avsluttet", "Utgår"]
+_dokumentstatuser = ["Dokumentet er under redigering", "Dokumentet er ferdigstilt"]
+_formater = ["pdf", "docx", "odt", "txt"]
+
+_size_pattern = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.IGNORECASE)
+_size_units = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parseSize(size):
+    """ Parse a size like "10MB", "1.5 GiB" or "4096" into a number of bytes """
+    if isinstance(size, int):
+        return size
+    match = _size_pattern.match(size)
+    if match is None:
+        raise ValueError("'%s' is not a size" % size)
+    return int(float(match.group(1)) * _size_units[match.group(2).lower()])
+
+
+class ArchiveGenerator:
+    """
+    Writes a synthetic, Noark5 shaped arkiv: "arkivdeler" arkivdel with mapper nested "depth" levels
+    deep, "mapper" child mapper per mappe, the innermost being saksmapper with "registreringer"
+    journalposter, each with "dokumenter" dokumentbeskrivelser of "objekter" dokumentobjekter.
+    Titles are about "text_size" characters, and "non_ascii" is the share of their characters
+    that are not ASCII. The same seed gives the same file
+    """
+    def __init__(self, seed=0, arkivdeler=1, depth=2, mapper=3, registreringer=4, dokumenter=1, objekter=2,
+                 korrespondanseparter=2, text_size=40, non_ascii=0.0, indent=True):
+        self.random = random.Random(seed)
+        self.arkivdeler = max(1, arkivdeler)
+        self.depth = max(1, depth)
+        self.mapper = max(1, mapper)
+        self.registreringer = registreringer
+        self.dokumenter = dokumenter
+        self.objekter = objekter
+        self.korrespondanseparter = korrespondanseparter
+        self.indent = indent
+        self.elements = 0
+        self.bytes = 0
+        self.counts = {}
+        self._time = datetime.datetime(2014, 11, 4, 15, 9, 19, 849000)
+        self._sequence = 0
+        self._mappeSequence = 0
+
+        # Titles are picked from a pool, generating every one of them would be slow
+        self._texts = [escape(self._makeText(text_size, non_ascii)) for i in range(1024)]
+
+    def _makeText(self, size, non_ascii):
+        rnd = self.random
+        words = []
+        length = 0
+        while length < size:
+            word = rnd.choice(_words)
+            words.append(word)
+            length = length + len(word) + 1
+        chars = list(" ".join(words)[:max(1, size)])
+        for pos in range(len(chars)):
+            if rnd.random() < non_ascii:
+                chars[pos] = rnd.choice(_non_ascii)
+        return "".join(chars).strip() or "x"
+
+    def _id(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def _date(self):
+        self._time = self._time + datetime.timedelta(seconds=self.random.randint(1, 600), microseconds=self.random.randint(0, 999) * 1000)
+        return self._time.strftime("%Y-%m-%dT%H:%M:%S.") + "%03d+01:00" % (self._time.microsecond // 1000)
+
+    def _text(self):
+        return self.random.choice(self._texts)
+
+    def _count(self, name, elements):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.elements = self.elements + elements
+
+    def _leaf(self, parts, pad, name, value):
+        parts.append("%s<%s>%s</%s>" % (pad, name, value, name))
+
+    def _pad(self, level):
+        return self.indent and "\n" + "  " * level or ""
+
+    def _dokumentobjekt(self, parts, level, versjon):
+        pad = self._pad(level)
+        inner = self._pad(level + 1)
+        rnd = self.random
+        format = rnd.choice(_formater)
+        parts.append(pad + "<dokumentobjekt>")
+        self._leaf(parts, inner, "versjonsnummer", versjon)
+        self._leaf(parts, inner, "variantformat", "Arkivformat")
+        self._leaf(parts, inner, "format", format)
+        self._leaf(parts, inner, "opprettetDato", self._date())
+        self._leaf(parts, inner, "opprettetAv", self._text())
+        self._leaf(parts, inner, "referanseDokumentfil", "dokumenter/%s.%s" % (self._id(), format))
+        self._leaf(parts, inner, "sjekksum", "%064X" % rnd.getrandbits(256))
+        self._leaf(parts, inner, "sjekksumAlgoritme", "SHA-256")
+        self._leaf(parts, inner, "filstoerrelse", rnd.randint(0, 5000000))
+        parts.append(pad + "</dokumentobjekt>")
+        self._count("dokumentobjekt", 10)
+
+    def _dokumentbeskrivelse(self, parts, level, hoveddokument):
+        pad = self._pad(level)
+        inner = self._pad(level + 1)
+        date = self._date()
+        parts.append(pad + "<dokumentbeskrivelse>")
+        self._leaf(parts, inner, "systemID", self._id())
+        self._leaf(parts, inner, "dokumentstatus", self.random.choice(_dokumentstatuser))
+        self._leaf(parts, inner, "opprettetDato", date)
+        self._leaf(parts, inner, "opprettetAv", self._text())
+        self._leaf(parts, inner, "tilknyttetRegistreringSom", hoveddokument and "Hoveddokument" or "Vedlegg")
+        self._leaf(parts, inner, "tilknyttetDato", date)
+        self._leaf(parts, inner, "tilknyttetAv", self._text())
+        for versjon in range(1, self.objekter + 1):
+            self._dokumentobjekt(parts, level + 1, versjon)
+        parts.append(pad + "</dokumentbeskrivelse>")
+        self._count("dokumentbeskrivelse", 8)
+
+    def _registrering(self, parts, level, year):
+        pad = self._pad(level)
+        inner = self._pad(level + 1)
+        rnd = self.random
+        self._sequence = self._sequence + 1
+        date = self._date()
+        parts.append(pad + '<registrering xsi:type="journalpost">')
+        self._leaf(parts, inner, "systemID", self._id())
+        self._leaf(parts, inner, "opprettetDato", date)
+        self._leaf(parts, inner, "opprettetAv", self._text())
+        self._leaf(parts, inner, "arkivertDato", self._date())
+        self._leaf(parts, inner, "arkivertAv", self._text())
+        for index in range(self.dokumenter):
+            self._dokumentbeskrivelse(parts, level + 1, index == 0)
+        self._leaf(parts, inner, "tittel", self._text())
+        self._leaf(parts, inner, "forfatter", self._text())
+        self._leaf(parts, inner, "journalaar", year)
+        self._leaf(parts, inner, "journalsekvensnummer", self._sequence)
+        self._leaf(parts, inner, "journalpostnummer", self._sequence)
+        self._leaf(parts, inner, "journalposttype", rnd.choice(_journalposttyper))
+        self._leaf(parts, inner, "journalstatus", rnd.choice(_journalstatuser))
+        self._leaf(parts, inner, "journaldato", date)
+        self._leaf(parts, inner, "dokumentetsDato", date)
+        for index in range(self.korrespondanseparter):
+            parts.append(inner + "<korrespondansepart>")
+            self._leaf(parts, self._pad(level + 2), "korrespondanseparttype", index == 0 and "Avsender" or "Mottaker")
+            self._leaf(parts, self._pad(level + 2), "korrespondansepartNavn", self._text())
+            parts.append(inner + "</korrespondansepart>")
+            self._count("korrespondansepart", 3)
+        parts.append(pad + "</registrering>")
+        self._count("registrering", 15)
+
+    def _mappe(self, parts, level, depth):
+        pad = self._pad(level)
+        inner = self._pad(level + 1)
+        saksmappe = depth == self.depth
+        self._mappeSequence = self._mappeSequence + 1
+        sequence = self._mappeSequence
+        date = self._date()
+        parts.append(pad + (saksmappe and '<mappe xsi:type="saksmappe">' or "<mappe>"))
+        self._leaf(parts, inner, "systemID", self._id())
+        self._leaf(parts, inner, "mappeID", "%s/%06d" % (self._time.year, sequence))
+        self._leaf(parts, inner, "tittel", self._text())
+        self._leaf(parts, inner, "opprettetDato", date)
+        self._leaf(parts, inner, "opprettetAv", self._text())
+        elements = 6
+        if saksmappe:
+            for index in range(self.registreringer):
+                self._registrering(parts, level + 1, self._time.year)
+            self._leaf(parts, inner, "saksaar", self._time.year)
+            self._leaf(parts, inner, "sakssekvensnummer", sequence)
+            self._leaf(parts, inner, "saksdato", date)
+            self._leaf(parts, inner, "administrativEnhet", self._text())
+            self._leaf(parts, inner, "saksansvarlig", self._text())
+            self._leaf(parts, inner, "saksstatus", self.random.choice(_saksstatuser))
+            elements = elements + 6
+        else:
+            for index in range(self.mapper):
+                self._mappe(parts, level + 1, depth + 1)
+        parts.append(pad + "</mappe>")
+        self._count("mappe", elements)
+
+    def _write(self, output, parts):
+        data = "".join(parts).encode("utf-8")
+        output.write(data)
+        self.bytes = self.bytes + len(data)
+
+    def write(self, output, size=None, mapper=None):
+        """
+        Write the arkiv to a binary stream: "mapper" top level mapper per arkivdel (default
+        "mapper"), or as many as it takes to make the file "size" bytes (roughly, it ends with
+        the mappe that crosses the size). Returns the number of elements written by name
+        """
+        if size is not None:
+            size = parseSize(size)
+        elif mapper is None:
+            mapper = self.mapper
+
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '%s<arkiv xmlns="%s" xmlns:xsi="%s">' % (self.indent and "\n" or "", NAMESPACE, XSI_NAMESPACE)]
+        inner = self._pad(1)
+        self._leaf(parts, inner, "systemID", self._id())
+        self._leaf(parts, inner, "tittel", self._text())
+        self._leaf(parts, inner, "arkivstatus", "Opprettet")
+        self._leaf(parts, inner, "opprettetDato", self._date())
+        self._leaf(parts, inner, "opprettetAv", self._text())
+        parts.append(inner + "<arkivskaper>")
+        self._leaf(parts, self._pad(2), "arkivskaperID", self.random.randint(900000000, 999999999))
+        self._leaf(parts, self._pad(2), "arkivskaperNavn", self._text())
+        parts.append(inner + "</arkivskaper>")
+        self._count("arkivskaper", 3)
+        self._write(output, parts)
+
+        for index in range(self.arkivdeler):
+            parts = [inner + "<arkivdel>"]
+            self._leaf(parts, self._pad(2), "systemID", self._id())
+            self._leaf(parts, self._pad(2), "tittel", self._text())
+            self._leaf(parts, self._pad(2), "opprettetDato", self._date())
+            self._leaf(parts, self._pad(2), "opprettetAv", self._text())
+            self._count("arkivdel", 5)
+
+            # Every arkivdel gets a equal share of the size
+            written = 0
+            while (size is None and written < mapper) or (size is not None and self.bytes < size * (index + 1) // self.arkivdeler):
+                self._mappe(parts, 2, 1)
+                written = written + 1
+                self._write(output, parts)
+                parts = []
+
+            parts.append(inner + "</arkivdel>")
+            self._write(output, parts)
+
+        self._count("arkiv", 6)
+        self._write(output, ["\n</arkiv>\n" if self.indent else "</arkiv>"])
+        return self.counts
+
+
+def generateArchive(filename, size=None, **options):
+    """ Write a synthetic arkiv to a file (see ArchiveGenerator), and return the generator """
+    generator = ArchiveGenerator(**options)
+    with open(filename, "wb") as output:
+        generator.write(output, size=size)
+    return generator
+
+
+def main():
+    """ Parse arguments and write a synthetic arkivstruktur.xml """
+    parser = argparse.ArgumentParser(description="Generate a synthetic Noark5 arkivstruktur.xml")
+    parser.add_argument("-o", "--output", dest="outputfile", default="-",
+                        help="File to write to, the default is stdout")
+    parser.add_argument("-s", "--size", dest="size", default="10MB",
+                        help="Approximate size of the file, e.g. 1MB or 10GB, the default is 10MB")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+                        help="Seed of the random values, the same seed gives the same file")
+    parser.add_argument("--arkivdeler", dest="arkivdeler", type=int, default=1)
+    parser.add_argument("--depth", dest="depth", type=int, default=2,
+                        help="Levels of mapper, the innermost are saksmapper, the default is 2")
+    parser.add_argument("--mapper", dest="mapper", type=int, default=3,
+                        help="Mapper in each mappe that is not a saksmappe, the default is 3")
+    parser.add_argument("--registreringer", dest="registreringer", type=int, default=4,
+                        help="Journalposter in each saksmappe, the default is 4")
+    parser.add_argument("--dokumenter", dest="dokumenter", type=int, default=1,
+                        help="Dokumentbeskrivelser in each journalpost, the default is 1")
+    parser.add_argument("--objekter", dest="objekter", type=int, default=2,
+                        help="Dokumentobjekter in each dokumentbeskrivelse, the default is 2")
+    parser.add_argument("--text-size", dest="text_size", type=int, default=40,
+                        help="Length of titles and names, the default is 40")
+    parser.add_argument("--non-ascii", dest="non_ascii", type=float, default=0.0,
+                        help="Share of the characters of the texts that are not ASCII, 0 to 1, the default is 0")
+
+    options = parser.parse_args()
+
+    generator = ArchiveGenerator(seed=options.seed, arkivdeler=options.arkivdeler, depth=options.depth, mapper=options.mapper,
+                                 registreringer=options.registreringer, dokumenter=options.dokumenter, objekter=options.objekter,
+                                 text_size=options.text_size, non_ascii=options.non_ascii)
+    if options.outputfile == "-":
+        generator.write(sys.stdout.buffer, size=options.size)
+    else:
+        with open(options.outputfile, "wb") as output:
+            generator.write(output, size=options.size)
+
+    sys.stderr.write("%s bytes, %s elements\n" % (generator.bytes, generator.elements))
+
+
+# Check if called from command line
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,54 @@
 import os
 import sys
+import io
+import tracemalloc
+import time
+import gzip, bz2, lzma, tarfile, zipfile
+import xml.sax
+import pstats
+import logging
 
 from . import config
 from . import noark5tordf
+from . import elements
+from . import watcher
+from . import batch
+from . import split
+from . import expressions
+from . import sinks
+from . import utils
+from . import parsers
+from . import inputs
+from . import formats
+from . import incremental
+from . import store
+from . import rmil
+from . import validation
+from . import generateconfig
+from . import synthetic
+from . import benchmark
+from . import metrics
+from . import references
+from . import checksums
+from . import subjectindex
+from . import xmlhandler
+import re
+import json
 import shutil
+import hashlib
+
+# The dirs the tests write to, relative to the current dir
+TEST_DIRS = ["input", "backup", "output", "foo", "bar", "zoo", "batch-input", "batch-output", "compressed-input",
+             "split-output", "split-reference", "watch-input", "watch-backup", "watch-output", "output-checksums",
+             "output-compressed", "output-formats", "output-generateconfig", "output-incremental", "output-index",
+             "output-metrics", "output-parsers", "output-references", "output-rmil", "output-sharded", "output-stable",
+             "output-store", "output-stream", "output-streaming", "output-synthetic", "output-utf8", "output-validation"]
+
+
+def teardown_module():
+    """ Remove the output of the tests """
+    for path in TEST_DIRS:
+        shutil.rmtree(path, ignore_errors=True)
 
 
 def test_load_config():
@@ -63,7 +108,7 @@ def test_load_config():
 def test_convert():
     env = {"SESAM_CONF" : "./noark5tordf/"}
 
-    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", "output.log", "DEBUG", env=env, logger=None)
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
     
     noark5tordf.process_xml_file(cfg,  os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml")
 
@@ -97,6 +142,1474 @@ def test_convert():
         assert data.find('_:dokumentobjekt-12 <http://www.arkivverket.no/standarder/noark5/arkivstruktur/referanseDokumentfil> <http://localhost:8080/someservice/dokumenter/fasit/Avlevering_Kassasjon/Personer/30A00/7a5e0d2d-240f-496d-9671-0efaab16f6d0/9cc95dab-f344-40f2-9243-ca9c92f79e75/29265a60-8c80-4071-b6de-bc22411e9b79/24084cab-aae7-41fe-9a7a-a12d90adda49.pdf>') > -1
 
 
+def test_convert_stream():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-stream", output_mode="stream",
+                            logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+
+    sink = noark5tordf.process_xml_file(cfg, os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml")
+
+    filename = os.path.join(os.getcwd(), "output-stream", "arkivstruktur.nt")
+    assert sink.filename == filename
+    assert os.path.isfile(filename)
+
+    with open(filename, "r") as infile:
+        data = infile.read()
+
+    # Same subjects as the per-subject layout, in a single file
+    assert sink.subjects == 29
+    assert sink.triples == data.count("\n")
+    assert data.find('<http://sesam.io/sys1/c3b4aeec-3369-40fa-a28d-ebc4d7df5190> <http://www.arkivverket.no/standarder/noark5/arkivstruktur/journalpost> <http://sesam.io/sys1/8aac37cd-a5d1-4140-8699-1dae3db79c10>.') > -1
+    assert data.find('<http://sesam.io/sys1/ba2f34cb-dac7-4987-b25c-16bd760a9035> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://www.arkivverket.no/standarder/noark5/arkivstruktur/Arkiv>.') > -1
+
+
+def test_convert_sharded():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-sharded", output_mode="sharded",
+                            output_file="part", shard_max_triples=100, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+
+    sink = noark5tordf.process_xml_file(cfg, os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml")
+
+    assert len(sink.filenames) > 1
+    assert sink.filenames[0] == os.path.join(os.getcwd(), "output-sharded", "part-00000.nt")
+
+    triples = 0
+    subjects = set()
+    for filename in sink.filenames:
+        with open(filename, "r") as infile:
+            lines = infile.readlines()
+
+        triples = triples + len(lines)
+        shard_subjects = set(line.split(" ")[0] for line in lines if not line.startswith("_:"))
+
+        # A subject is never split across shards
+        assert not subjects.intersection(shard_subjects)
+        subjects.update(shard_subjects)
+
+    assert triples == sink.triples
+    assert len(subjects) == sink.subjects
+
+
+def test_watch():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+
+    for d in ["watch-input", "watch-backup", "watch-output"]:
+        shutil.rmtree(d, ignore_errors=True)
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="watch-output", input_dir="watch-input",
+                            backup_dir="watch-backup", output_mode="stream", interval=1, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+
+    shutil.copy("noark5tordf/sample/arkivstruktur.xml", "watch-input/part1.xml")
+    shutil.copy("noark5tordf/sample/arkivstruktur.xml", "watch-input/part2.xml")
+
+    # A file claimed by a watcher that has died is resumed
+    os.makedirs("watch-input/.processing")
+    shutil.copy("noark5tordf/sample/arkivstruktur.xml", "watch-input/.processing/999999999-part3.xml")
+
+    w = watcher.Watcher(cfg, workers=2)
+    stats = w.run(once=True)
+
+    assert sorted(s["file"] for s in stats) == ["part1.xml", "part2.xml", "part3.xml"]
+    assert all(s["subjects"] == 29 for s in stats)
+    assert w.failed == []
+
+    assert sorted(os.listdir("watch-backup")) == ["part1.xml", "part2.xml", "part3.xml"]
+    assert sorted(os.listdir("watch-output")) == ["part1.nt", "part2.nt", "part3.nt"]
+    assert os.listdir("watch-input/.processing") == []
+    assert not [name for name in os.listdir("watch-input") if not name.startswith(".")]
+
+
+def test_batch():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+
+    for d in ["batch-input", "batch-output"]:
+        shutil.rmtree(d, ignore_errors=True)
+
+    os.makedirs("batch-input/b")
+    shutil.copy("noark5tordf/sample/arkivstruktur.xml", "batch-input/a.xml")
+    shutil.copy("noark5tordf/sample/arkivstruktur.xml", "batch-input/b/arkivstruktur.xml")
+    with open("batch-input/b/broken.xml", "w") as outfile:
+        outfile.write("<arkiv><systemID>1</systemID>")
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="batch-output", output_mode="stream",
+                            output_file="merged.nt", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+
+    stats = batch.process_xml_files(cfg, ["batch-input"], workers=2, merge=True)
+
+    assert [os.path.basename(s["file"]) for s in stats] == ["a.xml", "arkivstruktur.xml", "broken.xml"]
+    assert [s["subjects"] for s in stats[:2]] == [29, 29]
+    assert stats[0]["error"] is None
+    assert stats[2]["error"] is not None
+
+    assert os.listdir("batch-output") == ["merged.nt"]
+    with open("batch-output/merged.nt", "r") as infile:
+        data = infile.read()
+
+    assert data.count("\n") == stats[0]["triples"] + stats[1]["triples"]
+
+    # Blank node labels from different files never collide
+    assert data.find("_:f00000-dokumentobjekt-10 ") > -1
+    assert data.find("_:f00001-dokumentobjekt-10 ") > -1
+    assert data.find("_:f00000-dokumentobjekt-10 ") < data.find("_:f00001-dokumentobjekt-10 ")
+
+    # Without merging, each input gets its own, stable output name
+    shutil.rmtree("batch-output")
+    stats = batch.process_xml_files(cfg, ["batch-input/*.xml", "batch-input/b/arkiv*.xml"], workers=2)
+    assert sorted(os.listdir("batch-output")) == ["00000-a.nt", "00001-arkivstruktur.nt"]
+
+    # A error the parent can't unpickle is sent as a WorkerError, and the files after it still convert
+    shutil.rmtree("batch-output")
+    stats = batch.process_xml_files(cfg, ["batch-input/b/broken.xml", "batch-input/a.xml", "batch-input/b/arkivstruktur.xml"], workers=1)
+    assert stats[0]["error"].startswith("noark5tordf.batch.WorkerError: ") and "SAXParseException" in stats[0]["error"]
+    assert [s["error"] for s in stats[1:]] == [None, None]
+    assert [s["subjects"] for s in stats[1:]] == [29, 29]
+
+
+def test_split():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    inputfile = os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml"
+
+    for d in ["split-output", "split-reference"]:
+        shutil.rmtree(d, ignore_errors=True)
+
+    scan = split.scanFile(inputfile)
+    assert len(scan.contexts) == 1
+    assert [frame.qname for frame in scan.contexts[0]] == ["arkiv", "arkivdel"]
+    assert ("systemID", {}, "585231e2-9df9-4e2c-8288-2fdba64736c3") in scan.contexts[0][1].leaves
+
+    with open(inputfile, "rb") as infile:
+        data = infile.read()
+
+    for index, start, end in scan.ranges:
+        assert data[start:end].startswith(b"<mappe>")
+        assert data[start:end].endswith(b"</mappe>")
+
+    def normalized(filename):
+        # Blank node labels differ between the two, and korrespondansepart ids are random
+        with open(filename, "r") as infile:
+            return sorted(re.sub(r"_:[\w-]+", "_:b", line) for line in infile)
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="split-reference", output_mode="stream",
+                            logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    cfg["ObjectElements"]["korrespondansepart"] = {"id" : None}
+    reference = noark5tordf.process_xml_file(cfg, inputfile)
+
+    cfg = dict(cfg, output_dir=os.path.join(os.getcwd(), "split-output"))
+    result = split.process_large_xml_file(cfg, inputfile, workers=2, chunk_size=1)
+
+    assert result["chunks"] == len(scan.ranges)
+    assert result["subjects"] == reference.subjects
+    assert result["triples"] == reference.triples
+    assert os.listdir("split-output") == ["arkivstruktur.nt"]
+    assert normalized("split-output/arkivstruktur.nt") == normalized("split-reference/arkivstruktur.nt")
+
+    # A chunk that fails leaves no parts behind, and the incremental run is finished without deletions
+    cfg = dict(cfg, output_dir=os.path.join(os.getcwd(), "split-output", "failed"), manifest="manifest.db")
+    cfg["ObjectElements"] = dict(cfg["ObjectElements"], registrering={"id-expression": "result = 1 / 0"})
+    os.makedirs(cfg["output_dir"])
+    try:
+        split.process_large_xml_file(cfg, inputfile, workers=2, chunk_size=1)
+        assert False, "Expected the ZeroDivisionError of a chunk"
+    except ZeroDivisionError:
+        pass
+    assert os.listdir("split-output/failed") == ["manifest.db"]
+    manifest = incremental.Manifest("split-output/failed/manifest.db")
+    assert manifest._db.execute("SELECT finished FROM runs").fetchone()[0] is not None
+    manifest.close()
+
+
+def test_expressions():
+    cfg = {"document_url_prefix" : "http://localhost/", "ObjectElements" : {
+        "referanseDokumentfil" : {"value" : 'result = config["document_url_prefix"] + value\n'},
+        "korrespondansepart" : {"id-expression" : 'result = randomID()\n'},
+        "tittel" : {"value" : 'result = value.upper() + "-" + context.getName()\n'},
+        "mappe" : {}}}
+
+    compiled = expressions.compileExpressions(cfg)
+
+    # The common patterns skip exec() altogether
+    assert isinstance(compiled["referanseDokumentfil"]["value"], expressions.PrefixExpression)
+    assert isinstance(compiled["korrespondansepart"]["id-expression"], expressions.RandomIdExpression)
+    assert type(compiled["tittel"]["value"]) is expressions.Expression
+    assert "mappe" not in compiled
+
+    assert compiled["referanseDokumentfil"]["value"].evaluate("a/b.pdf", None, cfg) == "http://localhost/a/b.pdf"
+    assert len(compiled["korrespondansepart"]["id-expression"].evaluate(None, None, cfg)) == 36
+
+    entity = elements.Entity("tittel", None, cfg)
+    entity.setValue("fasit")
+    assert entity.getValue() == "FASIT-tittel"
+
+    # Broken expressions are reported when the config is compiled, not when used
+    for source in ["result = = value", "value = 1", None]:
+        try:
+            expressions.compileExpressions({"ObjectElements" : {"tittel" : {"value" : source or 42}}})
+        except expressions.ConfigError:
+            pass
+        else:
+            assert False, "Expected a ConfigError for %r" % source
+
+
+def test_streaming():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+
+    results = []
+    for streaming in [False, True]:
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-streaming", output_mode="stream",
+                                output_file="streaming-%s" % streaming, streaming=streaming, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+
+        # The random korrespondansepart ids would differ between the runs
+        cfg["ObjectElements"]["korrespondansepart"]["id-expression"] = 'result = context.getNumberedId()'
+
+        sink = noark5tordf.process_xml_file(cfg, os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml")
+        assert sink.subjects == 29
+
+        with open(sink.filename, "r") as infile:
+            results.append(sorted(infile.readlines()))
+
+    # Only the order of the triples differs
+    assert results[0] == results[1]
+
+    # A subject with its id in a attribute is streamed from its first child, one with a id
+    # element from that element. Properties before the id are written when it is seen
+    lines = []
+    class ListWriter:
+        def write(self, data):
+            lines.extend(data.splitlines())
+        def close(self):
+            lines.append("closed")
+
+    class StreamingSink(sinks.Sink):
+        def openSubject(self, entity):
+            lines.append("open " + entity.getSubject())
+            return ListWriter()
+        def writeSubject(self, entity, data):
+            lines.append("write " + entity.getSubject())
+
+    cfg = {"type_prefix" : "http://x/", "subject_prefix" : "http://s/", "ids" : ["@id", "systemID"], "ObjectElements" : {}, "streaming" : True}
+    data = b'<a id="1"><tittel>A</tittel><b><tittel>B</tittel><systemID>2</systemID><c><d>D</d></c></b></a>'
+    noark5tordf.process_xml_file(cfg, io.BytesIO(data), sink=StreamingSink(cfg))
+
+    assert lines == ['open <http://s/1>', '<http://s/1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://x/A>.',
+                     '<http://s/1> <http://x/id> "1".', '<http://s/1> <http://x/tittel> "A".',
+                     'open <http://s/2>', '<http://s/2> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://x/B>.',
+                     '<http://s/2> <http://x/tittel> "B".', '<http://s/2> <http://x/systemID> "2".',
+                     '<http://s/2> <http://x/c> _:c-1.', '_:c-1 <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://x/C>.',
+                     '_:c-1 <http://x/d> "D".', '<http://s/2> <http://x/a> <http://s/1>.', 'closed', 'closed'], lines
+
+
+def test_parsers():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    assert parsers.availableParsers()[0] == "expat"
+    assert parsers.getParser("auto") is parsers.parseExpat
+    assert parsers.getParser("sax") is parsers.parseSax
+
+    # Namespaced, prefixed and xml: attributes, comments, CDATA, entity references and mixed text
+    data = ('<?xml version="1.0" encoding="UTF-8"?>\n<arkiv xmlns="http://www.arkivverket.no/standarder/noark5/arkivstruktur" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:n5="http://www.arkivverket.no/standarder/noark5/metadatakatalog">'
+            '<systemID>a</systemID><arkivdel id="d1" n5:kode="K&amp;1"><tittel xml:lang="no">Del &lt;1&gt; &#xE6;</tittel>'
+            '<registrering xsi:type="journalpost"><systemID>r1</systemID><!-- kommentar --><tittel>T<!-- x -->it<![CDATA[<tel>]]></tittel>'
+            '<korrespondansepart><navn>Ola</navn></korrespondansepart></registrering></arkivdel></arkiv>').encode("utf-8")
+
+    results = {}
+    for name in parsers.availableParsers():
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-parsers", output_mode="stream",
+                                output_file="sample-%s" % name, parser=name, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+        cfg["ObjectElements"]["korrespondansepart"]["id-expression"] = 'result = context.getNumberedId()'
+
+        sink = noark5tordf.process_xml_file(cfg, os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml")
+        with open(sink.filename, "r", encoding="utf-8") as infile:
+            sample = infile.read()
+
+        cfg["output_file"] = "synthetic-%s" % name
+        sink = noark5tordf.process_xml_file(cfg, io.BytesIO(data))
+        with open(sink.filename, "r", encoding="utf-8") as infile:
+            synthetic = infile.read()
+
+        results[name] = (sample, synthetic)
+
+    # Byte-identical output for all backends
+    for name in results:
+        assert results[name] == results["sax"], name
+
+    assert '<http://sesam.io/sys1/r1> <http://www.arkivverket.no/standarder/noark5/arkivstruktur/tittel> "Tit<tel>".' in results["sax"][1]
+    assert '"K&1"' in results["sax"][1]
+
+    for name in parsers.availableParsers():
+        try:
+            parsers.getParser(name)(xmlhandler.GeneralXmlHandler({"ObjectElements" : {}}, sink=CountingSink({})), io.BytesIO(b"<a><b></a>"))
+        except xml.sax.SAXParseException as e:
+            assert e.getLineNumber() == 1, name
+        else:
+            assert False, "Expected a SAXParseException from %s" % name
+
+    try:
+        parsers.getParser("dom")
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected a ValueError for a unknown parser"
+
+
+def test_compressed_input():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+
+    shutil.rmtree("compressed-input", ignore_errors=True)
+    os.makedirs("compressed-input")
+
+    with open("noark5tordf/sample/arkivstruktur.xml", "rb") as infile:
+        data = infile.read()
+
+    for extension, module in [(".gz", gzip), (".bz2", bz2), (".xz", lzma)]:
+        with module.open("compressed-input/arkivstruktur.xml" + extension, "wb") as outfile:
+            outfile.write(data)
+
+    with tarfile.open("compressed-input/pakke.tar.gz", "w:gz") as archive:
+        archive.add("noark5tordf/sample/arkivstruktur.xml", arcname="content/arkivstruktur.xml")
+        archive.add("compressed-input/arkivstruktur.xml.bz2", arcname="content/kopi.xml.bz2")
+        archive.add("noark5tordf/config/noark5.yaml", arcname="content/noark5.yaml")
+
+    with zipfile.ZipFile("compressed-input/pakke.zip", "w") as archive:
+        archive.write("noark5tordf/sample/arkivstruktur.xml", arcname="arkivstruktur.xml")
+
+    assert batch.expandInputs(["compressed-input"]) == [
+        "compressed-input/arkivstruktur.xml.bz2", "compressed-input/arkivstruktur.xml.gz", "compressed-input/arkivstruktur.xml.xz",
+        "compressed-input/pakke.tar.gz!content/arkivstruktur.xml", "compressed-input/pakke.tar.gz!content/kopi.xml.bz2",
+        "compressed-input/pakke.zip!arkivstruktur.xml"]
+
+    assert inputs.getInputBasename("compressed-input/arkivstruktur.xml.gz") == "arkivstruktur.xml"
+    assert inputs.getInputBasename("compressed-input/pakke.tar.gz!content/kopi.xml.bz2") == "kopi.xml"
+    assert inputs.isPlainFile("noark5tordf/sample/arkivstruktur.xml")
+    assert not inputs.isPlainFile("compressed-input/arkivstruktur.xml.gz")
+
+    reader = inputs.openInput("noark5tordf/sample/arkivstruktur.xml")
+    assert isinstance(reader, inputs.MappedInput)
+    assert bytes(reader.getBuffer()) == data
+    reader.close()
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-compressed", output_mode="stream",
+                            logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    cfg["ObjectElements"]["korrespondansepart"]["id-expression"] = 'result = context.getNumberedId()'
+
+    expected = None
+    for path in ["noark5tordf/sample/arkivstruktur.xml"] + batch.expandInputs(["compressed-input"]):
+        for parser in parsers.availableParsers():
+            cfg["parser"] = parser
+            cfg["output_file"] = "%s-%s" % (inputs.getInputBasename(path), parser)
+            sink = noark5tordf.process_xml_file(cfg, path)
+            with open(sink.filename, "r", encoding="utf-8") as infile:
+                result = infile.read()
+
+            if expected is None:
+                expected = result
+            assert result == expected, (path, parser)
+
+    # Default output names leave out the compression extension
+    cfg["output_file"] = None
+    sink = noark5tordf.process_xml_file(cfg, "compressed-input/arkivstruktur.xml.xz")
+    assert sink.filename == os.path.join(os.getcwd(), "output-compressed", "arkivstruktur.nt")
+
+
+def _convertWithFormat(cfg, output_file, output_format, compression="none"):
+    cfg["output_file"] = output_file
+    cfg["output_format"] = output_format
+    cfg["output_compression"] = compression
+    return noark5tordf.process_xml_file(cfg, "noark5tordf/sample/arkivstruktur.xml")
+
+
+def test_output_formats():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    shutil.rmtree("output-formats", ignore_errors=True)
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-formats", output_mode="stream",
+                            graph="http://x/graph", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    cfg["ObjectElements"]["korrespondansepart"]["id-expression"] = 'result = context.getNumberedId()'
+
+    sink = _convertWithFormat(cfg, "plain", "ntriples")
+    assert sink.filename.endswith("plain.nt")
+    with open(sink.filename, "r", encoding="utf-8") as infile:
+        expected = infile.read()
+
+    sink = _convertWithFormat(cfg, "compressed", "ntriples", "gzip")
+    assert sink.filename.endswith("compressed.nt.gz")
+    with gzip.open(sink.filename, "rt", encoding="utf-8") as infile:
+        assert infile.read() == expected
+
+    sink = _convertWithFormat(cfg, "quads", "nquads")
+    assert sink.filename.endswith("quads.nq")
+    with open(sink.filename, "r", encoding="utf-8") as infile:
+        quads = infile.read()
+    assert quads == expected.replace(".\n", " <http://x/graph>.\n")
+
+    sink = _convertWithFormat(cfg, "binary", "binary", "gzip")
+    assert sink.filename.endswith("binary.n5b.gz")
+    output = io.StringIO()
+    formats.binaryToNTriples(sink.filename, output)
+    assert output.getvalue() == expected
+
+    # The dictionary starts over when it gets too big
+    cfg["binary_max_terms"] = 10
+    sink = _convertWithFormat(cfg, "reset", "binary")
+    output = io.StringIO()
+    formats.binaryToNTriples(sink.filename, output)
+    assert output.getvalue() == expected
+    cfg["binary_max_terms"] = 1000000
+
+    # Binary files can be concatenated like NTriples files
+    with open(sink.filename, "rb") as infile:
+        data = infile.read()
+    with open("output-formats/twice.n5b", "wb") as outfile:
+        outfile.write(data + data)
+    output = io.StringIO()
+    formats.binaryToNTriples("output-formats/twice.n5b", output)
+    assert output.getvalue() == expected + expected
+
+    if formats.zstandard is not None:
+        sink = _convertWithFormat(cfg, "zstd", "binary", "zstd")
+        output = io.StringIO()
+        formats.binaryToNTriples(sink.filename, output)
+        assert output.getvalue() == expected
+
+    # One compressed file per subject, and sharded
+    cfg["output_mode"] = "per-subject"
+    cfg["output_dir"] = os.path.join(os.getcwd(), "output-formats", "subjects")
+    os.makedirs(cfg["output_dir"])
+    sink = _convertWithFormat(cfg, None, "ntriples", "gzip")
+    filenames = os.listdir("output-formats/subjects")
+    assert len(filenames) == sink.subjects
+    assert all(name.endswith(".nt.gz") for name in filenames)
+    with gzip.open(os.path.join("output-formats/subjects", filenames[0]), "rt", encoding="utf-8") as infile:
+        assert infile.readline() in expected
+
+    cfg["output_mode"] = "sharded"
+    cfg["shard_max_triples"] = 100
+    sink = _convertWithFormat(cfg, "part", "nquads", "gzip")
+    assert sink.filenames[0] == os.path.join(os.getcwd(), "output-formats", "subjects", "part-00000.nq.gz")
+    lines = []
+    for filename in sink.filenames:
+        with gzip.open(filename, "rt", encoding="utf-8") as infile:
+            lines.extend(infile.readlines())
+    assert sorted(lines) == sorted(quads.splitlines(True))
+
+    try:
+        config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_format="turtle", env=env)
+        assert False, "Unknown output formats are errors"
+    except expressions.ConfigError:
+        pass
+
+
+def _convertIncremental(cfg, data, name):
+    with open("output-incremental/%s.xml" % name, "w", encoding="utf-8") as outfile:
+        outfile.write(data)
+
+    cfg["output_file"] = name
+    sink = noark5tordf.process_xml_file(cfg, "output-incremental/%s.xml" % name)
+    with open(sink.filename, "r", encoding="utf-8") as infile:
+        output = infile.read()
+    with open(incremental.getTombstoneFile(cfg), "r", encoding="utf-8") as infile:
+        deleted = infile.read()
+
+    return sink, output, deleted
+
+
+def test_incremental():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    shutil.rmtree("output-incremental", ignore_errors=True)
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-incremental", output_mode="stream",
+                            manifest="manifest.db", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    cfg["ObjectElements"]["korrespondansepart"]["id-expression"] = 'result = context.getNumberedId()'
+
+    with open("noark5tordf/sample/arkivstruktur.xml", "r", encoding="utf-8") as infile:
+        data = infile.read()
+
+    sink, output, deleted = _convertIncremental(cfg, data, "first")
+    assert sink.added == sink.subjects > 0
+    assert sink.changed == sink.unchanged == 0
+    assert deleted == ""
+    subjects = sink.subjects
+
+    # Blank node labels are not part of the hash, so a different prefix changes nothing
+    cfg["streaming"] = True
+    sink, output, deleted = _convertIncremental(cfg, data, "second")
+    assert sink.unchanged == subjects
+    assert sink.added == sink.changed == sink.subjects == 0
+    assert output == "" and deleted == ""
+    cfg["streaming"] = False
+
+    # Change a registrering and remove the last one (with everything in it)
+    start = data.index('        <registrering xsi:type="journalpost">\n          <systemID>d5d0a713')
+    end = data.index("      </mappe>\n    </mappe>")
+    changed = data[:start] + data[end:]
+    changed = changed.replace("<tittel>Innvilgelse</tittel>", "<tittel>Avslag</tittel>")
+
+    sink, output, deleted = _convertIncremental(cfg, changed, "third")
+    assert sink.added == 0
+    assert sink.changed == sink.subjects == 1
+    assert '"Avslag"' in output
+    assert "<http://sesam.io/sys1/d5d0a713-aa25-442c-ab89-ba7706395488>" in deleted.splitlines()
+    assert len(deleted.splitlines()) == len(sink.deleted) == subjects - sink.unchanged - 1
+    removed = len(sink.deleted)
+
+    # The deleted subjects are added back
+    sink, output, deleted = _convertIncremental(cfg, data, "fourth")
+    assert sink.added == removed
+    assert sink.changed == 1
+    assert deleted == ""
+
+    # Line separators in UTF-8 literals are part of the line
+    triples = '<s> <p> "x\u2028z".\n<s> <q> "y\u0085".\n'
+    assert incremental.hashSubject(triples) == incremental.hashSubject('<s> <q> "y\u0085".\n<s> <p> "x\u2028z".\n')
+    assert incremental.hashSubject(triples) != incremental.hashSubject(triples.replace("\u2028", "\n"))
+
+    # The labels of blank nodes are left out, but not "_:" in literals
+    assert incremental.hashSubject('<s> <p> _:b1 .\n_:b1 <q> "x" .\n') == incremental.hashSubject('<s> <p> _:b7 .\n_:b7 <q> "x" .\n')
+    assert incremental.hashSubject('<s> <p> "see _:a1 here".\n') != incremental.hashSubject('<s> <p> "see _:b2 here".\n')
+    assert incremental.hashSubject('<s> <p> _:b1 .\n<s> <q> "_:a1" .\n') != incremental.hashSubject('<s> <p> _:b1 .\n<s> <q> "_:a2" .\n')
+
+
+def test_stable_ids():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    shutil.rmtree("output-stable", ignore_errors=True)
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-stable", output_mode="stream",
+                            stable_ids=True, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+
+    outputs = []
+    for name, streaming in [("first", False), ("second", False), ("streaming", True)]:
+        cfg["output_file"] = name
+        cfg["streaming"] = streaming
+        sink = noark5tordf.process_xml_file(cfg, "noark5tordf/sample/arkivstruktur.xml", bnode_prefix=name)
+        with open(sink.filename, "r", encoding="utf-8") as infile:
+            outputs.append(infile.read())
+
+    # The random korrespondansepart ids and the blank node labels are the same in every run
+    assert outputs[0] == outputs[1]
+    assert sorted(outputs[0].splitlines()) == sorted(outputs[2].splitlines())
+    assert "_:dokumentobjekt-" in outputs[0] and "_:dokumentobjekt-1" not in outputs[0]
+
+    cfg["output_file"] = "split"
+    cfg["streaming"] = False
+    cfg["split_element"] = "registrering"
+    cfg["split_parent"] = "mappe"
+    result = split.process_large_xml_file(cfg, "noark5tordf/sample/arkivstruktur.xml", workers=2, chunk_size=1)
+    assert result["chunks"] > 1
+    with open(result["output"][0], "r", encoding="utf-8") as infile:
+        assert sorted(infile.read().splitlines()) == sorted(outputs[0].splitlines())
+
+    # Blank nodes with the same content in the same parent are still different nodes
+    xml = ('<a xmlns="http://x/"><id>1</id><b><c>x</c></b><b><c>x</c></b><b><c>y</c></b></a>')
+    cfg["ObjectElements"] = {"b": {"id": None}}
+    cfg["ids"] = ["id"]
+    parts = []
+
+    class ListSink(sinks.Sink):
+        def writeSubject(self, entity, data):
+            parts.append(data)
+
+    noark5tordf.process_xml_file(cfg, io.BytesIO(xml.encode("utf-8")), sink=ListSink(cfg))
+    triples = "".join(parts)
+    labels = set(re.findall(r"_:b-[0-9a-f]+", triples))
+    assert len(labels) == 3
+
+
+def test_store():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    shutil.rmtree("output-store", ignore_errors=True)
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-store", output_mode="stream",
+                            graph="http://x/graph", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    cfg["ObjectElements"]["korrespondansepart"]["id-expression"] = 'result = context.getNumberedId()'
+
+    sink = noark5tordf.process_xml_file(cfg, "noark5tordf/sample/arkivstruktur.xml")
+    with open(sink.filename, "r", encoding="utf-8") as infile:
+        expected = set(infile.read().splitlines())
+
+    cfg["output_mode"] = "store"
+    cfg["store_batch_size"] = 100
+    sink = noark5tordf.process_xml_file(cfg, "noark5tordf/sample/arkivstruktur.xml")
+    assert sink.triples == len(expected)
+
+    # The blank nodes of every load get a label prefix of their own
+    def unscoped(quads):
+        return set(re.sub(r"(^|> )_:[0-9a-f]{32}-", r"\1_:", "%s %s %s." % (s, p, o)) for g, s, p, o in quads)
+    def hasBlank(line):
+        return "> _:" in line or line.startswith("_:")
+    blank = sum(1 for line in expected if hasBlank(line))
+    assert blank
+
+    quads = store.SQLiteQuadStore(store.getStorePath(cfg))
+    assert quads.count() == quads.count("http://x/graph") == len(expected)
+    assert unscoped(quads.quads()) == expected
+    assert set(g for g, s, p, o in quads.quads()) == set(["<http://x/graph>"])
+    quads.close()
+
+    # Loading the same triples again only adds the blank nodes, as new nodes. Another graph adds them all
+    noark5tordf.process_xml_file(cfg, "noark5tordf/sample/arkivstruktur.xml")
+    cfg["graph"] = "http://x/other"
+    stats = batch.process_xml_files(cfg, ["noark5tordf/sample/arkivstruktur.xml"], workers=2)
+    assert not stats[0]["error"] and stats[0]["output"] == []
+
+    quads = store.SQLiteQuadStore(store.getStorePath(cfg))
+    assert quads.count("http://x/graph") == len(expected) + blank and quads.count("http://x/other") == len(expected)
+    quads.close()
+
+    # A term cache that fills up again and again
+    quads = store.SQLiteQuadStore(os.path.join("output-store", "small-cache.db"), graph="http://x/graph", batch_size=50, cache_size=6)
+    for line in sorted(expected):
+        quads.add(line + "\n")
+    assert quads.count() == len(expected)
+    assert unscoped(quads.quads()) == expected
+    quads.close()
+
+    # Two files with the same blank node labels don't share nodes
+    cfg["graph"] = "http://x/graph"
+    cfg["store_path"] = "two-files.db"
+    other = os.path.join(CD_DIR, "samples", "structure-valid.xml")
+    noark5tordf.process_xml_file(cfg, "noark5tordf/sample/arkivstruktur.xml")
+    noark5tordf.process_xml_file(cfg, other)
+    quads = store.SQLiteQuadStore(store.getStorePath(cfg))
+    subjects = {}
+    for g, s, p, o in quads.quads():
+        subjects.setdefault(s, []).append(p)
+    quads.close()
+
+    cfg["output_mode"] = "stream"
+    cfg["output_dir"] = "output-store/other"
+    os.makedirs("output-store/other")
+    with open(noark5tordf.process_xml_file(cfg, other).filename, "r", encoding="utf-8") as infile:
+        other_triples = infile.read().splitlines()
+    assert "_:dokumentobjekt-1 " in "\n".join(expected) and "_:dokumentobjekt-1 " in "\n".join(other_triples)
+    shared = set(line for line in set(expected) | set(other_triples) if not hasBlank(line))
+    assert sum(len(predicates) for predicates in subjects.values()) == \
+        len(shared) + blank + sum(1 for line in other_triples if hasBlank(line))
+    filstoerrelse = "<http://www.arkivverket.no/standarder/noark5/arkivstruktur/filstoerrelse>"
+    assert all(predicates.count(filstoerrelse) <= 1 for predicates in subjects.values())
+    assert len([s for s in subjects if s.startswith("_:") and s.endswith("-dokumentobjekt-1")]) == 2
+
+    # A blank node whose triples are in two batches of a rdflib store is one node
+    if store.rdflib is not None:
+        dataset = store.RdflibStore("output-store/rdflib", graph="http://x/graph", batch_size=1, store="Memory")
+        dataset.add('<http://x/s> <http://x/p> _:b1 .\n')
+        dataset.add('_:b1 <http://x/q> "x" .\n')
+        dataset.flush()
+        assert len(set(dataset._graph.subjects()) & set(dataset._graph.objects())) == 1
+        dataset.close()
+
+
+CD_DIR = os.path.join(os.getcwd(), "..", "..", "continuous-delivery")
+
+# The violations the continuous delivery samples must have (see samples/manifest.txt)
+CD_SAMPLES = {
+    "structure-valid.xml" : [],
+    "structure-invalid.xml" : [("parent", "parent")],
+    "journalpost-valid-properties.xml" : [],
+    "journalpost-inalid-properties.xml" : [("mincard", "opprettetAv")],
+    "journalpost-invalid2-properties.xml" : [("mincard", "opprettetAv")],
+    "saksmappe-valid-properties.xml" : [],
+    "saksmappe-invalid-properties.xml" : [("mincard", "administrativEnhet"), ("mincard", "saksansvarlig")],
+    "sak-registrering-valid-children.xml" : [],
+    "sak-registrering-invalid-children.xml" : [("value", "journalstatus")],
+}
+
+
+def test_validation():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    shutil.rmtree("output-validation", ignore_errors=True)
+
+    schema = rmil.parseRmil("""
+prefix http://x/
+prefix voc http://x/voc/
+# comment
+class A
+    xsd:dateTime created 1 1
+    xsd:int count 0 *
+    xsd:string status [ "Åpen", "Lukket" ]
+end
+class B A
+    Status state 1 1
+    A || C parent 1 1
+end
+instance voc:open Status
+    tittel "Open"
+end
+""".splitlines())
+    assert schema.getAncestors("http://x/B") == ["http://x/B", "http://x/A"]
+    assert [p.name for p in schema.getProperties("http://x/B")] == ["state", "parent", "created", "count", "status"]
+    parent = schema.getProperties("http://x/B")[1]
+    assert parent.ranges == ["http://x/A", "http://x/C"] and (parent.min, parent.max) == (1, 1)
+    assert schema.getProperties("http://x/A")[1].max is None
+    assert schema.instances["http://x/voc/open"].values == {"http://x/tittel" : ["Open"]}
+
+    validator = validation.Validator(schema)
+    report = validation.ValidationReport()
+    validator.validate(report, "<s1>", ["http://x/B"], {"<http://x/created>" : ['"2013-01-12"'], "<http://x/status>" : ['"apen"'],
+                                                         "<http://x/state>" : ['"open"']}, parent_type="http://x/B")
+    assert report.violations == 0, report.details
+    validator.validate(report, "<s2>", ["http://x/B"], {"<http://x/created>" : ['"yesterday"', '"2013-01-12T10:00:00Z"'],
+                                                         "<http://x/count>" : ['"x"'], "<http://x/status>" : ['"Closed"']},
+                       parent_type="http://x/D")
+    assert sorted((d["kind"], d["property"]) for d in report.details) == [
+        ("datatype", "count"), ("datatype", "created"), ("maxcard", "created"), ("mincard", "state"), ("parent", "parent"), ("value", "status")]
+    assert report.subjects == 2
+
+    # Malformed RMIL is reported with the line number
+    try:
+        rmil.parseRmil(["class A", "xsd:string x 1 1 [ \"a\""])
+        assert False
+    except rmil.RmilError as e:
+        assert "Line 2" in str(e)
+
+    # The RMIL files of the repository can all be read
+    for path in ["moreq2010-rmil.txt", "noark5-rmil.txt", "noark5-norsk.rmil.txt", "vehicle-registration-rmil.txt"]:
+        assert rmil.readRmil(os.path.join(os.getcwd(), "..", "..", "rmil", path)).classes
+
+    # The continuous delivery samples pass or fail as described, also when streaming
+    for streaming in [False, True]:
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-validation", output_mode="stream",
+                                streaming=streaming, validation_schema=os.path.join(CD_DIR, "validation", "noark5-subset-for-cd.rmil"),
+                                logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+
+        for name, expected in CD_SAMPLES.items():
+            sink = noark5tordf.process_xml_file(cfg, os.path.join(CD_DIR, "samples", name))
+            violations = [(d["kind"], d["property"]) for d in sink.report.details]
+            assert sorted(violations) == expected, (name, sink.report.details)
+            assert sink.getCounts()["violations"] == len(expected)
+
+            with open(validation.getReportPath(cfg, name), encoding="utf-8") as infile:
+                report = json.load(infile)
+            assert report["valid"] == (not expected) and report["subjects"] > 0
+
+    # Many files and split files give the same violations
+    stats = batch.process_xml_files(cfg, [os.path.join(CD_DIR, "samples")], workers=2)
+    assert dict((os.path.basename(s["file"]), s["violations"]) for s in stats) == dict((name, len(v)) for name, v in CD_SAMPLES.items())
+
+    cfg.update(split_element="registrering", split_parent="mappe")
+    result = split.process_large_xml_file(cfg, os.path.join(CD_DIR, "samples", "sak-registrering-invalid-children.xml"), workers=2)
+    assert result["violations"] == 1
+
+
+def test_rmil_schema():
+    rmil_dir = os.path.join(os.getcwd(), "..", "..", "rmil")
+    rdf_dir = os.path.join(os.getcwd(), "..", "..", "rdf")
+
+    def withoutIds(lines):
+        return sorted(re.sub(r"<http://data.bouvet.no/rmil/[0-9a-f]{32}>", "<id>", line.strip()) for line in lines if line.strip())
+
+    # The NTriples of noark5-rmil.txt are the ones in rdf/, apart from the constraint ids
+    schema = rmil.readRmil(os.path.join(rmil_dir, "noark5-rmil.txt"))
+    output = io.StringIO()
+    rmil.writeNTriples(schema, output)
+    with open(os.path.join(rdf_dir, "noark5.nt"), encoding="utf-8") as infile:
+        assert withoutIds(output.getvalue().splitlines()) == withoutIds(infile)
+
+    # And read back in either vocabulary, they give the same schema
+    for vocabulary in ["rmil", "rdfcl"]:
+        output = io.StringIO()
+        rmil.writeNTriples(schema, output, vocabulary)
+        parsed = rmil.parseSchemaTriples(output.getvalue().splitlines())
+        # The value types are declared as classes too
+        assert set(schema.classes) <= set(parsed.classes)
+        assert not any(parsed.classes[iri].properties for iri in set(parsed.classes) - set(schema.classes))
+        assert sorted(parsed.instances) == sorted(schema.instances)
+        for iri, rmil_class in schema.classes.items():
+            assert sorted(parsed.classes[iri].superclasses) == sorted(rmil_class.superclasses)
+            assert sorted((p.iri, p.min, p.max, tuple(p.ranges)) for p in parsed.classes[iri].properties) == \
+                sorted((p.iri, p.min, p.max, tuple(p.ranges)) for p in rmil_class.properties)
+
+    output = io.StringIO()
+    assert rmil.writeTurtle(schema, output) == len(list(rmil.generateTriples(schema)))
+    assert "@prefix rmil: <http://data.bouvet.no/rmil/> ." in output.getvalue()
+
+    # The subclass closure
+    norsk = rmil.readRmil(os.path.join(rmil_dir, "noark5-norsk.rmil.txt"))
+    mappe = norsk.expand("Mappe")
+    assert norsk.isSubclass(norsk.expand("Saksmappe"), mappe)
+    assert not norsk.isSubclass(mappe, norsk.expand("Saksmappe"))
+    assert norsk.getDescendants(mappe)[0] == mappe and norsk.expand("Saksmappe") in norsk.getDescendants(mappe)
+
+    # The compiled cache gives the same schema, and is only used while the files are unchanged
+    shutil.rmtree("output-rmil", ignore_errors=True)
+    path = os.path.join(rmil_dir, "noark5-norsk.rmil.txt")
+    loaded = rmil.loadSchema(path, cache_dir="output-rmil")
+    cache_file = rmil.getCachePath([path], "output-rmil")
+    assert os.path.exists(cache_file)
+
+    cached = rmil.readCache(cache_file)
+    assert cached is not None and cached.sources == [path]
+    for schema_ in [loaded, cached]:
+        expected, output = io.StringIO(), io.StringIO()
+        rmil.writeNTriples(norsk, expected)
+        rmil.writeNTriples(schema_, output)
+        assert output.getvalue() == expected.getvalue()
+        assert schema_.getDescendants(mappe) == norsk.getDescendants(mappe)
+    assert rmil.readCache(cache_file, key=b"another key") is None
+
+    # An empty list of allowed values is kept, it is not the same as no list
+    empty = rmil.parseRmil(["prefix http://example.org/", "class A", '  xsd:string status 0 1 [ ]', '  xsd:string kind 0 1 [ "a" ]', "  xsd:string free 0 1", "end"])
+    rmil.writeCache(empty, "output-rmil/empty.bin")
+    for schema_ in [rmil.loadCompiled(rmil.compileSchema(empty)), rmil.readCache("output-rmil/empty.bin")]:
+        assert [(p.name, p.values) for p in schema_.classes["http://example.org/A"].properties] == \
+            [("status", []), ("kind", ["a"]), ("free", None)]
+
+    # A validator can be made from the NTriples form too
+    cfg = {"validation_schema": [os.path.join(CD_DIR, "validation", "noark5-schema.nt")], "schema_cache_dir": "output-rmil"}
+    validator = validation.getValidator(cfg)
+    arkivstruktur = "http://www.arkivverket.no/standarder/noark5/arkivstruktur/"
+    assert validator.isA(arkivstruktur + "Saksmappe", [arkivstruktur + "Mappe"])
+    assert len(validator.getProperties(arkivstruktur + "Journalpost")) == \
+        len(rmil.readRmil(os.path.join(CD_DIR, "validation", "noark5-subset-for-cd.rmil")).getProperties(arkivstruktur + "Journalpost"))
+
+
+def test_generateconfig():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    sample = os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml"
+
+    profile = generateconfig.profileFiles([sample], workers=1)
+    assert profile.files == 1 and not profile.failed
+    assert profile.isSubject("mappe") and not profile.isSubject("systemID")
+    assert profile.elements["mappe"].getCardinality("registrering") == (0, 2)
+    assert profile.elements["registrering"].getCardinality("korrespondansepart") == (1, 2)
+    assert "systemID" in profile.getIdCandidates("mappe")
+    assert profile.elements["opprettetDato"].text.getDatatype() == "dateTime"
+    assert profile.elements["versjonsnummer"].text.getDatatype() == "integer"
+    assert profile.elements["format"].text.values == set(["docx", "pdf"])
+    assert profile.elements["registrering"].attributes["type"].values == set(["journalpost"])
+
+    # Close to the hand written config
+    cfg = generateconfig.generateConfig(profile)
+    assert cfg["ids"] == ["systemID"]
+    assert cfg["type_prefix"] == "http://www.arkivverket.no/standarder/noark5/arkivstruktur/"
+    assert cfg["ObjectElements"]["arkivskaper"] == {"id": "arkivskaperID"}
+    assert cfg["ObjectElements"]["korrespondansepart"] == {"id": None}
+    assert cfg["ObjectElements"]["mappe"] == {}
+
+    # The written config can be used for converting
+    shutil.rmtree("output-generateconfig", ignore_errors=True)
+    os.makedirs("output-generateconfig")
+    with open("output-generateconfig/config.yaml", "w", encoding="utf-8") as output:
+        generateconfig.writeConfig(profile, output)
+    cfg = config.readConfig("output-generateconfig/config.yaml", output_dir="output-generateconfig", output_mode="stream",
+                            logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    sink = noark5tordf.process_xml_file(cfg, sample)
+    assert sink.subjects > 0
+
+    # Files profiled in parallel give the merged profile, and a repeated id is no id
+    with open(sample, "rb") as infile, gzip.open("output-generateconfig/copy.xml.gz", "wb") as output:
+        output.write(infile.read())
+    profile = generateconfig.profileFiles([sample, "output-generateconfig/copy.xml.gz"], workers=2)
+    assert profile.files == 2
+    assert profile.elements["mappe"].count == 8
+    assert "systemID" in profile.getIdCandidates("mappe")
+
+    data = b"<a><b><id>1</id><v>x</v></b><b><id>1</id><v>y</v></b><b><id>2</id><v>z</v></b></a>"
+    small = generateconfig.Profile(max_values=2)
+    parsers.parseExpat(generateconfig.ProfileXmlHandler(small), io.BytesIO(data))
+    assert small.getIdCandidates("b") == ["v"]
+    assert small.elements["v"].text.getDistinct() == (2, True)
+    assert generateconfig.generateConfig(small)["ObjectElements"]["b"] == {"id": None}
+
+    # Too many distinct values to tell if a id is unique across the input, which is reported
+    data = b"<a><b><bID>1</bID><v>x</v></b><b><bID>2</bID><v>x</v></b><b><bID>3</bID><v>x</v></b></a>"
+    small = generateconfig.Profile(max_values=2)
+    parsers.parseExpat(generateconfig.ProfileXmlHandler(small), io.BytesIO(data))
+    assert small.getIdCandidates("b") == ["bID"] and small.isGloballyUnique("b", "bID") is None
+    output = io.StringIO()
+    generateconfig.writeConfig(small, output)
+    assert "# not known to be unique across the input (too many distinct values): bID" in output.getvalue()
+    small = generateconfig.Profile(max_values=3)
+    parsers.parseExpat(generateconfig.ProfileXmlHandler(small), io.BytesIO(data))
+    assert small.isGloballyUnique("b", "bID") is True
+
+    # Broken files are reported but don't stop the others
+    with open("output-generateconfig/broken.xml", "w") as output:
+        output.write("<arkiv><systemID>1</systemID>")
+    profile = generateconfig.profileFiles(["output-generateconfig/broken.xml", sample], workers=2)
+    assert profile.files == 1 and len(profile.failed) == 1
+
+
+class CountingSink(sinks.Sink):
+    """ A sink that only counts what it gets """
+    def writeSubject(self, entity, data):
+        self._count(data)
+
+    def openSubject(self, entity):
+        return sinks._DirectWriter(self)
+
+    def _writeData(self, data):
+        self.triples = self.triples + data.count("\n")
+
+
+def _mappeXml(registreringer):
+    """ A archive with a single mappe with many registrering children """
+    registrering = ('<registrering xsi:type="journalpost"><systemID>r-%d</systemID><opprettetDato>2014-11-04T15:10:29.598+01:00</opprettetDato>'
+                    '<opprettetAv>Birger Ballangrud</opprettetAv><tittel attr="x">Tittel %d</tittel><journalaar>2014</journalaar>'
+                    '<journalsekvensnummer>%d</journalsekvensnummer><journalpostnummer>1</journalpostnummer>'
+                    '<journalposttype>Inngaaende dokument</journalposttype><journalstatus>Arkivert</journalstatus></registrering>')
+
+    return ('<?xml version="1.0" encoding="UTF-8"?><arkiv xmlns="http://www.arkivverket.no/standarder/noark5/arkivstruktur" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"><systemID>a</systemID><arkivdel><systemID>d</systemID><mappe><systemID>m</systemID>'
+            + "".join(registrering % (i, i, i) for i in range(registreringer)) + '</mappe></arkivdel></arkiv>').encode("utf-8")
+
+
+def _peakMemory(cfg, data):
+    sink = CountingSink(cfg)
+    tracemalloc.start()
+    try:
+        noark5tordf.process_xml_file(cfg, io.BytesIO(data), sink=sink)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_synthetic():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    shutil.rmtree("output-synthetic", ignore_errors=True)
+    os.makedirs("output-synthetic")
+
+    assert synthetic.parseSize("10MB") == 10 * 1024 * 1024 and synthetic.parseSize("1.5k") == 1536 and synthetic.parseSize(7) == 7
+
+    # The same seed gives the same file, and the structure follows the options
+    def generate(seed, **options):
+        output = io.BytesIO()
+        generator = synthetic.ArchiveGenerator(seed=seed, **options)
+        generator.write(output)
+        return generator, output.getvalue()
+
+    generator, data = generate(1, depth=3, mapper=2, registreringer=3, dokumenter=2, objekter=1)
+    assert data == generate(1, depth=3, mapper=2, registreringer=3, dokumenter=2, objekter=1)[1]
+    assert data != generate(2, depth=3, mapper=2, registreringer=3, dokumenter=2, objekter=1)[1]
+    assert generator.counts["mappe"] == 2 + 4 + 8 and generator.counts["registrering"] == 8 * 3
+    assert generator.counts["dokumentbeskrivelse"] == 24 * 2 and generator.counts["dokumentobjekt"] == 48
+    assert generator.bytes == len(data)
+    mappe_ids = re.findall(r"<mappeID>([^<]*)</mappeID>", data.decode("utf-8"))
+    assert len(mappe_ids) == generator.counts["mappe"] and len(set(mappe_ids)) == len(mappe_ids)
+
+    class ElementCounter(xml.sax.ContentHandler):
+        elements = 0
+        def startElement(self, name, attrs):
+            self.elements = self.elements + 1
+    counter = ElementCounter()
+    xml.sax.parseString(data, counter)
+    assert counter.elements == generator.elements
+
+    text = generate(0, non_ascii=0.5)[1].decode("utf-8")
+    assert 0.02 < sum(1 for c in text if ord(c) > 127) / len(text)
+
+    # A sized file is valid against the continuous delivery schema and converts
+    generator = synthetic.generateArchive("output-synthetic/arkiv.xml", size="200k", arkivdeler=2, non_ascii=0.2)
+    assert 200 * 1024 <= os.path.getsize("output-synthetic/arkiv.xml") < 300 * 1024
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-synthetic", output_mode="stream",
+                            validation_schema=os.path.join(CD_DIR, "validation", "noark5-subset-for-cd.rmil"),
+                            logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    sink = noark5tordf.process_xml_file(cfg, "output-synthetic/arkiv.xml")
+    assert sink.report.violations == 0, sink.report.details[:5]
+    assert sink.subjects > sum(generator.counts[name] for name in ["arkiv", "arkivdel", "mappe", "registrering", "dokumentbeskrivelse"])
+
+    # The benchmark measures a conversion, and a slower one is a regression
+    result = benchmark.runBenchmark("output-synthetic/arkiv.xml", generator.elements, output_mode="sharded", work_dir="output-synthetic")
+    assert result["triples"] > result["subjects"] > 0 and result["files"] == 1
+    assert result["elements_per_second"] > 0 and result["mb_per_second"] > 0
+    assert result["peak_rss_mb"] is None or result["peak_rss_mb"] > 1
+
+    baseline = {"results" : {"default/200k/sharded" : dict(result)}}
+    results = {"default/200k/sharded" : dict(result)}
+    assert benchmark.compareBaseline(results, baseline) == []
+    results["default/200k/sharded"]["triples_per_second"] = result["triples_per_second"] / 2
+    assert benchmark.compareBaseline(results, baseline) == [
+        ("default/200k/sharded", "triples_per_second", result["triples_per_second"], result["triples_per_second"] / 2)]
+
+    benchmark.writeBaseline(results, "output-synthetic/baseline.json")
+    assert benchmark.readBaseline("output-synthetic/baseline.json")["results"] == results
+    assert benchmark.readBaseline("output-synthetic/missing.json") is None
+
+
+def test_metrics():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    sample = os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml"
+    shutil.rmtree("output-metrics", ignore_errors=True)
+
+    # The same output as without metrics
+    outputs = []
+    for metered in [False, True]:
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-metrics", output_mode="stream",
+                                stable_ids=True, metrics=metered, metrics_textfile=metered and "metrics.prom", profile=metered,
+                                logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+        sink = noark5tordf.process_xml_file(cfg, sample)
+        with open("output-metrics/arkivstruktur.nt", encoding="utf-8") as infile:
+            outputs.append(infile.read())
+    assert outputs[0] == outputs[1]
+
+    counters = sink.metrics.counters
+    assert counters["files"] == 1 and counters["triples"] == sink.triples == outputs[1].count("\n")
+    assert counters["objects"] == sink.subjects == 29
+    with open(sample, "rb") as infile:
+        assert counters["elements"] == len(re.findall(rb"<[A-Za-z]", infile.read())) == counters["objects"] + counters["blank_nodes"] + counters["properties"]
+    assert sum(sink.metrics.phases.values()) <= sink.metrics.seconds
+    assert sink.metrics.getElement("mappe")[0] == 4 and sink.metrics.getElement("mappe")[2] > 0
+
+    with open("output-metrics/arkivstruktur-metrics.json", encoding="utf-8") as infile:
+        written = json.load(infile)
+    assert written["counters"] == counters and set(written["phases"]) == set(metrics.PHASES)
+    assert [e["element"] for e in written["elements"]] == [name for name, count, seconds, triples in sink.metrics.getElements()]
+    with open("output-metrics/metrics.prom", encoding="utf-8") as infile:
+        prometheus = infile.read()
+    assert "noark5tordf_elements_total %s\n" % counters["elements"] in prometheus
+    assert 'noark5tordf_element_count_total{element="mappe"} 4\n' in prometheus
+    assert 'noark5tordf_phase_seconds_total{phase="parse"} ' in prometheus
+    assert pstats.Stats("output-metrics/arkivstruktur.prof").total_calls > 0
+
+    # Metrics add up, also when many files are converted
+    total = metrics.Metrics()
+    total.merge(sink.metrics)
+    total.merge(sink.metrics.asDict())
+    assert total.counters["elements"] == 2 * counters["elements"] and total.getElement("mappe")[0] == 8
+    assert metrics._label('a"b\\c\n') == 'a\\"b\\\\c\\n'
+
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-metrics", output_mode="stream",
+                            metrics="batch.json", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    stats = batch.process_xml_files(cfg, [sample, os.path.join(CD_DIR, "samples", "structure-valid.xml")], workers=2)
+    with open("output-metrics/batch.json", encoding="utf-8") as infile:
+        written = json.load(infile)
+    assert written["counters"]["files"] == 2 and written["counters"]["triples"] == sum(s["triples"] for s in stats)
+
+    # Debug messages are only formatted when they are logged
+    logger = logging.getLogger("test-metrics")
+    logger.setLevel(logging.INFO)
+    assert not xmlhandler.GeneralXmlHandler(cfg, logger=logger).debug
+    logger.setLevel(logging.DEBUG)
+    assert xmlhandler.GeneralXmlHandler(cfg, logger=logger).debug
+
+
+def test_subject_index():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    sample = os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml"
+    shutil.rmtree("output-index", ignore_errors=True)
+    mappe = "<http://sesam.io/sys1/00e69f9d-e115-4134-a483-1807cf3e8ff3>"
+
+    def lines(data):
+        return sorted(line for line in data.splitlines() if line)
+
+    for output_mode, streaming, split_file in [("stream", False, False), ("sharded", True, False), ("per-subject", False, False),
+                                               ("sharded", False, True), ("stream", False, True)]:
+        output_dir = "output-index/%s-%s-%s" % (output_mode, streaming, split_file)
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir=output_dir, output_mode=output_mode,
+                                shard_max_triples=50, streaming=streaming, subject_index="index.db", stable_ids=True,
+                                logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+        if split_file:
+            split.process_large_xml_file(cfg, sample, workers=2, chunk_size=1)
+        else:
+            noark5tordf.process_xml_file(cfg, sample)
+        # Converting again replaces the locations
+        if output_mode == "stream":
+            noark5tordf.process_xml_file(cfg, sample)
+
+        output = []
+        for root, dirs, names in os.walk(output_dir):
+            for name in names:
+                if name.endswith(".nt"):
+                    with open(os.path.join(root, name), encoding="utf-8") as infile:
+                        output.extend(infile.read().splitlines())
+
+        index = subjectindex.SubjectIndex(os.path.join(output_dir, "index.db"))
+        try:
+            subjects = set(line.split(" ")[0] for line in output if not line.startswith("_:"))
+            assert set(row[0] for row in index._db.execute("SELECT subject FROM locations")) == subjects
+            for subject in subjects:
+                triples = lines(index.getTriples(subject))
+                assert [line for line in triples if line.startswith(subject + " ")] == sorted(line for line in output if line.startswith(subject + " "))
+                assert not [line for line in triples if not line.startswith(subject + " ") and not line.startswith("_:")]
+
+            # A mappe by its systemID, with its type and parent, and everything below it
+            location = index.find(id="00e69f9d-e115-4134-a483-1807cf3e8ff3")[0]
+            assert location.subject == mappe and location.type.endswith("/Mappe")
+            assert location.parent == "<http://sesam.io/sys1/585231e2-9df9-4e2c-8288-2fdba64736c3>"
+            subtree = set(location.subject for location in index.getSubtree(mappe))
+            assert len(subtree) > 3 and mappe in subtree
+            assert set(location.subject for location in index.getChildren(mappe)) < subtree
+        finally:
+            index.close()
+
+    try:
+        config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-index", output_format="binary",
+                          subject_index="index.db", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+        assert False
+    except expressions.ConfigError:
+        pass
+
+
+_referencing_xml = """<?xml version="1.0" encoding="utf-8"?>
+<arkiv xmlns="http://www.arkivverket.no/standarder/noark5/arkivstruktur">
+  <systemID>ref-arkiv</systemID>
+  <arkivdel>
+    <systemID>ref-arkivdel</systemID>
+    <referanseForloeper>585231e2-9df9-4e2c-8288-2fdba64736c3</referanseForloeper>
+    <mappe>
+      <systemID>ref-mappe</systemID>
+      <kryssreferanse>
+        <referanseTilMappe>00e69f9d-e115-4134-a483-1807cf3e8ff3</referanseTilMappe>
+      </kryssreferanse>
+      <kryssreferanse>
+        <referanseTilMappe>missing "mappe"</referanseTilMappe>
+      </kryssreferanse>
+    </mappe>
+  </arkivdel>
+</arkiv>
+"""
+
+
+def test_references():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    sample = os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml"
+    shutil.rmtree("output-references", ignore_errors=True)
+    utils.assertDir("output-references")
+    referencing = os.getcwd() + "/output-references/referencing.xml"
+    with open(referencing, "w", encoding="utf-8") as output:
+        output.write(_referencing_xml)
+
+    prefix = "http://www.arkivverket.no/standarder/noark5/arkivstruktur/"
+    links = sorted([
+        "<http://sesam.io/sys1/ref-arkivdel> <%sreferanseForloeper> <http://sesam.io/sys1/585231e2-9df9-4e2c-8288-2fdba64736c3>." % prefix,
+        "<http://sesam.io/sys1/ref-mappe> <%sreferanseTilMappe> <http://sesam.io/sys1/00e69f9d-e115-4134-a483-1807cf3e8ff3>." % prefix,
+    ])
+
+    def read(path):
+        with open(path, encoding="utf-8") as infile:
+            return path.endswith(".json") and json.load(infile) or sorted(infile.read().splitlines())
+
+    # The referenced subjects come in a later run, until then the references are dangling
+    output_dir = "output-references/runs"
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir=output_dir, output_mode="stream",
+                            id_index="ids.db", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    sink = noark5tordf.process_xml_file(cfg, referencing)
+    assert sink.getCounts()["references"] == 3 and sink.getCounts()["dangling"] == 3
+    assert read(output_dir + "/referencing-references.nt") == []
+    report = read(output_dir + "/referencing-references.json")
+    assert report["dangling"] == 3 and report["references"] == 3
+    assert {"source" : "<http://sesam.io/sys1/ref-mappe>", "predicate" : prefix + "referanseTilMappe",
+            "key" : 'missing "mappe"', "file" : referencing} in report["details"]
+
+    sink = noark5tordf.process_xml_file(cfg, sample)
+    assert read(output_dir + "/arkivstruktur-references.nt") == links
+    report = read(output_dir + "/arkivstruktur-references.json")
+    assert report["dangling"] == 1 and report["details"][0]["key"] == 'missing "mappe"' and report["conflicting_keys"] == 0
+
+    index = references.IdIndex(output_dir + "/ids.db")
+    try:
+        assert index.getSubject("00e69f9d-e115-4134-a483-1807cf3e8ff3") == "<http://sesam.io/sys1/00e69f9d-e115-4134-a483-1807cf3e8ff3>"
+        assert index.getSubject("ref-mappe") == "<http://sesam.io/sys1/ref-mappe>"
+        assert index.getSubject("nothing") is None
+    finally:
+        index.close()
+    assert os.listdir(output_dir + "/ids.db.shards") == []
+
+    # Files converted together, by several processes, are resolved together
+    for streaming, split_file in [(False, False), (True, False), (False, True)]:
+        output_dir = "output-references/batch-%s-%s" % (streaming, split_file)
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir=output_dir, output_mode="sharded",
+                                streaming=streaming, id_index="ids.db", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+        if split_file:
+            split.process_large_xml_file(cfg, sample, workers=2, chunk_size=1)
+            noark5tordf.process_xml_file(cfg, referencing)
+            assert read(output_dir + "/referencing-references.nt") == links
+            report = read(output_dir + "/referencing-references.json")
+        else:
+            stats = batch.process_xml_files(cfg, [referencing, sample], workers=2)
+            assert [s.get("references") for s in stats] == [3, 0]
+            assert read(output_dir + "/output-references.nt") == links
+            report = read(output_dir + "/output-references.json")
+        assert report["dangling"] == 1 and report["references"] == 3
+        assert os.listdir(output_dir + "/ids.db.shards") == []
+
+
+def _documentPackage(package_dir):
+    """ Write a Noark5 file whose dokumentobjekter describe files in "dokumenter", some of them wrongly """
+    files = {"ok.pdf" : b"%PDF-1.4" + b"x" * 5000, "size.pdf" : b"abc", "checksum.pdf" : b"hello", "md5.txt" : b"md5 content"}
+    utils.assertDir(os.path.join(package_dir, "dokumenter"))
+    for name, data in files.items():
+        with open(os.path.join(package_dir, "dokumenter", name), "wb") as output:
+            output.write(data)
+
+    def dokumentobjekt(name, data, algorithm="SHA-256", checksum=None, size=None):
+        return ("<dokumentobjekt><versjonsnummer>1</versjonsnummer><referanseDokumentfil>dokumenter/%s</referanseDokumentfil>"
+                "<sjekksum>%s</sjekksum><sjekksumAlgoritme>%s</sjekksumAlgoritme><filstoerrelse>%s</filstoerrelse></dokumentobjekt>\n" % (
+                    name, checksum or hashlib.new(algorithm.replace("-", "").lower(), data).hexdigest().upper(), algorithm,
+                    len(data) if size is None else size))
+
+    inputfile = os.path.join(package_dir, "arkivstruktur.xml")
+    with open(inputfile, "w", encoding="utf-8") as output:
+        output.write("""<?xml version="1.0" encoding="utf-8"?>
+<arkiv xmlns="http://www.arkivverket.no/standarder/noark5/arkivstruktur"><systemID>a1</systemID>
+<arkivdel><systemID>d1</systemID><mappe><systemID>m1</systemID><registrering><systemID>r1</systemID>
+<dokumentbeskrivelse><systemID>db1</systemID>
+%s</dokumentbeskrivelse></registrering></mappe></arkivdel></arkiv>
+""" % "".join([dokumentobjekt("ok.pdf", files["ok.pdf"]), dokumentobjekt("size.pdf", files["size.pdf"], size=4),
+               dokumentobjekt("checksum.pdf", files["checksum.pdf"], checksum="00" * 32), dokumentobjekt("missing.pdf", b""),
+               dokumentobjekt("md5.txt", files["md5.txt"], algorithm="MD5"), dokumentobjekt("ok.pdf", files["ok.pdf"], algorithm="CRC-99", checksum="11")]))
+    return inputfile
+
+
+def test_checksums():
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    shutil.rmtree("output-checksums", ignore_errors=True)
+    inputfile = _documentPackage("output-checksums/package")
+    kinds = {"size" : 1, "checksum" : 1, "missing" : 1, "algorithm" : 1}
+
+    def read(path):
+        with open(path, encoding="utf-8") as infile:
+            return path.endswith(".json") and json.load(infile) or infile.read()
+
+    output = None
+    for streaming, verify_checksums in [(False, False), (False, True), (True, True)]:
+        output_dir = "output-checksums/%s-%s" % (streaming, verify_checksums)
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir=output_dir, output_mode="stream", streaming=streaming,
+                                verify_checksums=verify_checksums, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+        # Memory mapped, with the parser waiting for the hashing now and then
+        cfg.update(checksum_buffer_size=16, checksum_workers=2, checksum_queue=2)
+        sink = noark5tordf.process_xml_file(cfg, inputfile)
+
+        # The output stays the same
+        if not streaming:
+            output = output or read(output_dir + "/arkivstruktur.nt")
+            assert read(output_dir + "/arkivstruktur.nt") == output
+        if not verify_checksums:
+            assert not hasattr(sink, "checksums") and not os.path.exists(output_dir + "/arkivstruktur-checksums.json")
+            continue
+
+        assert sink.checksums.files == 6 and sink.getCounts()["checksum_mismatches"] == 4
+        report = read(output_dir + "/arkivstruktur-checksums.json")
+        assert report["files"] == 6 and report["kinds"] == kinds
+        assert [detail["file"] for detail in report["details"]] == ["dokumenter/checksum.pdf", "dokumenter/missing.pdf",
+                                                                     "dokumenter/ok.pdf", "dokumenter/size.pdf"]
+        assert report["details"][0]["message"].startswith("The SHA-256 checksum of the file is " + hashlib.sha256(b"hello").hexdigest())
+
+    # The files of a batch are reported together
+    shutil.copy(inputfile, "output-checksums/package/arkivstruktur2.xml")
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-checksums/batch", output_mode="stream",
+                            verify_checksums=True, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    stats = batch.process_xml_files(cfg, [inputfile, "output-checksums/package/arkivstruktur2.xml"], workers=2)
+    assert [s["checksum_mismatches"] for s in stats] == [4, 4]
+    report = read("output-checksums/batch/output-checksums.json")
+    assert report["files"] == 12 and report["kinds"] == dict((kind, 2) for kind in kinds)
+
+    # And so are the chunks of a split file, with the documents relative to "document_dir"
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-checksums/split", output_mode="stream",
+                            verify_checksums=True, document_dir="output-checksums/package", logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    result = split.process_large_xml_file(cfg, inputfile, workers=2, chunk_size=1)
+    assert result["checksum_mismatches"] == 4
+    assert read("output-checksums/split/arkivstruktur-checksums.json")["kinds"] == kinds
+
+    # Files outside of the package are never read, however they are named
+    secret = os.path.abspath("output-checksums/secret.txt")
+    with open(secret, "w", encoding="utf-8") as output:
+        output.write("secret")
+    os.symlink(secret, "output-checksums/package/dokumenter/link.txt")
+    outside = os.path.join("output-checksums/package", "outside.xml")
+    with open(outside, "w", encoding="utf-8") as output:
+        output.write("""<?xml version="1.0" encoding="utf-8"?>
+<arkiv xmlns="http://www.arkivverket.no/standarder/noark5/arkivstruktur"><systemID>a2</systemID>
+%s</arkiv>
+""" % "".join("<dokumentobjekt><referanseDokumentfil>%s</referanseDokumentfil><sjekksum>00</sjekksum></dokumentobjekt>\n" % name
+              for name in ["../secret.txt", secret, "dokumenter/link.txt", "dokumenter/../dokumenter/md5.txt"]))
+    cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-checksums/outside", output_mode="stream",
+                            verify_checksums=True, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+    noark5tordf.process_xml_file(cfg, outside)
+    report = read("output-checksums/outside/outside-checksums.json")
+    assert report["files"] == 4 and report["kinds"] == {"outside" : 3, "checksum" : 1}
+    assert hashlib.sha256(b"secret").hexdigest() not in json.dumps(report)
+    assert [detail["path"] for detail in report["details"] if detail["kind"] == "outside"] == [None, None, None]
+
+
+def test_memory():
+    """ Memory benchmark: peak memory per registrering while converting a large mappe """
+    cfg = {"type_prefix" : "http://www.arkivverket.no/standarder/noark5/arkivstruktur/", "subject_prefix" : "http://sesam.io/sys1/",
+           "ids" : ["systemID"], "ObjectElements" : {}}
+    data = _mappeXml(2000)
+
+    # The registrering objects are written as they end, the mappe keeps nothing of them
+    # (was ~740 bytes each with a dict based Entity that kept its SAX attributes)
+    per_object = _peakMemory(cfg, data) / 2000
+    assert per_object < 200, per_object
+
+    # As blank nodes they are kept (as compact property records) until the mappe ends
+    # (was ~9600 bytes each)
+    cfg["ObjectElements"]["registrering"] = {"id" : None}
+    per_blank_node = _peakMemory(cfg, data) / 2000
+    assert per_blank_node < 4000, per_blank_node
+
+    # Streamed, the mappe writes them as they end
+    cfg["streaming"] = True
+    per_streamed_blank_node = _peakMemory(cfg, data) / 2000
+    assert per_streamed_blank_node < 200, per_streamed_blank_node
+
+
+# Literal escaping conformance corpus: (literal, ASCII NTriples, UTF-8 NTriples)
+ESCAPE_CORPUS = [
+    ("", "", ""),
+    ("Birger Ballangrud (baladmin)", "Birger Ballangrud (baladmin)", "Birger Ballangrud (baladmin)"),
+    ("2014-11-04T15:10:29.598+01:00", "2014-11-04T15:10:29.598+01:00", "2014-11-04T15:10:29.598+01:00"),
+    ('Sak "Ålesund"', 'Sak \\"\\u00C5lesund\\"', 'Sak \\"Ålesund\\"'),
+    ("C:\\arkiv\\fil.pdf", "C:\\\\arkiv\\\\fil.pdf", "C:\\\\arkiv\\\\fil.pdf"),
+    ("linje 1\nlinje 2\r\n", "linje 1\\nlinje 2\\r\\n", "linje 1\\nlinje 2\\r\\n"),
+    ("vertikal\vtab", "vertikaltab", "vertikaltab"),
+    ("tab\tstays", "tab\tstays", "tab\tstays"),
+    ("æøå ÆØÅ", "\\u00E6\\u00F8\\u00E5 \\u00C6\\u00D8\\u00C5", "æøå ÆØÅ"),
+    ("Sámi: Čáhcesuolu ŋ", "S\\u00E1mi: \\u010C\\u00E1hcesuolu \\u014B", "Sámi: Čáhcesuolu ŋ"),
+    ("\u07ff\u0800", "\\u07FF\\u0800", "\u07ff\u0800"),
+    ("100 €", "100 \\u20AC", "100 €"),
+    ("\ufeff\uffff", "\\uFEFF\\uFFFF", "\ufeff\uffff"),
+    ("\U00010000 😀", "\\U00010000 \\U0001F600", "\U00010000 😀"),
+    ("a\u2028b\u0085c", "a\\u2028b\\u0085c", "a\u2028b\u0085c"),
+    ('\\u00E6 is not unescaped', '\\\\u00E6 is not unescaped', '\\\\u00E6 is not unescaped'),
+]
+
+
+def _referenceEscape(literal):
+    """ The escaping as originally implemented, character by character """
+    literal = literal.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"').replace('\r', '\\r').replace('\v', '')
+    result = ""
+    for char in literal:
+        if ord(char) < 0x80:
+            result += char
+        elif ord(char) <= 0xFFFF:
+            result += '\\u%04X' % ord(char)
+        else:
+            result += '\\U%08X' % ord(char)
+    return result
+
+
+def test_escape_literal():
+    for literal, ascii, utf8 in ESCAPE_CORPUS:
+        assert utils.escape_literal(literal) == ascii, (literal, utils.escape_literal(literal))
+        assert utils.escape_literal_utf8(literal) == utf8, (literal, utils.escape_literal_utf8(literal))
+        assert _referenceEscape(literal) == ascii
+
+    # Every code point, on its own and surrounded by text
+    for code in list(range(0, 0x3000)) + list(range(0xD7F0, 0x10100)) + [0x1F600, 0x10FFFF]:
+        char = chr(code)
+        assert utils.escape_literal(char) == _referenceEscape(char), hex(code)
+        assert utils.escape_literal("x" + char + "ø") == _referenceEscape("x" + char + "ø"), hex(code)
+
+    # Unescaped line separators in UTF-8 literals don't end the line
+    line = '<a> <p> "%s".\n' % utils.escape_literal_utf8("a\u2028b\u0085c\x1cd")
+    assert formats.splitTriples(line) == [("<a>", "<p>", '"a\u2028b\u0085c\x1cd"')]
+
+    assert utils.getLiteralEscaper({}) is utils.escape_literal
+    assert utils.getLiteralEscaper({"utf8_output" : True}) is utils.escape_literal_utf8
+
+    # UTF-8 output has the same triples, only without the escapes
+    env = {"SESAM_CONF" : "./noark5tordf/"}
+    results = []
+    for utf8_output in [False, True]:
+        cfg = config.readConfig(os.getcwd() +"/noark5tordf/config/noark5.yaml", output_dir="output-utf8", output_mode="stream",
+                                output_file="utf8-%s" % utf8_output, utf8_output=utf8_output, logfile="output.log", loglevel="DEBUG", env=env, logger=None)
+        cfg["ObjectElements"]["korrespondansepart"]["id-expression"] = 'result = context.getNumberedId()'
+
+        sink = noark5tordf.process_xml_file(cfg, os.getcwd() + "/noark5tordf/sample/arkivstruktur.xml")
+        with open(sink.filename, "r", encoding="utf-8") as infile:
+            results.append(infile.read())
+
+    assert results[0].isascii()
+    assert not results[1].isascii()
+    assert re.sub(r"\\u([0-9A-F]{4})", lambda match: chr(int(match.group(1), 16)), results[0]) == results[1]
+
+
+def _timePerItem(cfg, data, items, repeat=3):
+    """ Best time per item of converting "data" """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        noark5tordf.process_xml_file(cfg, io.BytesIO(data), sink=CountingSink(cfg))
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best / items
+
+
+def test_scaling():
+    """ Micro benchmark: the cost per blank node (or text chunk) must not grow with their number """
+    cfg = {"type_prefix" : "http://www.arkivverket.no/standarder/noark5/arkivstruktur/", "subject_prefix" : "http://sesam.io/sys1/",
+           "ids" : ["systemID"], "ObjectElements" : {"dokumentobjekt" : {"id" : None}}}
+
+    def dokumentbeskrivelse(dokumentobjekter):
+        dokumentobjekt = ('<dokumentobjekt><versjonsnummer>1</versjonsnummer><variantformat>Produksjonsformat</variantformat>'
+                          '<format>PDF</format><sjekksum>%d</sjekksum></dokumentobjekt>')
+        return ('<dokumentbeskrivelse><systemID>d</systemID>' + "".join(dokumentobjekt % i for i in range(dokumentobjekter))
+                + '</dokumentbeskrivelse>').encode("utf-8")
+
+    small = _timePerItem(cfg, dokumentbeskrivelse(1000), 1000)
+    large = _timePerItem(cfg, dokumentbeskrivelse(16000), 16000)
+    assert large < small * 3, (small, large)
+
+    # Every entity reference is a separate chunk of text from the parser
+    def tittel(chunks):
+        return ('<mappe><systemID>m</systemID><tittel>' + "Arkiv &amp; " * chunks + '</tittel></mappe>').encode("utf-8")
+
+    small = _timePerItem(cfg, tittel(4000), 4000)
+    large = _timePerItem(cfg, tittel(64000), 64000)
+    assert large < small * 3, (small, large)
+
+
+def test_deep_and_wide():
+    """ Micro benchmark: the cost per element must not grow with the depth or width of the tree """
+    cfg = {"type_prefix" : "http://www.arkivverket.no/standarder/noark5/arkivstruktur/", "subject_prefix" : "http://sesam.io/sys1/",
+           "ids" : ["systemID"], "ObjectElements" : {}}
+
+    def deep(depth):
+        return ("".join('<mappe><systemID>m%d</systemID><tittel>Tittel</tittel>' % i for i in range(depth))
+                + '</mappe>' * depth).encode("utf-8")
+
+    def wide(width):
+        return ('<mappe>' + "".join('<tittel>Tittel %d</tittel><registrering><systemID>r%d</systemID></registrering>' % (i, i) for i in range(width))
+                + '<systemID>m</systemID></mappe>').encode("utf-8")
+
+    for tree in [deep, wide]:
+        small = _timePerItem(cfg, tree(250), 250)
+        large = _timePerItem(cfg, tree(4000), 4000)
+        assert large < small * 3, (tree.__name__, small, large)
+
+    # The id is the last value of the first id element that is found
+    cfg["ids"] = ["@id", "systemID", "arkivskaperID"]
+    class SubjectSink(CountingSink):
+        subject_list = []
+        def openSubject(self, entity):
+            self.subject_list.append(entity.getSubject())
+            return CountingSink.openSubject(self, entity)
+
+    sink = SubjectSink(cfg)
+    data = b'<a><arkivskaperID>x</arkivskaperID><systemID>1</systemID><systemID>2</systemID><b><systemID>3</systemID></b></a>'
+    noark5tordf.process_xml_file(cfg, io.BytesIO(data), sink=sink)
+    assert sink.subject_list == ["<http://sesam.io/sys1/3>", "<http://sesam.io/sys1/2>"], sink.subject_list
+
+
 if __name__ == '__main__':
     test_load_config()
     test_convert()
+    test_convert_stream()
+    test_convert_sharded()
+    test_watch()
+    test_batch()
+    test_split()
+    test_expressions()
+    test_streaming()
+    test_escape_literal()
+    test_parsers()
+    test_compressed_input()
+    test_output_formats()
+    test_incremental()
+    test_stable_ids()
+    test_store()
+    test_validation()
+    test_rmil_schema()
+    test_generateconfig()
+    test_synthetic()
+    test_metrics()
+    test_subject_index()
+    test_references()
+    test_checksums()
+    test_memory()
+    test_scaling()
+    test_deep_and_wide()
+    teardown_module()
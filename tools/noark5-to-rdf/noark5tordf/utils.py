@@ -44,38 +44,78 @@ def assertDir(path, rootdir=None):
         try:
             os.makedirs(path)
         except OSError as exc: # Python >2.5
-            if exc.errno == errno.EEXIST and os.path.isdir(rootdir + os.sep + path):
+            if exc.errno == errno.EEXIST and os.path.isdir(path):
                 pass
             else:
                 raise
 
 
-def _xmlcharref_encode(unicode_data, encoding="ascii"):
-    """Emulate Python 2.3's 'xmlcharrefreplace' encoding error handler."""
-    res = ""
+# The characters that must be escaped in a NTriples string literal, "\v" is dropped
+_literal_escapes = {"\\" : "\\\\", "\n" : "\\n", '"' : '\\"', "\r" : "\\r", "\v" : ""}
+_literal_special = re.compile('[\\\\\n"\r\v]')
+_non_ascii = re.compile("[^\x00-\x7f]")
 
-    # Step through the unicode_data string one character at a time in
-    # order to catch unencodable characters:
-    for char in unicode_data:
-        try:
-            char.encode(encoding, 'strict')
-        except UnicodeError:
-            if ord(char) <= 0xFFFF:
-                res += '\\u%04X' % ord(char)
-            else:
-                res += '\\U%08X' % ord(char)
-        else:
-            res += char
+# str.translate() tables indexed by code point. Code points beyond the end of a table are
+# left as they are, the ASCII table covers the most common (latin, greek, cyrillic) letters
+_utf8_table = [chr(i) for i in range(0x80)]
+_ascii_table = _utf8_table + ["\\u%04X" % i for i in range(0x80, 0x800)]
+for char, escaped in _literal_escapes.items():
+    _utf8_table[ord(char)] = escaped
+    _ascii_table[ord(char)] = escaped
 
-    return res
+
+def _escapeCodePoint(match):
+    code = ord(match.group())
+    if code <= 0xFFFF:
+        return "\\u%04X" % code
+    return "\\U%08X" % code
 
 
 def escape_literal(literal):
-    """ Escape the string literal as per NTriples rules """
-    literal = literal.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"').replace('\r', '\\r').replace('\v', '')
-    literal = _xmlcharref_encode(literal, "ascii")
-    return literal
+    """ Escape the string literal as per NTriples rules, with everything but ASCII as \\uXXXX or \\UXXXXXXXX """
+    if literal.isascii():
+        if _literal_special.search(literal) is None:
+            return literal
+        return literal.translate(_utf8_table)
+
+    literal = literal.translate(_ascii_table)
+    if literal.isascii():
+        return literal
+
+    return _non_ascii.sub(_escapeCodePoint, literal)
+
+
+def escape_literal_utf8(literal):
+    """ Escape the string literal as per RDF 1.1 NTriples rules, leaving non-ASCII characters as they are """
+    if _literal_special.search(literal) is None:
+        return literal
+    return literal.translate(_utf8_table)
+
+
+_unescapes = {"n" : "\n", "r" : "\r", "t" : "\t", "b" : "\b", "f" : "\f"}
+_escaped = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+
+
+def _unescapeMatch(match):
+    code = match.group(1) or match.group(2)
+    if code:
+        return chr(int(code, 16))
+    char = match.group(3)
+    return _unescapes.get(char, char)
+
+
+def unescape_literal(literal):
+    """ Undo the NTriples escaping of a string literal (the part between the quotes) """
+    if "\\" not in literal:
+        return literal
+    return _escaped.sub(_unescapeMatch, literal)
+
 
+def getLiteralEscaper(config):
+    """ Get the escape function for the output encoding in the config ("utf8_output") """
+    if config.get("utf8_output"):
+        return escape_literal_utf8
+    return escape_literal
 
 
 def getCurrDir():
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, re, json, unicodedata
+
+from .utils import *
+from .formats import splitTriples
+from .inputs import getInputBasename
+from .rmil import XSD, loadSchema
+
+RDF_TYPE = "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>"
+
+# The RMIL property that constrains the class of the parent of a subject (the subject it links
+# to, or the subject that links to it for blank nodes) instead of a predicate
+PARENT_PROPERTY = "parent"
+
+# The kinds of violations
+MINCARD = "mincard"
+MAXCARD = "maxcard"
+DATATYPE = "datatype"
+VALUE = "value"
+RANGE = "range"
+PARENT = "parent"
+
+DEFAULT_MAX_DETAILS = 10000
+
+_date = r"-?\d{4,}-\d\d-\d\d"
+_time = r"\d\d:\d\d:\d\d(\.\d+)?"
+_zone = r"(Z|[+-]\d\d:\d\d)?"
+_integer = r"[+-]?\d+"
+_decimal = r"[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?|[+-]?INF|NaN"
+
+# Lexical forms of the XML schema datatypes by lower case name (the schemas are not consistent
+# about case). A xsd:dateTime may also be just a date, as it is in many Noark5 exports.
+# Other datatypes (like xsd:string) accept any literal
+DATATYPE_PATTERNS = dict((name, re.compile("^(%s)$" % pattern)) for name, pattern in [
+    ("datetime", "%s(T%s)?%s" % (_date, _time, _zone)),
+    ("date", _date + _zone),
+    ("time", _time + _zone),
+    ("gyear", r"-?\d{4,}" + _zone),
+    ("integer", _integer), ("int", _integer), ("long", _integer), ("short", _integer),
+    ("nonnegativeinteger", r"\+?\d+"), ("positiveinteger", r"\+?0*[1-9]\d*"),
+    ("decimal", _decimal), ("float", _decimal), ("double", _decimal),
+    ("boolean", "true|false|1|0"),
+])
+
+_literal_pattern = re.compile(r'^"(.*)"(\^\^<[^>]*>\S*|@\S+)?$')
+_folds = str.maketrans({"æ": "ae", "ø": "o", "å": "a"})
+
+
+def foldValue(value):
+    """ Fold a value for comparing it to the allowed values, ignoring case, accents and æ, ø and å """
+    value = unicodedata.normalize("NFKD", value.strip().casefold().translate(_folds))
+    return "".join(char for char in value if not unicodedata.combining(char))
+
+
+def _localName(name):
+    return name.rpartition(":")[2]
+
+
+class _Property:
+    """ A property constraint of the schema, prepared for checking values """
+    def __init__(self, schema, constraint):
+        self.constraint = constraint
+        self.name = constraint.name
+        self.predicate = "<%s>" % constraint.iri
+        self.is_parent = constraint.name == PARENT_PROPERTY
+        self.classes = [iri for iri in constraint.ranges if not iri.startswith(XSD)]
+        self.datatypes = [DATATYPE_PATTERNS.get(iri[len(XSD):].lower()) for iri in constraint.ranges if iri.startswith(XSD)]
+        self.allowed = None
+        self.allowed_iris = None
+
+        if constraint.values is not None:
+            self.allowed = set(foldValue(value) for value in constraint.values)
+        else:
+            # Literals of a vocabulary class are the name or a value (e.g. "tittel") of a instance
+            instances = [instance for iri in self.classes for instance in schema.getInstancesOf(iri)]
+            if instances:
+                self.allowed = set()
+                self.allowed_iris = set()
+                for instance in instances:
+                    self.allowed.add(foldValue(_localName(instance.name)))
+                    self.allowed_iris.add("<%s>" % instance.iri)
+                    for values in instance.values.values():
+                        self.allowed.update(foldValue(value) for value in values)
+
+    def checkValue(self, term):
+        """ Check a value (a term in NTriples syntax), returns (kind, message) or None if it is valid """
+        match = _literal_pattern.match(term)
+        if match is not None:
+            value = unescape_literal(match.group(1))
+            if self.allowed is not None and foldValue(value) not in self.allowed:
+                return VALUE, "'%s' is not one of the allowed values" % value
+            if self.datatypes:
+                if not [pattern for pattern in self.datatypes if pattern is None or pattern.match(value)]:
+                    return DATATYPE, "'%s' is not a valid %s" % (value, " or ".join(_localName(r) for r in self.constraint.ranges))
+            elif self.allowed is None:
+                return RANGE, "expected a %s, not a literal" % " or ".join(self.classes)
+            return None
+
+        if self.datatypes and not self.classes:
+            return RANGE, "expected a literal, not %s" % term
+        if self.allowed_iris is not None and term.startswith("<") and term not in self.allowed_iris:
+            return VALUE, "%s is not one of the allowed values" % term
+        return None
+
+
+class Validator:
+    """
+    Checks subjects against the constraints of a RMIL schema: the number of values of each
+    property, their datatypes and allowed values, and the class of the parent. The constraints
+    of a class include those of its superclasses. Subjects of classes that are not in the
+    schema are not checked.
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self._properties = {}
+        self._ancestors = {}
+        self.predicates = set()
+
+        for rmil_class in schema.classes.values():
+            for constraint in rmil_class.properties:
+                if constraint.name != PARENT_PROPERTY:
+                    self.predicates.add("<%s>" % constraint.iri)
+
+    def getProperties(self, type):
+        """ Get the prepared property constraints of a class (a URI), or None if it is not in the schema """
+        try:
+            return self._properties[type]
+        except KeyError:
+            pass
+
+        properties = None
+        if type in self.schema.classes:
+            properties = [_Property(self.schema, constraint) for constraint in self.schema.getProperties(type)]
+        self._properties[type] = properties
+        return properties
+
+    def isA(self, type, classes):
+        """ Checks if the class "type" is one of "classes" (URIs) or a subclass of one of them """
+        ancestors = self._ancestors.get(type)
+        if ancestors is None:
+            ancestors = self._ancestors[type] = set(self.schema.getAncestors(type))
+        return not ancestors.isdisjoint(classes)
+
+    def validate(self, report, subject, types, values, parent_type=None):
+        """
+        Check a subject with the given types (URIs), values (a dict of predicate to a list of
+        object terms, in NTriples syntax) and the type of its parent, adding any violations to
+        "report"
+        """
+        checked = False
+        for type in types:
+            properties = self.getProperties(type)
+            if properties is None:
+                continue
+            checked = True
+
+            for prop in properties:
+                if prop.is_parent:
+                    self._checkParent(report, subject, type, prop, parent_type)
+                    continue
+
+                objects = values.get(prop.predicate, ())
+                if len(objects) < prop.constraint.min:
+                    report.add(subject, type, MINCARD, prop.name, "has %s values, at least %s are required" % (len(objects), prop.constraint.min))
+                if prop.constraint.max is not None and len(objects) > prop.constraint.max:
+                    report.add(subject, type, MAXCARD, prop.name, "has %s values, at most %s are allowed" % (len(objects), prop.constraint.max))
+
+                for term in objects:
+                    violation = prop.checkValue(term)
+                    if violation is not None:
+                        report.add(subject, type, violation[0], prop.name, violation[1])
+
+        if checked:
+            report.subjects = report.subjects + 1
+
+    def _checkParent(self, report, subject, type, prop, parent_type):
+        if parent_type is None:
+            if prop.constraint.min > 0:
+                report.add(subject, type, MINCARD, prop.name, "has no parent, one of %s is required" % ", ".join(prop.classes))
+        elif prop.classes and not self.isA(parent_type, prop.classes):
+            report.add(subject, type, PARENT, prop.name, "the parent is a %s, not one of %s" % (parent_type, ", ".join(prop.classes)))
+
+
+class ValidationReport:
+    """
+    The violations found by a Validator. Every violation is counted, but only the first
+    "max_details" are kept
+    """
+    def __init__(self, max_details=None):
+        self.subjects = 0
+        self.violations = 0
+        self.kinds = {}
+        self.details = []
+        self._max_details = DEFAULT_MAX_DETAILS if max_details is None else max_details
+
+    def add(self, subject, type, kind, property, message):
+        self.violations = self.violations + 1
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+        if len(self.details) < self._max_details:
+            self.details.append({"subject": subject, "type": type, "kind": kind, "property": property, "message": message})
+
+    def isValid(self):
+        return self.violations == 0
+
+    def merge(self, other):
+        """ Add the counts and violations of another report, or of its asDict() """
+        if isinstance(other, ValidationReport):
+            other = other.asDict()
+
+        self.subjects = self.subjects + other["subjects"]
+        self.violations = self.violations + other["violations"]
+        for kind, count in other["kinds"].items():
+            self.kinds[kind] = self.kinds.get(kind, 0) + count
+        self.details.extend(other["details"][:max(0, self._max_details - len(self.details))])
+
+    def asDict(self):
+        return {"valid": self.isValid(), "subjects": self.subjects, "violations": self.violations,
+                "kinds": dict(self.kinds), "details": list(self.details),
+                "truncated": len(self.details) < self.violations}
+
+    def write(self, filename, **info):
+        """ Write the report as JSON, "info" (e.g. the input and schema) is added at the top """
+        report = dict(info)
+        report.update(self.asDict())
+        with open(filename, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2, ensure_ascii=False)
+        return filename
+
+
+# Schemas are only read once per process (e.g. a batch worker)
+_validators = {}
+
+
+def getSchemaPaths(config):
+    """ Get the schema files (RMIL or NTriples) of "validation_schema" in the config as a list (empty if there is none) """
+    paths = config.get("validation_schema") or []
+    if isinstance(paths, str):
+        paths = [paths]
+    return list(paths)
+
+
+def getValidator(config):
+    """ Get the Validator of the schema in the config, or None if it has none """
+    paths = tuple(getSchemaPaths(config))
+    if not paths:
+        return None
+
+    validator = _validators.get(paths)
+    if validator is None:
+        cache_dir = config.get("schema_cache_dir")
+        validator = _validators[paths] = Validator(loadSchema(list(paths), cache_dir, cache=cache_dir is not False))
+    return validator
+
+
+def getReportPath(config, inputfile=None):
+    """
+    Get the file the validation report of a input is written to: "validation_report" (relative
+    to the output dir) or "<input name>-validation.json" in the output dir
+    """
+    path = config.get("validation_report")
+    if not path:
+        name = inputfile and getInputBasename(inputfile) or "output"
+        if name.endswith(".xml"):
+            name = name[:-4]
+        path = name + "-validation.json"
+
+    if not os.path.isabs(path):
+        path = os.path.join(config.get("output_dir", "."), path)
+    return path
+
+
+class _ValidatingWriter:
+    """ Writes the pieces of a subject through to the sink, and collects the values to check """
+    def __init__(self, sink, entity, writer):
+        self._sink = sink
+        self._writer = writer
+        self._subject = entity.getSubject()
+        parent = entity.getParent()
+        self._parent_type = parent is not None and parent.getTypePredicate() or None
+        self._records = {}
+        self._links = {}
+
+    def write(self, data):
+        self._writer.write(data)
+
+        predicates = self._sink._validator.predicates
+        records = self._records
+        for subject, predicate, object in splitTriples(data):
+            record = records.get(subject)
+            if record is None:
+                record = records[subject] = ([], {})
+
+            if predicate == RDF_TYPE:
+                record[0].append(object[1:-1])
+            elif predicate in predicates:
+                record[1].setdefault(predicate, []).append(object)
+
+            # Blank nodes are written within their parent, which links to them
+            if object.startswith("_:"):
+                self._links[object] = subject
+
+    def close(self):
+        self._writer.close()
+        self._sink._checkSubjects(self._subject, self._parent_type, self._records, self._links)
+        self._records = self._links = None
+
+
+class ValidatingSink:
+    """
+    Wraps a sink, and checks every subject handed to it against the constraints of a RMIL schema
+    (see Validator) while it is written, so the subjects (and the blank nodes within them) are
+    checked as they are converted. The violations are collected in a ValidationReport, that is
+    written to "report_file" as JSON when the sink is closed.
+    """
+    def __init__(self, config, sink, validator, report_file=None, inputfile=None, logger=None):
+        self._config = config
+        self._inputfile = inputfile
+        self._sink = sink
+        self._validator = validator
+        self._report_file = report_file
+        self._logger = logger
+        self._closed = False
+        self.report = ValidationReport(config.get("validation_max_details"))
+
+    def __getattr__(self, name):
+        # The counts, file names etc. of the wrapped sink
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._sink, name)
+
+    def _checkSubjects(self, subject, parent_type, records, links):
+        for node, (types, values) in records.items():
+            if node == subject:
+                node_parent = parent_type
+            else:
+                linking = records.get(links.get(node))
+                node_parent = linking and linking[0] and linking[0][0] or None
+
+            self._validator.validate(self.report, node, types, values, node_parent)
+
+    def openSubject(self, entity):
+        return _ValidatingWriter(self, entity, self._sink.openSubject(entity))
+
+    def writeSubject(self, entity, data):
+        writer = self.openSubject(entity)
+        writer.write(data)
+        writer.close()
+
+    def getFilenames(self):
+        return self._sink.getFilenames()
+
+    def getCounts(self):
+        """ Get the counts of the wrapped sink (if any) and the number of violations """
+        counts = {}
+        if hasattr(self._sink, "getCounts"):
+            counts.update(self._sink.getCounts())
+        counts["violations"] = self.report.violations
+        return counts
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        self._sink.close()
+
+        if self._report_file:
+            self.report.write(self._report_file, input=self._inputfile, schema=getSchemaPaths(self._config))
+
+        if self._logger:
+            message = "Checked %s subjects, found %s violations" % (self.report.subjects, self.report.violations)
+            if self._report_file:
+                message = message + ", see '%s'" % self._report_file
+            if self.report.violations:
+                self._logger.warning(message)
+            else:
+                self._logger.info(message)
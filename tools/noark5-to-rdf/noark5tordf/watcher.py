@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, time, signal
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .utils import *
+from .batch import _initWorker, _convertFile
+from .inputs import isXmlInput
+from .incremental import startRun, finishRun
+
+PROCESSING_DIR = ".processing"
+FAILED_DIR = ".failed"
+
+def _isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def _moveAside(path, target_dir, name):
+    """ Move a file into "target_dir" without overwriting anything that is already there """
+    assertDir(target_dir)
+    target = os.path.join(target_dir, name)
+    if os.path.exists(target):
+        target = os.path.join(target_dir, "%s.%s" % (name, time.strftime("%Y%m%d%H%M%S")))
+
+    os.rename(path, target)
+    return target
+
+
+class Watcher:
+    """
+    Polls the "input_dir" of the config for (possibly compressed) XML files and converts them with a bounded pool of
+    worker processes. Files are claimed by an atomic rename into "<input_dir>/.processing" (the
+    claim carries the pid of the watcher) and moved to "backup_dir" when converted. Files that fail
+    are moved to "<input_dir>/.failed". Claims left behind by a watcher that died are put back into
+    the input dir on startup, so they are converted again.
+    """
+    def __init__(self, config, workers=None, logger=None):
+        self.config = config
+        self.workers = workers or os.cpu_count() or 1
+        self.logger = logger
+        self.interval = config.get("interval") or 5
+        self.input_dir = config["input_dir"]
+        self.backup_dir = config["backup_dir"]
+        self.processing_dir = os.path.join(self.input_dir, PROCESSING_DIR)
+        self.failed_dir = os.path.join(self.input_dir, FAILED_DIR)
+        self.stats = []
+        self.failed = []
+        self._pid = os.getpid()
+        self._sizes = {}
+        self._running = {}
+        self._stopped = False
+
+    def recoverClaims(self):
+        """ Put files claimed by watchers that are no longer running back into the input dir """
+        assertDir(self.processing_dir)
+        recovered = []
+
+        for claimed in sorted(os.listdir(self.processing_dir)):
+            pid, sep, name = claimed.partition("-")
+            if not sep or not pid.isdigit():
+                continue
+
+            if int(pid) != self._pid and _isAlive(int(pid)):
+                continue
+
+            if self.logger:
+                self.logger.warning("Resuming '%s' left behind by process %s" % (name, pid))
+
+            _moveAside(os.path.join(self.processing_dir, claimed), self.input_dir, name)
+            recovered.append(name)
+
+        return recovered
+
+    def pendingFiles(self):
+        """
+        Get the names of input files that are ready to be converted. A file is only
+        considered ready when its size has not changed since the previous poll, so files
+        that are still being copied into the input dir are left alone
+        """
+        sizes = {}
+        ready = []
+
+        for name in sorted(os.listdir(self.input_dir)):
+            path = os.path.join(self.input_dir, name)
+            if name.startswith(".") or not isXmlInput(name) or not os.path.isfile(path):
+                continue
+
+            sizes[name] = os.path.getsize(path)
+            if self._sizes.get(name) == sizes[name]:
+                ready.append(name)
+
+        self._sizes = sizes
+        return ready
+
+    def claim(self, name):
+        """ Atomically claim a input file, returns the claimed path or None if someone else got it """
+        claimed = os.path.join(self.processing_dir, "%s-%s" % (self._pid, name))
+        try:
+            os.rename(os.path.join(self.input_dir, name), claimed)
+        except FileNotFoundError:
+            return None
+
+        self._sizes.pop(name, None)
+        return claimed
+
+    def _finish(self, future):
+        claimed, name = self._running.pop(future)
+
+        try:
+            stats = future.result()
+        except Exception as e:
+            target = _moveAside(claimed, self.failed_dir, name)
+            self.failed.append(name)
+            if self.logger:
+                self.logger.error("Failed to convert '%s', moved it to '%s': %s" % (name, target, e))
+            return
+
+        target = _moveAside(claimed, self.backup_dir, name)
+        self.stats.append(stats)
+        if self.logger:
+            self.logger.info("Converted '%s' (%s subjects, %s triples in %.2fs), moved it to '%s'" % (
+                name, stats["subjects"], stats["triples"], stats["seconds"], target))
+
+    def stop(self, *args):
+        """ Stop after the files that are being converted are done """
+        self._stopped = True
+
+    def run(self, once=False):
+        """
+        Watch the input dir until stopped. If "once" is True, the files that are in
+        the input dir when called are converted and then the method returns
+        """
+        self.recoverClaims()
+
+        if once:
+            # No need to wait for files to settle
+            self.pendingFiles()
+
+        # With a manifest, only new and changed subjects are written. The files arrive one by
+        # one, so subjects missing from a file are not deleted
+        config = startRun(self.config)
+
+        logger_name = self.logger and self.logger.name or None
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_initWorker,
+                                 initargs=(config, logger_name)) as executor:
+            while not self._stopped:
+                for name in self.pendingFiles():
+                    if len(self._running) >= self.workers:
+                        # Bounded concurrency, the rest is picked up on a later poll
+                        break
+
+                    claimed = self.claim(name)
+                    if claimed is not None:
+                        future = executor.submit(_convertFile, claimed, name=name)
+                        self._running[future] = (claimed, name)
+
+                if once and not self._running:
+                    break
+
+                if self._running:
+                    done, pending = wait(list(self._running.keys()), timeout=self.interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._finish(future)
+                else:
+                    time.sleep(self.interval)
+
+            for future in list(self._running.keys()):
+                future.exception()
+                self._finish(future)
+
+        finishRun(config, deletions=False)
+        return self.stats
+
+
+def watch(config, workers=None, once=False, logger=None):
+    """ Run a Watcher on the input dir of the config until SIGTERM/SIGINT """
+    watcher = Watcher(config, workers=workers, logger=logger)
+
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+
+    if logger:
+        logger.info("Watching '%s' for XML files every %ss with %s workers" % (watcher.input_dir, watcher.interval, watcher.workers))
+
+    return watcher.run(once=once)
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
+import os, sys, logging
 import xml.sax
 
 from .elements import Entity
+from .rules import compileRules
+from .sinks import PerSubjectSink
 from .utils import *
 
 class GeneralXmlHandler(xml.sax.ContentHandler):
@@ -12,7 +14,7 @@ class GeneralXmlHandler(xml.sax.ContentHandler):
     SAX content handler class that can traverse a NOARK 5 compliant XML file
     and construct a object tree that is then serialized to RDF (NTriples format)
     """
-    def __init__(self, config, logger=None):
+    def __init__(self, config, logger=None, sink=None, bnode_prefix="", context_depth=0):
         self.parent = ""
         self.subject = ""
         self.root = None
@@ -20,30 +22,61 @@ class GeneralXmlHandler(xml.sax.ContentHandler):
         self.config = config
         self.count_dict = {}
         self.logger = logger
-        self.text = ""
+        # Checked once, the debug messages would otherwise be formatted for every element
+        self.debug = logger is not None and logger.isEnabledFor(logging.DEBUG)
+        self.text = []
+        self.bnode_prefix = bnode_prefix
+        self.rules = compileRules(config)
+        self.streaming = bool(config.get("streaming"))
+        # Checks the document files of the dokumentobjekter, see checksums.ChecksumVerifier
+        self.verifier = None
+
+        # The outermost "context_depth" elements only provide context (parent links)
+        # for the elements below them, and are not serialized themselves
+        self.context_depth = context_depth
+
+        # Without a given sink we fall back to the one-file-per-subject layout
+        self._owns_sink = sink is None
+        if sink is None:
+            sink = PerSubjectSink(config, logger=logger)
+        self.sink = sink
 
     def getCurrentEntity(self, pop=False):
-        current_entity = len(self._entities) > 0 and self._entities[0] or None
-        
+        """ Get the innermost open entity (the top of the stack), and optionally pop it """
+        if not self._entities:
+            return None
+
         if pop:
-            self._entities = self._entities[1:]
+            return self._entities.pop()
 
-        return current_entity
+        return self._entities[-1]
     
     def setCurrentEntity(self, entity):
-        self._entities.insert(0, entity)
+        """ Push a entity onto the stack """
+        self._entities.append(entity)
         return self._entities
 
     def startElementNS(self, nsname, qname, attrs):
         """ Create a entity or property object based on config lookup """
         uri, name = nsname
         
-        if self.logger:
+        if self.debug:
             self.logger.debug("Start of entity:" + name)
+
+        # The names from the parser are new strings for every element, use the interned
+        # name from the rule and an interned namespace instead
+        rule = self.rules[name]
+        if uri:
+            uri = sys.intern(uri)
         
         # Create a Entity
         parent = self.getCurrentEntity()
-        entity = Entity(name, attrs, self.config, parent, count_dict=self.count_dict, namespace=uri)
+
+        # At the first child we know that the parent is not a property, it can start streaming
+        if self.streaming and parent is not None and not parent.hasChildren() and len(self._entities) > self.context_depth:
+            self.prepareStreaming(parent)
+
+        entity = Entity(rule.name, attrs, self.config, parent, count_dict=self.count_dict, namespace=uri, bnode_prefix=self.bnode_prefix, rule=rule)
         
         if parent is None:
             # This entity is the root
@@ -51,12 +84,32 @@ class GeneralXmlHandler(xml.sax.ContentHandler):
 
         # Push the entity onto the stack
         self.setCurrentEntity(entity)
-        self.text = ""
+        self.text = []
+
+    def prepareStreaming(self, entity):
+        """
+        Start streaming a entity if its id is known already, or else remember the element that will
+        tell us. Explicit blank nodes are streamed within the parent, if the parent is streaming
+        (unless they get stable ids).
+        """
+        if entity.getRule().is_blank:
+            # A stable blank node label depends on the content, so it can't be written early
+            parent = entity.getParent()
+            if parent is not None and parent.isStreaming() and not entity.getRule().stable_ids:
+                entity.startStreaming(parent.getWriter())
+            return
+
+        id, id_element = entity.getEarlyId()
+        if id is not None:
+            entity.setId(id)
+            entity.startStreaming(self.sink.openSubject(entity))
+        elif id_element is not None:
+            entity.awaitId(id_element)
 
     def endElementNS(self, nsname, qname):
         """ Serialize to RDF if the ended element node is a entity """
         uri, name = nsname
-        if self.logger:
+        if self.debug:
             self.logger.debug("end of entity: " + name)
 
         # Pick a entity element off the stack
@@ -66,28 +119,64 @@ class GeneralXmlHandler(xml.sax.ContentHandler):
         #    import pdb;pdb.set_trace()
         
         # Is this a "property" type element?
-        if len(entity.getEntities()) == 0:
-            entity.setValue(self.text);
-            if self.logger:
-                self.logger.debug("Setting value of element '%s' to '%s'" % (str(entity), self.text))
-            self.text = ""
+        if not entity.hasChildren():
+            text = "".join(self.text)
+            entity.setValue(text)
+            if self.debug:
+                self.logger.debug("Setting value of element '%s' to '%s'" % (str(entity), text))
+            self.text = []
 
-        # If it is a "object" type element, serialize it to NTriples
-        if not (entity.isProperty() or entity.isContainedObject()):
-            id = entity.getSubject() + "-" + entity.getType()
+            # Keep only the compact property record in the parent
+            parent = entity.getParent()
+            if self.verifier is not None and parent is not None:
+                self.verifier.addProperty(parent, entity.getName(), text)
+            if entity.isProperty() and parent is not None:
+                if parent.isStreaming():
+                    parent.writeChild(entity.toProperty())
+                    parent.replaceEntity(entity, None)
+                    return
+
+                parent.replaceEntity(entity, entity.toProperty())
+
+                if parent.awaitsId(entity.getName()):
+                    parent.setId(entity.getValue())
+                    parent.startStreaming(self.sink.openSubject(parent))
+                return
 
-            filename = self.config.get("output_dir",".") + os.path.sep + "%s.nt" % stringToFilename(id)
+        parent = entity.getParent()
+        if self.verifier is not None:
+            self.verifier.finishEntity(entity)
 
-            if self.logger:
-                self.logger.info("Writing %s to file '%s'" % (entity, filename))
+        # If it is a "object" type element, serialize it to NTriples
+        if len(self._entities) < self.context_depth:
+            pass
+        elif entity.isStreaming():
+            # Everything but the link to the parent has been written already
+            entity.finishStreaming()
+
+            if parent is not None:
+                parent.replaceEntity(entity, None)
+            entity.cleanUp()
+        elif not (entity.isProperty() or entity.isContainedObject()):
+            writer = self.sink.openSubject(entity)
+            entity.writeNTriples(writer.write)
+            writer.close()
 
-            with open(filename, "w") as output:
-                output.write(entity.generateNTriples())
-                
-            # We're done with this object now, hand it over to GC
+            # We're done with this object now, hand it over to GC. The
+            # parent doesn't need it either (it only links to blank nodes)
+            if parent is not None:
+                parent.replaceEntity(entity, None)
             entity.cleanUp()
             del entity
+        elif parent is not None and parent.isStreaming():
+            # A finished blank node tree of a streaming parent
+            parent.writeChild(entity)
+            parent.replaceEntity(entity, None)
+
+    def endDocument(self):
+        if self._owns_sink:
+            self.sink.close()
 
     def characters(self, text):
-        """ Accumulate text values """
-        self.text += text
+        """ Accumulate text values, the chunks are joined when the element ends """
+        self.text.append(text)
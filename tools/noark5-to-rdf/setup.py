@@ -9,8 +9,9 @@ setup(name='noark5tordf',
       author='Graham Moore',
       author_email='graham.moore@sesam.io',
       url='http://sesam.io',
-      packages=['noark5tordf'],      
+      packages=['noark5tordf', 'noark5tordf.rmil'],
       install_requires=['pyyaml>=3.11','nose'],
+      extras_require={'lxml': ['lxml'], 'zstd': ['zstandard'], 'rdflib': ['rdflib>=6']},
       test_suite = 'nose.collector',
       license = "BSD",
       keywords = "convert noark5 xml rdf",
@@ -28,5 +29,9 @@ setup(name='noark5tordf',
       entry_points={
           'console_scripts': [
               'noark5tordf=noark5tordf.noark5tordf:main',
+              'rmil2rdf=noark5tordf.rmil.__main__:main',
+              'noark5tordf-generateconfig=noark5tordf.generateconfig:main',
+              'noark5tordf-synthetic=noark5tordf.synthetic:main',
+              'noark5tordf-lookup=noark5tordf.lookup:main',
           ],
       })